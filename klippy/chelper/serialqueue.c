@@ -1030,28 +1030,30 @@ serialqueue_send(struct serialqueue *sq, struct command_queue *cq, uint8_t *msg
     serialqueue_send_batch(sq, cq, &msgs);
 }
 
-// Return a message read from the serial port (or wait for one if none
-// available)
-void __visible
-serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
+// Wait for a message to be available on the receive queue (returns
+// -1 if the serialqueue is exiting)
+static int
+wait_receive(struct serialqueue *sq)
 {
-    pthread_mutex_lock(&sq->lock);
-    // Wait for message to be available
     while (list_empty(&sq->receive_queue)) {
         if (pollreactor_is_exit(&sq->pr))
-            goto exit;
+            return -1;
         sq->receive_waiting = 1;
         int ret = pthread_cond_wait(&sq->cond, &sq->lock);
         if (ret)
             report_errno("pthread_cond_wait", ret);
     }
+    return 0;
+}
 
-    // Remove message from queue
+// Remove the first message from the receive queue and copy it to 'pqm'
+static void
+copy_receive(struct serialqueue *sq, struct pull_queue_message *pqm)
+{
     struct queue_message *qm = list_first_entry(
         &sq->receive_queue, struct queue_message, node);
     list_del(&qm->node);
 
-    // Copy message
     memcpy(pqm->msg, qm->msg, qm->len);
     pqm->len = qm->len;
     pqm->sent_time = qm->sent_time;
@@ -1061,13 +1063,35 @@ serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
         debug_queue_add(&sq->old_receive, qm);
     else
         message_free(qm);
+}
 
+// Return a message read from the serial port (or wait for one if none
+// available)
+void __visible
+serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
+{
+    pthread_mutex_lock(&sq->lock);
+    if (wait_receive(sq))
+        pqm->len = -1;
+    else
+        copy_receive(sq, pqm);
     pthread_mutex_unlock(&sq->lock);
-    return;
+}
 
-exit:
-    pqm->len = -1;
+// Return up to 'max' messages read from the serial port (or wait for
+// at least one if none available).  Returns the number of messages or
+// -1 if the serialqueue is exiting.
+int __visible
+serialqueue_pull_batch(struct serialqueue *sq, struct pull_queue_message *q
+                       , int max)
+{
+    pthread_mutex_lock(&sq->lock);
+    int count = wait_receive(sq);
+    if (!count)
+        while (count < max && !list_empty(&sq->receive_queue))
+            copy_receive(sq, &q[count++]);
     pthread_mutex_unlock(&sq->lock);
+    return count;
 }
 
 void __visible
@@ -99,6 +99,8 @@ class PrinterConfig:
         self.status_raw_config = {}
         self.status_settings = {}
         self.save_config_pending = False
+        self.webhooks = printer.lookup_object('webhooks')
+        self.webhooks.register_status_tracking('configfile')
         gcode = self.printer.lookup_object('gcode')
         gcode.register_command("SAVE_CONFIG", self.cmd_SAVE_CONFIG,
                                desc=self.cmd_SAVE_CONFIG_help)
@@ -255,6 +257,7 @@ class PrinterConfig:
         self.status_settings = {}
         for (section, option), value in config.access_tracking.items():
             self.status_settings.setdefault(section, {})[option] = value
+        self.webhooks.mark_status_dirty('configfile')
     def log_config(self, config):
         lines = ["===== Config file =====",
                  self._build_config_string(config),
@@ -267,6 +270,7 @@ class PrinterConfig:
             self.status_raw_config[section.get_name()] = section_status = {}
             for option in section.get_prefix_options(''):
                 section_status[option] = section.get(option, note_valid=False)
+        self.webhooks.mark_status_dirty('configfile')
     def get_status(self, eventtime):
         return {'config': self.status_raw_config,
                 'settings': self.status_settings,
@@ -278,10 +282,12 @@ class PrinterConfig:
         svalue = str(value)
         self.autosave.fileconfig.set(section, option, svalue)
         self.save_config_pending = True
+        self.webhooks.mark_status_dirty('configfile', ['save_config_pending'])
         logging.info("save_config: set [%s] %s = %s", section, option, svalue)
     def remove_section(self, section):
         self.autosave.fileconfig.remove_section(section)
         self.save_config_pending = True
+        self.webhooks.mark_status_dirty('configfile', ['save_config_pending'])
     def _disallow_include_conflicts(self, regular_data, cfgname, gcode):
         config = self._build_config_wrapper(regular_data, cfgname)
         for section in self.autosave.fileconfig.sections():
@@ -3,7 +3,7 @@
 # Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, time, collections, multiprocessing, os
+import logging, time, collections, multiprocessing, os, importlib
 from . import bus
 
 # ADXL345 registers
@@ -25,6 +25,17 @@ SCALE = 0.004 * 9.80665 * 1000. # 4mg/LSB * Earth gravity in mm/s**2
 Accel_Measurement = collections.namedtuple(
     'Accel_Measurement', ('time', 'accel_x', 'accel_y', 'accel_z'))
 
+# Decode raw (sequence, data) blocks into an (N, 3) numpy array of
+# (accel_x, accel_y, accel_z) rows
+def decode_accel_array(np, axes_map, raw_samples):
+    rawdata = b"".join([data[:len(data) - len(data) % 6]
+                        for seq, data in raw_samples])
+    sdata = np.frombuffer(rawdata, dtype='<i2').reshape(-1, 3)
+    accel = np.empty(sdata.shape)
+    for i, (pos, scale) in enumerate(axes_map):
+        accel[:,i] = sdata[:,pos] * scale
+    return accel
+
 # Sample results
 class ADXL345Results:
     def __init__(self):
@@ -38,7 +49,8 @@ class ADXL345Results:
                 % (self.drops, self.overflows,
                    self.time_per_sample, self.start_range, self.end_range))
     def setup_data(self, axes_map, raw_samples, end_sequence, overflows,
-                   start1_time, start2_time, end1_time, end2_time):
+                   start1_time, start2_time, end1_time, end2_time,
+                   popped_count=0):
         if not raw_samples or not end_sequence:
             return
         self.axes_map = axes_map
@@ -51,7 +63,8 @@ class ADXL345Results:
         total_time = end2_time - start2_time
         self.time_per_sample = time_per_sample = total_time / self.total_count
         self.seq_to_time = time_per_sample * 8.
-        actual_count = sum([len(data)//6 for _, data in raw_samples])
+        actual_count = popped_count + sum([len(data)//6
+                                           for _, data in raw_samples])
         self.drops = self.total_count - actual_count
     def decode_samples(self):
         if not self.raw_samples:
@@ -74,6 +87,28 @@ class ADXL345Results:
                 actual_count += 1
         del samples[actual_count:]
         return self.samples
+    def decode_samples_array(self):
+        # Decode all samples into an (N, 4) numpy array of
+        # (time, accel_x, accel_y, accel_z) rows.  Returns None if
+        # numpy is not available.
+        try:
+            np = importlib.import_module('numpy')
+        except ImportError:
+            return None
+        if not self.raw_samples:
+            return np.zeros((0, 4))
+        seqs = np.array([seq for seq, data in self.raw_samples])
+        counts = np.array([len(data) // 6 for seq, data in self.raw_samples])
+        accel = decode_accel_array(np, self.axes_map, self.raw_samples)
+        # Sample time is the block time plus the index within the block
+        starts = np.cumsum(counts) - counts
+        block_times = self.start2_time + seqs * self.seq_to_time
+        index = np.arange(accel.shape[0]) - np.repeat(starts, counts)
+        samples = np.empty((accel.shape[0], 4))
+        samples[:,0] = (np.repeat(block_times, counts)
+                        + index * self.time_per_sample)
+        samples[:,1:] = accel
+        return samples
     def write_to_file(self, filename):
         def write_impl():
             try:
@@ -84,10 +119,18 @@ class ADXL345Results:
             f = open(filename, "w")
             f.write("##%s\n#time,accel_x,accel_y,accel_z\n" % (
                 self.get_stats(),))
-            samples = self.samples or self.decode_samples()
-            for t, accel_x, accel_y, accel_z in samples:
-                f.write("%.6f,%.6f,%.6f,%.6f\n" % (
-                    t, accel_x, accel_y, accel_z))
+            samples = self.samples
+            if not samples:
+                samples = self.decode_samples_array()
+            if samples is None:
+                samples = self.decode_samples()
+            if isinstance(samples, list):
+                for t, accel_x, accel_y, accel_z in samples:
+                    f.write("%.6f,%.6f,%.6f,%.6f\n" % (
+                        t, accel_x, accel_y, accel_z))
+            else:
+                np = importlib.import_module('numpy')
+                np.savetxt(f, samples, fmt="%.6f", delimiter=",")
             f.close()
         write_proc = multiprocessing.Process(target=write_impl)
         write_proc.daemon = True
@@ -110,6 +153,7 @@ class ADXL345:
             raise config.error("Invalid rate parameter: %d" % (self.data_rate,))
         # Measurement storage (accessed from background thread)
         self.raw_samples = []
+        self.popped_count = 0
         self.last_sequence = 0
         self.samples_start1 = self.samples_start2 = 0.
         # Setup mcu sensor_adxl345 bulk query code
@@ -123,7 +167,8 @@ class ADXL345:
                            % (oid,), on_restart=True)
         mcu.register_config_callback(self._build_config)
         mcu.register_response(self._handle_adxl345_start, "adxl345_start", oid)
-        mcu.register_response(self._handle_adxl345_data, "adxl345_data", oid)
+        mcu.register_response(self._handle_adxl345_data, "adxl345_data", oid,
+                              bulk=True)
         # Register commands
         self.name = "default"
         if len(config.get_name().split()) > 1:
@@ -154,17 +199,20 @@ class ADXL345:
     def _handle_adxl345_start(self, params):
         self.samples_start1 = self._clock_to_print_time(params['start1_time'])
         self.samples_start2 = self._clock_to_print_time(params['start2_time'])
-    def _handle_adxl345_data(self, params):
+    def _handle_adxl345_data(self, msgs):
+        # Called with the list of data blocks received in a batch
         last_sequence = self.last_sequence
-        sequence = (last_sequence & ~0xffff) | params['sequence']
-        if sequence < last_sequence:
-            sequence += 0x10000
-        self.last_sequence = sequence
         raw_samples = self.raw_samples
-        if len(raw_samples) >= 300000:
-            # Avoid filling up memory with too many samples
-            return
-        raw_samples.append((sequence, params['data']))
+        for params in msgs:
+            sequence = (last_sequence & ~0xffff) | params['sequence']
+            if sequence < last_sequence:
+                sequence += 0x10000
+            last_sequence = sequence
+            if len(raw_samples) >= 300000:
+                # Avoid filling up memory with too many samples
+                continue
+            raw_samples.append((sequence, params['data']))
+        self.last_sequence = last_sequence
     def _convert_sequence(self, sequence):
         sequence = (self.last_sequence & ~0xffff) | sequence
         if sequence < self.last_sequence:
@@ -190,6 +238,7 @@ class ADXL345:
         # Setup samples
         print_time = self.printer.lookup_object('toolhead').get_last_move_time()
         self.raw_samples = []
+        self.popped_count = 0
         self.last_sequence = 0
         self.samples_start1 = self.samples_start2 = print_time
         # Start bulk reading
@@ -220,10 +269,27 @@ class ADXL345:
         res = ADXL345Results()
         res.setup_data(self.axes_map, raw_samples, end_sequence, overflows,
                        self.samples_start1, self.samples_start2,
-                       end1_time, end2_time)
+                       end1_time, end2_time, self.popped_count)
         logging.info("ADXL345 finished %d measurements: %s",
                      res.total_count, res.get_stats())
         return res
+    def pop_raw_samples(self):
+        # Remove and return the data blocks received so far.  The most
+        # recent block is retained so that finish_measurements() can
+        # determine the total sample count.
+        raw_samples = self.raw_samples
+        count = len(raw_samples) - 1
+        if count <= 0:
+            return []
+        popped = raw_samples[:count]
+        del raw_samples[:count]
+        self.popped_count += sum([len(data)//6 for _, data in popped])
+        return popped
+    def decode_raw_samples(self, raw_samples):
+        np = importlib.import_module('numpy')
+        if not raw_samples:
+            return np.zeros((0, 3))
+        return decode_accel_array(np, self.axes_map, raw_samples)
     def end_query(self, name):
         if not self.query_rate:
             return
@@ -4,7 +4,7 @@
 # Copyright (C) 2018-2019 Eric Callahan <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, math, json, collections
+import logging, math, json, collections, importlib
 from . import probe
 
 PROFILE_VERSION = 1
@@ -74,6 +74,9 @@ class BedMesh:
         self.fade_target = 0.
         self.gcode = self.printer.lookup_object('gcode')
         self.splitter = MoveSplitter(config, self.gcode)
+        self.status_name = config.get_name()
+        self.webhooks = self.printer.lookup_object('webhooks')
+        self.webhooks.register_status_tracking(self.status_name)
         # setup persistent storage
         self.pmgr = ProfileManager(config, self)
         self.save_profile = self.pmgr.save_profile
@@ -95,6 +98,7 @@ class BedMesh:
         self.bmc.print_generated_points(logging.info)
         self.pmgr.initialize()
     def set_mesh(self, mesh):
+        self.mark_status_dirty()
         if mesh is not None and self.fade_end != self.FADE_DISABLE:
             self.log_fade_complete = True
             if self.base_fade_target is None:
@@ -130,6 +134,8 @@ class BedMesh:
         # cache the current position before a transform takes place
         gcode_move = self.printer.lookup_object('gcode_move')
         gcode_move.reset_last_position()
+    def mark_status_dirty(self, fields=None):
+        self.webhooks.mark_status_dirty(self.status_name, fields)
     def get_z_factor(self, z_pos):
         if z_pos >= self.fade_end:
             return 0.
@@ -231,6 +237,58 @@ class BedMesh:
         self.set_mesh(None)
 
 
+# Find the region of the bed covered by the extrusion moves of a
+# g-code file.  This is run in a background process (see
+# workerpool.py).
+def calc_print_bounds(filename):
+    min_x = min_y = 99999999.
+    max_x = max_y = -99999999.
+    absolute = True
+    pos_x = pos_y = 0.
+    with open(filename, 'rb') as f:
+        for line in f:
+            words = line.split(b';', 1)[0].upper().split()
+            if not words:
+                continue
+            cmd = words[0]
+            if cmd == b'G90':
+                absolute = True
+                continue
+            elif cmd == b'G91':
+                absolute = False
+                continue
+            elif cmd not in (b'G0', b'G1', b'G2', b'G3'):
+                continue
+            try:
+                args = dict([(w[:1], float(w[1:])) for w in words[1:]])
+            except ValueError:
+                continue
+            prev_x, prev_y = pos_x, pos_y
+            if absolute:
+                pos_x = args.get(b'X', pos_x)
+                pos_y = args.get(b'Y', pos_y)
+            else:
+                pos_x += args.get(b'X', 0.)
+                pos_y += args.get(b'Y', 0.)
+            if b'E' not in args or (pos_x == prev_x and pos_y == prev_y):
+                continue
+            pts = [(prev_x, prev_y), (pos_x, pos_y)]
+            if cmd in (b'G2', b'G3'):
+                # Use the full circle of an arc
+                i, j = args.get(b'I', 0.), args.get(b'J', 0.)
+                r = math.sqrt(i*i + j*j)
+                pts.append((prev_x + i - r, prev_y + j - r))
+                pts.append((prev_x + i + r, prev_y + j + r))
+            for x, y in pts:
+                min_x = min(min_x, x)
+                max_x = max(max_x, x)
+                min_y = min(min_y, y)
+                max_y = max(max_y, y)
+    if min_x > max_x:
+        return None
+    return (min_x, min_y), (max_x, max_y)
+
+
 class BedMeshCalibrate:
     ALGOS = ['lagrange', 'bicubic']
     def __init__(self, config, bedmesh):
@@ -241,6 +299,10 @@ class BedMeshCalibrate:
         self.relative_reference_index = config.getint(
             'relative_reference_index', None)
         self.orig_config['rri'] = self.relative_reference_index
+        self.adaptive_margin = config.getfloat('adaptive_margin', 5.,
+                                               minval=0.)
+        self.adaptive_profile = None
+        self.adaptive_align = False
         self.bedmesh = bedmesh
         self.mesh_config = collections.OrderedDict()
         self._init_mesh_config(config)
@@ -389,8 +451,72 @@ class BedMeshCalibrate:
                     "interpolation. Configured Probe Count: %d, %d" %
                     (self.mesh_config['x_count'], self.mesh_config['y_count']))
                 params['algo'] = 'lagrange'
+    def _setup_adaptive(self, gcmd):
+        # Limit probing to the region of the bed used by the print
+        if self.radius is not None:
+            raise gcmd.error(
+                "bed_mesh: adaptive meshes are not supported on round beds")
+        prof_name = gcmd.get('ADAPTIVE_PROFILE', 'default')
+        profile = self.bedmesh.pmgr.get_profiles().get(prof_name)
+        if profile is None:
+            raise gcmd.error(
+                "bed_mesh: adaptive mesh requires a full bed profile [%s],"
+                " run BED_MESH_CALIBRATE without ADAPTIVE first" % (prof_name,))
+        print_min, print_max = self._get_print_bounds(gcmd)
+        margin = gcmd.get_float('ADAPTIVE_MARGIN', self.adaptive_margin,
+                                minval=0.)
+        # Expand the region to the lines of the full bed mesh so that
+        # it contains full bed points to be replaced
+        base_params = profile['mesh_params']
+        region_min = []
+        region_max = []
+        for i, axis in enumerate('xy'):
+            base_min = base_params['min_' + axis]
+            base_max = base_params['max_' + axis]
+            base_cnt = base_params[axis + '_count']
+            dist = (base_max - base_min) / (base_cnt - 1)
+            low = constrain(print_min[i] - margin,
+                            base_min, base_max)
+            high = constrain(print_max[i] + margin,
+                             base_min, base_max)
+            low_idx = int(math.floor((low - base_min) / dist + .001))
+            low_idx = min(low_idx, base_cnt - 2)
+            high_idx = int(math.ceil((high - base_min) / dist - .001))
+            high_idx = max(high_idx, low_idx + 1)
+            region_min.append(base_min + low_idx * dist)
+            region_max.append(base_min + high_idx * dist)
+            # Probe the region at the density of the full bed mesh
+            cnt = int(math.ceil(base_cnt * (high_idx - low_idx)
+                                / (base_cnt - 1.)))
+            self.mesh_config[axis + '_count'] = max(3, cnt)
+        self.mesh_min = tuple(region_min)
+        self.mesh_max = tuple(region_max)
+        # Probed values are aligned with the stored profile instead
+        self.adaptive_align = self.relative_reference_index is not None
+        self.relative_reference_index = None
+        self.adaptive_profile = prof_name
+    def _get_print_bounds(self, gcmd):
+        params = gcmd.get_command_parameters()
+        if 'PRINT_MIN' in params or 'PRINT_MAX' in params:
+            return (parse_pair(gcmd, ('PRINT_MIN',)),
+                    parse_pair(gcmd, ('PRINT_MAX',)))
+        sdcard = self.printer.lookup_object('virtual_sdcard', None)
+        if sdcard is None or sdcard.file_path is None:
+            raise gcmd.error(
+                "bed_mesh: PRINT_MIN and PRINT_MAX must be specified when"
+                " no print file is loaded")
+        import workerpool
+        pool = workerpool.lookup_worker_pool(self.printer)
+        bounds = pool.run(calc_print_bounds, (sdcard.file_path,),
+                          "Scanning print file...")
+        if bounds is None:
+            raise gcmd.error(
+                "bed_mesh: No extrusion moves found in print file")
+        return bounds
     def update_config(self, gcmd):
         # reset default configuration
+        self.adaptive_profile = None
+        self.adaptive_align = False
         self.radius = self.orig_config['radius']
         self.origin = self.orig_config['origin']
         self.relative_reference_index = self.orig_config['rri']
@@ -438,6 +564,10 @@ class BedMeshCalibrate:
             self.mesh_config['algo'] = gcmd.get('ALGORITHM').strip().lower()
             need_cfg_update = True
 
+        if gcmd.get_int('ADAPTIVE', 0, minval=0, maxval=1):
+            self._setup_adaptive(gcmd)
+            need_cfg_update = True
+
         if need_cfg_update:
             self._verify_algorithm(gcmd.error)
             self._generate_points(gcmd.error)
@@ -526,6 +656,11 @@ class BedMeshCalibrate:
                         "Probed table length: %d Probed Table:\n%s") %
                     (len(probed_matrix), str(probed_matrix)))
 
+        prof_name = "default"
+        if self.adaptive_profile is not None:
+            prof_name = self.adaptive_profile
+            probed_matrix, params = self._merge_adaptive(
+                probed_matrix, params)
         z_mesh = ZMesh(params)
         try:
             z_mesh.build_mesh(probed_matrix)
@@ -533,8 +668,50 @@ class BedMeshCalibrate:
             raise self.gcode.error(str(e))
         self.bedmesh.set_mesh(z_mesh)
         self.gcode.respond_info("Mesh Bed Leveling Complete")
-        self.bedmesh.save_profile("default")
+        self.bedmesh.save_profile(prof_name)
+    def _merge_adaptive(self, probed_matrix, params):
+        # Replace the points of the full bed profile that are within
+        # the probed region with values from the region's mesh
+        region = ZMesh(params)
+        try:
+            region.build_mesh(probed_matrix)
+        except BedMeshError as e:
+            raise self.gcode.error(str(e))
+        profile = self.bedmesh.pmgr.get_profiles()[self.adaptive_profile]
+        base_params = collections.OrderedDict(profile['mesh_params'])
+        matrix = [list(row) for row in profile['points']]
+        x_cnt = base_params['x_count']
+        y_cnt = base_params['y_count']
+        x_dist = (base_params['max_x'] - base_params['min_x']) / (x_cnt - 1)
+        y_dist = (base_params['max_y'] - base_params['min_y']) / (y_cnt - 1)
+        updates = []
+        for j in range(y_cnt):
+            y = base_params['min_y'] + j * y_dist
+            if not params['min_y'] - 1. <= y <= params['max_y'] + 1.:
+                continue
+            for i in range(x_cnt):
+                x = base_params['min_x'] + i * x_dist
+                if params['min_x'] - 1. <= x <= params['max_x'] + 1.:
+                    updates.append((j, i, region.calc_z(x, y)))
+        if not updates:
+            raise self.gcode.error(
+                "bed_mesh: adaptive region contains no profile points")
+        offset = 0.
+        if self.adaptive_align:
+            # Keep the profile's relative reference
+            offset = sum([matrix[j][i] - z for j, i, z in updates])
+            offset /= len(updates)
+        for j, i, z in updates:
+            matrix[j][i] = z + offset
+        self.gcode.respond_info(
+            "bed_mesh: updated %d of %d points in profile [%s]"
+            % (len(updates), x_cnt * y_cnt, self.adaptive_profile))
+        return matrix, base_params
+
 
+# Minimum number of checkpoints in a move for using numpy to
+# calculate their z adjustments
+SPLIT_NUMPY_COUNT = 24
 
 class MoveSplitter:
     def __init__(self, config, gcode):
@@ -544,8 +721,11 @@ class MoveSplitter:
             'move_check_distance', 5., minval=3.)
         self.z_mesh = None
         self.gcode = gcode
+        self.last_calc = (None, None, 0.)
+        self.np = None
     def initialize(self, mesh):
         self.z_mesh = mesh
+        self.last_calc = (None, None, 0.)
     def build_move(self, prev_pos, next_pos, factor):
         self.prev_pos = tuple(prev_pos)
         self.next_pos = tuple(next_pos)
@@ -553,13 +733,65 @@ class MoveSplitter:
         self.z_factor = factor
         self.z_offset = self._calc_z_offset(prev_pos)
         self.traverse_complete = False
-        self.distance_checked = 0.
         axes_d = [self.next_pos[i] - self.prev_pos[i] for i in range(4)]
         self.total_move_length = math.sqrt(sum([d*d for d in axes_d[:3]]))
         self.axis_move = [not isclose(d, 0., abs_tol=1e-10) for d in axes_d]
+        self._calc_checkpoints()
     def _calc_z_offset(self, pos):
-        z = self.z_mesh.calc_z(pos[0], pos[1])
+        # The end of a move is usually the start of the next move, so
+        # the last calculated z adjustment is cached
+        x, y, z = self.last_calc
+        if pos[0] != x or pos[1] != y:
+            x, y = pos[0], pos[1]
+            z = self.z_mesh.calc_z(x, y)
+            self.last_calc = (x, y, z)
         return self.z_factor * z + self.z_mesh.mesh_offset
+    def _calc_checkpoints(self):
+        # Determine the z adjustment at each checkpoint along the move
+        self.checkpoint_index = 0
+        self.checkpoint_dists = dists = []
+        self.checkpoint_z = []
+        if not self.axis_move[0] and not self.axis_move[1]:
+            return
+        total = self.total_move_length
+        mcd = self.move_check_distance
+        distance_checked = 0.
+        while distance_checked + mcd < total:
+            distance_checked += mcd
+            dists.append(distance_checked)
+        if not dists:
+            return
+        prev_pos, next_pos = self.prev_pos, self.next_pos
+        z_factor, mesh_offset = self.z_factor, self.z_mesh.mesh_offset
+        if len(dists) >= SPLIT_NUMPY_COUNT and self._get_numpy() is not None:
+            np = self.np
+            t = np.array(dists) / total
+            pos = []
+            for i in range(2):
+                if self.axis_move[i]:
+                    pos.append((1. - t) * prev_pos[i] + t * next_pos[i])
+                else:
+                    pos.append(np.full(len(dists), prev_pos[i]))
+            z = self.z_mesh.calc_z_array(np, pos[0], pos[1])
+            self.checkpoint_z = (z_factor * z + mesh_offset).tolist()
+            return
+        calc_z = self.z_mesh.calc_z
+        x, y = prev_pos[0], prev_pos[1]
+        move_x, move_y = self.axis_move[0], self.axis_move[1]
+        for d in dists:
+            t = d / total
+            if move_x:
+                x = lerp(t, prev_pos[0], next_pos[0])
+            if move_y:
+                y = lerp(t, prev_pos[1], next_pos[1])
+            self.checkpoint_z.append(z_factor * calc_z(x, y) + mesh_offset)
+    def _get_numpy(self):
+        if self.np is None:
+            try:
+                self.np = importlib.import_module('numpy')
+            except ImportError:
+                self.np = False
+        return self.np or None
     def _set_next_move(self, distance_from_prev):
         t = distance_from_prev / self.total_move_length
         if t > 1. or t < 0.:
@@ -572,18 +804,17 @@ class MoveSplitter:
                     t, self.prev_pos[i], self.next_pos[i])
     def split(self):
         if not self.traverse_complete:
-            if self.axis_move[0] or self.axis_move[1]:
-                # X and/or Y axis move, traverse if necessary
-                while self.distance_checked + self.move_check_distance \
-                        < self.total_move_length:
-                    self.distance_checked += self.move_check_distance
-                    self._set_next_move(self.distance_checked)
-                    next_z = self._calc_z_offset(self.current_pos)
-                    if abs(next_z - self.z_offset) >= self.split_delta_z:
-                        self.z_offset = next_z
-                        return self.current_pos[0], self.current_pos[1], \
-                            self.current_pos[2] + self.z_offset, \
-                            self.current_pos[3]
+            checkpoint_z = self.checkpoint_z
+            while self.checkpoint_index < len(checkpoint_z):
+                i = self.checkpoint_index
+                self.checkpoint_index += 1
+                next_z = checkpoint_z[i]
+                if abs(next_z - self.z_offset) >= self.split_delta_z:
+                    self.z_offset = next_z
+                    self._set_next_move(self.checkpoint_dists[i])
+                    return self.current_pos[0], self.current_pos[1], \
+                        self.current_pos[2] + self.z_offset, \
+                        self.current_pos[3]
             # end of move reached
             self.current_pos[:] = self.next_pos
             self.z_offset = self._calc_z_offset(self.current_pos)
@@ -603,6 +834,7 @@ class ZMesh:
         self.mesh_params = params
         self.avg_z = 0.
         self.mesh_offset = 0.
+        self.z_lookup = self.np_lookup = None
         logging.debug('bed_mesh: probe/mesh parameters:')
         for key, value in self.mesh_params.items():
             logging.debug("%s :  %s" % (key, value))
@@ -679,13 +911,14 @@ class ZMesh:
             print_func("bed_mesh: Z Mesh not generated")
     def build_mesh(self, z_matrix):
         self.probed_matrix = z_matrix
-        self._sample(z_matrix)
+        self.sample(z_matrix)
         self.avg_z = (sum([sum(x) for x in self.mesh_matrix]) /
                       sum([len(x) for x in self.mesh_matrix]))
         # Round average to the nearest 100th.  This
         # should produce an offset that is divisible by common
         # z step distances
         self.avg_z = round(self.avg_z, 2)
+        self._build_lookup_table()
         self.print_mesh(logging.debug)
     def offset_mesh(self, offset):
         if self.mesh_matrix:
@@ -693,21 +926,43 @@ class ZMesh:
             for y_line in self.mesh_matrix:
                 for idx, z in enumerate(y_line):
                     y_line[idx] = z - self.mesh_offset
+            self._build_lookup_table()
+    def _build_lookup_table(self):
+        # Store the four corner heights of each mesh cell in a flat list
+        # so that calc_z() only needs a single table lookup
+        tbl = self.mesh_matrix
+        self.z_lookup = [(tbl[y][x], tbl[y][x+1], tbl[y+1][x], tbl[y+1][x+1])
+                         for y in range(self.mesh_y_count - 1)
+                         for x in range(self.mesh_x_count - 1)]
+        self.np_lookup = None
     def get_x_coordinate(self, index):
         return self.mesh_x_min + self.mesh_x_dist * index
     def get_y_coordinate(self, index):
         return self.mesh_y_min + self.mesh_y_dist * index
     def calc_z(self, x, y):
-        if self.mesh_matrix is not None:
-            tbl = self.mesh_matrix
+        if self.z_lookup is not None:
             tx, xidx = self._get_linear_index(x, 0)
             ty, yidx = self._get_linear_index(y, 1)
-            z0 = lerp(tx, tbl[yidx][xidx], tbl[yidx][xidx+1])
-            z1 = lerp(tx, tbl[yidx+1][xidx], tbl[yidx+1][xidx+1])
+            z00, z01, z10, z11 = self.z_lookup[
+                yidx * (self.mesh_x_count - 1) + xidx]
+            z0 = lerp(tx, z00, z01)
+            z1 = lerp(tx, z10, z11)
             return lerp(ty, z0, z1)
         else:
             # No mesh table generated, no z-adjustment
             return 0.
+    def calc_z_array(self, np, x, y):
+        # Version of calc_z() for numpy arrays of coordinates
+        if self.z_lookup is None:
+            return np.zeros(len(x))
+        if self.np_lookup is None:
+            self.np_lookup = np.array(self.z_lookup)
+        tx, xidx = self._get_linear_index_array(np, x, 0)
+        ty, yidx = self._get_linear_index_array(np, y, 1)
+        cells = self.np_lookup[yidx * (self.mesh_x_count - 1) + xidx]
+        z0 = (1. - tx) * cells[:,0] + tx * cells[:,1]
+        z1 = (1. - tx) * cells[:,2] + tx * cells[:,3]
+        return (1. - ty) * z0 + ty * z1
     def get_z_range(self):
         if self.mesh_matrix is not None:
             mesh_min = min([min(x) for x in self.mesh_matrix])
@@ -721,18 +976,116 @@ class ZMesh:
             mesh_min = self.mesh_x_min
             mesh_cnt = self.mesh_x_count
             mesh_dist = self.mesh_x_dist
-            cfunc = self.get_x_coordinate
         else:
             # Y-axis
             mesh_min = self.mesh_y_min
             mesh_cnt = self.mesh_y_count
             mesh_dist = self.mesh_y_dist
-            cfunc = self.get_y_coordinate
-        t = 0.
         idx = int(math.floor((coord - mesh_min) / mesh_dist))
-        idx = constrain(idx, 0, mesh_cnt - 2)
-        t = (coord - cfunc(idx)) / mesh_dist
-        return constrain(t, 0., 1.), idx
+        idx = min(mesh_cnt - 2, max(0, idx))
+        t = (coord - (mesh_min + mesh_dist * idx)) / mesh_dist
+        return min(1., max(0., t)), idx
+    def _get_linear_index_array(self, np, coords, axis):
+        if axis == 0:
+            mesh_min = self.mesh_x_min
+            mesh_cnt = self.mesh_x_count
+            mesh_dist = self.mesh_x_dist
+        else:
+            mesh_min = self.mesh_y_min
+            mesh_cnt = self.mesh_y_count
+            mesh_dist = self.mesh_y_dist
+        idx = np.floor((coords - mesh_min) / mesh_dist).astype(int)
+        idx = np.clip(idx, 0, mesh_cnt - 2)
+        t = (coords - (mesh_min + mesh_dist * idx)) / mesh_dist
+        return np.clip(t, 0., 1.), idx
+    def sample(self, z_matrix):
+        # Generate the mesh_matrix from the probed points
+        if self.mesh_params['algo'] != 'direct':
+            try:
+                np = importlib.import_module('numpy')
+            except ImportError:
+                np = None
+            if np is not None:
+                self._sample_array(np, z_matrix)
+                return
+        self._sample(z_matrix)
+    def _sample_array(self, np, z_matrix):
+        # Version of _sample_lagrange() and _sample_bicubic() using
+        # array operations.  The calculations are done in the same
+        # order so that the results are identical.
+        if self.mesh_params['algo'] == 'lagrange':
+            calc_axis = self._calc_lagrange_array
+        else:
+            calc_axis = self._calc_bicubic_array
+        # Interpolate X on the probed rows and then Y on all columns
+        x_rows = calc_axis(np, np.array(z_matrix, dtype=float), 0)
+        y_cols = calc_axis(np, x_rows.T, 1)
+        self.mesh_matrix = y_cols.T.tolist()
+    def _get_axis_info(self, axis):
+        if axis == 0:
+            return self.x_mult, self.mesh_x_count, self.get_x_coordinate
+        return self.y_mult, self.mesh_y_count, self.get_y_coordinate
+    def _calc_lagrange_array(self, np, pts, axis):
+        # Interpolate each row of 'pts' to a full row of the mesh
+        mult, count, get_coord = self._get_axis_info(axis)
+        if mult == 1:
+            return pts
+        lpts = self._get_lagrange_coords()[axis]
+        idx = [k for k in range(count) if k % mult]
+        c = np.array([get_coord(k) for k in idx])
+        total = np.zeros((len(pts), len(idx)))
+        pt_cnt = len(lpts)
+        for i in range(pt_cnt):
+            n = np.ones(len(idx))
+            d = 1.
+            for j in range(pt_cnt):
+                if j == i:
+                    continue
+                n *= (c - lpts[j])
+                d *= (lpts[i] - lpts[j])
+            total += pts[:, i:i+1] * n / d
+        out = np.empty((len(pts), count))
+        out[:, ::mult] = pts
+        out[:, idx] = total
+        return out
+    def _calc_bicubic_array(self, np, pts, axis):
+        # Interpolate each row of 'pts' to a full row of the mesh
+        mult, count = self._get_axis_info(axis)[:2]
+        if mult == 1:
+            return pts
+        last_pt = count - 1 - mult
+        idx = []
+        ctl_idx = []
+        t = []
+        for k in range(count):
+            if not k % mult:
+                continue
+            # Same control points as _get_x_ctl_pts()/_get_y_ctl_pts()
+            p = k // mult
+            if k < mult:
+                ctl_idx.append((0, 0, 1, 2))
+            elif k > last_pt:
+                ctl_idx.append((p - 1, p, p + 1, p + 1))
+            else:
+                ctl_idx.append((p - 1, p, p + 1, p + 2))
+            idx.append(k)
+            t.append((k - p * mult) / float(mult))
+        ctl_idx = np.array(ctl_idx)
+        p0, p1, p2, p3 = [pts[:, ctl_idx[:, j]] for j in range(4)]
+        t = np.array(t)
+        tension = self.mesh_params['tension']
+        t2 = t*t
+        t3 = t2*t
+        m1 = tension * (p2 - p0)
+        m2 = tension * (p3 - p1)
+        a = p1 * (2*t3 - 3*t2 + 1)
+        b = p2 * (-2*t3 + 3*t2)
+        c = m1 * (t3 - 2*t2 + t)
+        d = m2 * (t3 - t2)
+        out = np.empty((len(pts), count))
+        out[:, ::mult] = pts
+        out[:, idx] = a + b + c + d
+        return out
     def _sample_direct(self, z_matrix):
         self.mesh_matrix = z_matrix
     def _sample_lagrange(self, z_matrix):
@@ -886,7 +1239,6 @@ class ZMesh:
         d = m2 * (t3 - t2)
         return a + b + c + d
 
-
 class ProfileManager:
     def __init__(self, config, bedmesh):
         self.name = config.get_name()
@@ -934,6 +1286,8 @@ class ProfileManager:
             self.load_profile("default")
     def get_current_profile(self):
         return self.current_profile
+    def get_profiles(self):
+        return self.profiles
     def _check_incompatible_profiles(self):
         if self.incompatible_profiles:
             configfile = self.printer.lookup_object('configfile')
@@ -972,6 +1326,7 @@ class ProfileManager:
         profile['points'] = probed_matrix
         profile['mesh_params'] = collections.OrderedDict(mesh_params)
         self.current_profile = prof_name
+        self.bedmesh.mark_status_dirty(['profile_name'])
         self.gcode.respond_info(
             "Bed Mesh state has been saved to profile [%s]\n"
             "for the current session.  The SAVE_CONFIG command will\n"
@@ -82,6 +82,35 @@ def measurements_to_distances(measured_params, delta_params):
 # Delta Calibrate class
 ######################################################################
 
+# Error function for coordinate descent (run in a background process)
+class DeltaErrorFunc:
+    def __init__(self, orig_delta_params, height_positions, distances,
+                 z_weight):
+        self.orig_delta_params = orig_delta_params
+        self.height_positions = height_positions
+        self.distances = distances
+        self.z_weight = z_weight
+    def __call__(self, params):
+        try:
+            # Build new delta_params for params under test
+            delta_params = self.orig_delta_params.new_calibration(params)
+            getpos = delta_params.get_position_from_stable
+            # Calculate z height errors
+            total_error = 0.
+            for z_offset, stable_pos in self.height_positions:
+                x, y, z = getpos(stable_pos)
+                total_error += (z - z_offset)**2
+            total_error *= self.z_weight
+            # Calculate distance errors
+            for dist, stable_pos1, stable_pos2 in self.distances:
+                x1, y1, z1 = getpos(stable_pos1)
+                x2, y2, z2 = getpos(stable_pos2)
+                d = math.sqrt((x1-x2)**2 + (y1-y2)**2 + (z1-z2)**2)
+                total_error += (d - dist)**2
+            return total_error
+        except ValueError:
+            return 9999999999999.9
+
 class DeltaCalibrate:
     def __init__(self, config):
         self.printer = config.get_printer()
@@ -181,26 +210,8 @@ class DeltaCalibrate:
         if distances:
             z_weight = len(distances) / (MEASURE_WEIGHT * len(probe_positions))
         # Perform coordinate descent
-        def delta_errorfunc(params):
-            try:
-                # Build new delta_params for params under test
-                delta_params = orig_delta_params.new_calibration(params)
-                getpos = delta_params.get_position_from_stable
-                # Calculate z height errors
-                total_error = 0.
-                for z_offset, stable_pos in height_positions:
-                    x, y, z = getpos(stable_pos)
-                    total_error += (z - z_offset)**2
-                total_error *= z_weight
-                # Calculate distance errors
-                for dist, stable_pos1, stable_pos2 in distances:
-                    x1, y1, z1 = getpos(stable_pos1)
-                    x2, y2, z2 = getpos(stable_pos2)
-                    d = math.sqrt((x1-x2)**2 + (y1-y2)**2 + (z1-z2)**2)
-                    total_error += (d - dist)**2
-                return total_error
-            except ValueError:
-                return 9999999999999.9
+        delta_errorfunc = DeltaErrorFunc(orig_delta_params, height_positions,
+                                         distances, z_weight)
         new_params = mathutil.background_coordinate_descent(
             self.printer, adj_params, params, delta_errorfunc)
         # Log and report results
@@ -75,6 +75,8 @@ class DisplayGroup:
         context['draw_progress_bar'] = display.draw_progress_bar
         def render(name, **kwargs):
             return templates[name].render(context, **kwargs)
+        # Output of nested templates is tracked by gcode_macro
+        render.template_cacheable = True
         context['render'] = render
         for row, col, template in self.data_items:
             text = template.render(context)
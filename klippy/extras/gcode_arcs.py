@@ -8,7 +8,8 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import math
 
-# Coordinates created by this are converted into G1 commands.
+# Coordinates created by this are queued as G1 moves (without creating
+# a G1 command for each segment).
 #
 # note: only IJ version available
 
@@ -16,6 +17,7 @@ class ArcSupport:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.mm_per_arc_segment = config.getfloat('resolution', 1., above=0.0)
+        self.tolerance = config.getfloat('tolerance', None, above=0.0)
 
         self.gcode_move = self.printer.load_object(config, 'gcode_move')
         self.gcode = self.printer.lookup_object('gcode')
@@ -51,23 +53,25 @@ class ArcSupport:
                 e_base = currentPos[3]
             e_per_move = (asE - e_base) / len(coords)
 
-        # Convert coords into G1 commands
+        # Queue the coords as G1 moves
+        commandline = gcmd.get_commandline()
+        fast_G1 = self.gcode_move.fast_G1
+        absolute_extrude = gcodestatus['absolute_extrude']
         for coord in coords:
-            g1_params = {'X': coord[0], 'Y': coord[1], 'Z': coord[2]}
+            e = None
             if e_per_move:
-                g1_params['E'] = e_base + e_per_move
-                if gcodestatus['absolute_extrude']:
+                e = e_base + e_per_move
+                if absolute_extrude:
                     e_base += e_per_move
-            if asF is not None:
-                g1_params['F'] = asF
-            g1_gcmd = self.gcode.create_gcode_command("G1", "G1", g1_params)
-            self.gcode_move.cmd_G1(g1_gcmd)
+            fast_G1(commandline, [coord[0], coord[1], coord[2], e, asF])
 
     # function planArc() originates from marlin plan_arc()
     # https://github.com/MarlinFirmware/Marlin
     #
     # The arc is approximated by generating many small linear segments.
-    # The length of each segment is configured in MM_PER_ARC_SEGMENT
+    # The length of each segment is configured in MM_PER_ARC_SEGMENT,
+    # or is derived from the chord error tolerance (if set) with
+    # MM_PER_ARC_SEGMENT as the minimum length.
     # Arcs smaller then this value, will be a Line only
     def planArc(self, currentPos, targetPos, offset, clockwise):
         # todo: sometimes produces full circles
@@ -107,20 +111,23 @@ class ArcSupport:
         else:
             mm_of_travel = math.fabs(flat_mm)
         segments = max(1., math.floor(mm_of_travel / self.mm_per_arc_segment))
+        if self.tolerance is not None and radius > self.tolerance:
+            # Use the longest segments within the tolerance of the arc
+            max_theta = 2. * math.acos(1. - self.tolerance / radius)
+            segments = min(segments, max(
+                1., math.ceil(math.fabs(angular_travel) / max_theta)))
 
-        # Generate coordinates
+        # Generate coordinates (by rotating the radius vector)
         theta_per_segment = angular_travel / segments
         linear_per_segment = linear_travel / segments
+        cos_T = math.cos(theta_per_segment)
+        sin_T = math.sin(theta_per_segment)
+        start_Z = currentPos[Z_AXIS]
         coords = []
         for i in range(1, int(segments)):
-            dist_Z = i * linear_per_segment
-            cos_Ti = math.cos(i * theta_per_segment)
-            sin_Ti = math.sin(i * theta_per_segment)
-            r_P = -offset[0] * cos_Ti + offset[1] * sin_Ti
-            r_Q = -offset[0] * sin_Ti - offset[1] * cos_Ti
-
-            c = [center_P + r_P, center_Q + r_Q, currentPos[Z_AXIS] + dist_Z]
-            coords.append(c)
+            r_P, r_Q = r_P * cos_T - r_Q * sin_T, r_P * sin_T + r_Q * cos_T
+            coords.append([center_P + r_P, center_Q + r_Q,
+                           start_Z + i * linear_per_segment])
 
         coords.append(targetPos)
         return coords
@@ -4,29 +4,220 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import traceback, logging, ast, copy
-import jinja2
+import jinja2, jinja2.meta, jinja2.nodes
 
 
 ######################################################################
 # Template handling
 ######################################################################
 
+# Read-only copies of get_status() results.  Containers are copied
+# (shallowly) with their nested containers replaced by read-only
+# copies, which avoids the cost of a deep copy of the contained values
+# while still preventing templates from modifying printer object state.
+def _freeze(val):
+    if isinstance(val, dict) and not isinstance(val, FrozenDict):
+        return FrozenDict(val)
+    if isinstance(val, list) and not isinstance(val, FrozenList):
+        return FrozenList(val)
+    return val
+
+def _has_containers(vals):
+    # Check the value types first, as most status values are scalars
+    return [t for t in set(map(type, vals)) if issubclass(t, (dict, list))]
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError("Printer status is read-only")
+
+# Copies made with dict(), list(), copy(), or "+" are modifiable, but
+# their contents remain read-only.
+class FrozenDict(dict):
+    def __init__(self, status=()):
+        dict.__init__(self, status)
+        if (not isinstance(status, FrozenDict)
+            and _has_containers(dict.values(self))):
+            for key, val in dict.items(self):
+                dict.__setitem__(self, key, _freeze(val))
+    def copy(self):
+        return dict(self)
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+    __setitem__ = __delitem__ = clear = pop = popitem = _read_only
+    setdefault = update = _read_only
+
+class FrozenList(list):
+    def __init__(self, vals=()):
+        list.__init__(self, vals)
+        if not isinstance(vals, FrozenList) and _has_containers(self):
+            list.__init__(self, [_freeze(v) for v in list.__iter__(self)])
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(list(self), memo)
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    __setslice__ = __delslice__ = _read_only
+    append = extend = insert = pop = remove = reverse = sort = _read_only
+
+# Record of the printer status read while rendering a template
+class StatusTracker:
+    # Kinds of status reads - the value at a path or the presence of a key
+    VALUE, CONTAINS = 'value', 'contains'
+    def __init__(self):
+        # {object_name: {(path, kind): value}} (or None for a missing object)
+        self.deps = {}
+        self.cacheable = True
+    def note_object(self, name, exists):
+        if not exists:
+            self.deps.setdefault(name, None)
+        elif self.deps.get(name) is None:
+            self.deps[name] = {}
+    def note_field(self, name, key, value):
+        fields = self.deps.get(name)
+        if fields is None:
+            fields = self.deps[name] = {}
+        if key not in fields:
+            fields[key] = value
+    def merge(self, other):
+        for name, fields in other.deps.items():
+            self.note_object(name, fields is not None)
+            if fields is not None:
+                for key, value in fields.items():
+                    self.note_field(name, key, value)
+    def check(self, status):
+        # Return True if none of the recorded status has changed
+        for name, fields in self.deps.items():
+            snapshot = status.lookup_snapshot(name)
+            if snapshot is None or fields is None:
+                if snapshot is not None or fields is not None:
+                    return False
+                continue
+            for (path, kind), value in fields.items():
+                cur = _lookup_path(snapshot, path)
+                if kind == self.CONTAINS:
+                    cur = cur is not _missing
+                if cur != value:
+                    return False
+        return True
+
+class _missing:
+    pass
+
+def _lookup_path(snapshot, path):
+    if not path:
+        return dict(dict.items(snapshot))
+    val = snapshot
+    for key in path:
+        if not isinstance(val, dict):
+            return _missing
+        val = dict.get(val, key, _missing)
+    return val
+
+# get_status() result that reports reads to StatusTrackers.  Reads are
+# recorded by their path within the status, so that checking a cached
+# render only compares the values that were actually used.  Reading a
+# list, or iterating over a dictionary, records a copy of its contents.
+class StatusSnapshot(FrozenDict):
+    def __init__(self, name, status, trackers, path=()):
+        FrozenDict.__init__(self, status)
+        self._status_name = name
+        self._status_path = path
+        self._trackers = trackers
+    def _note(self, path, kind, value):
+        name = self._status_name
+        key = (path, kind)
+        trackers = [t for t in self._trackers
+                    if key not in (t.deps.get(name) or ())]
+        if trackers:
+            if isinstance(value, (dict, list)):
+                value = copy.deepcopy(value)
+            for tracker in trackers:
+                tracker.note_field(name, key, value)
+    def _note_all(self):
+        if self._trackers:
+            self._note(self._status_path, StatusTracker.VALUE,
+                       dict(dict.items(self)))
+    def __getitem__(self, key):
+        val = dict.get(self, key, _missing)
+        path = self._status_path + (key,)
+        if isinstance(val, dict):
+            return StatusSnapshot(self._status_name, val, self._trackers, path)
+        if self._trackers:
+            self._note(path, StatusTracker.VALUE, val)
+        return dict.__getitem__(self, key)
+    def __contains__(self, key):
+        res = dict.__contains__(self, key)
+        if self._trackers:
+            self._note(self._status_path + (key,), StatusTracker.CONTAINS, res)
+        return res
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+    def __iter__(self):
+        self._note_all()
+        return dict.__iter__(self)
+    def __len__(self):
+        self._note_all()
+        return dict.__len__(self)
+    def __eq__(self, other):
+        self._note_all()
+        return dict.__eq__(self, other)
+    def __ne__(self, other):
+        self._note_all()
+        return dict.__ne__(self, other)
+    def __repr__(self):
+        self._note_all()
+        return dict.__repr__(self)
+    __str__ = __repr__
+    def keys(self):
+        self._note_all()
+        return dict.keys(self)
+    def items(self):
+        self._note_all()
+        return dict.items(self)
+    def values(self):
+        self._note_all()
+        return dict.values(self)
+    def iterkeys(self):
+        return iter(self.keys())
+    def iteritems(self):
+        return iter(self.items())
+    def itervalues(self):
+        return iter(self.values())
+    def copy(self):
+        self._note_all()
+        return FrozenDict.copy(self)
+
 # Wrapper for access to printer object get_status() methods
 class GetStatusWrapper:
-    def __init__(self, printer, eventtime=None):
+    def __init__(self, printer, eventtime=None, cache=None, trackers=None):
         self.printer = printer
         self.eventtime = eventtime
-        self.cache = {}
-    def __getitem__(self, val):
-        sval = str(val).strip()
+        if cache is None:
+            cache = {}
+        self.cache = cache
+        self.trackers = trackers
+    def lookup_snapshot(self, sval):
         if sval in self.cache:
             return self.cache[sval]
         po = self.printer.lookup_object(sval, None)
         if po is None or not hasattr(po, 'get_status'):
-            raise KeyError(val)
+            return None
         if self.eventtime is None:
             self.eventtime = self.printer.get_reactor().monotonic()
-        self.cache[sval] = res = copy.deepcopy(po.get_status(self.eventtime))
+        status = po.get_status(self.eventtime)
+        if self.trackers is None:
+            res = FrozenDict(status)
+        else:
+            res = StatusSnapshot(sval, status, self.trackers)
+        self.cache[sval] = res
+        return res
+    def __getitem__(self, val):
+        sval = str(val).strip()
+        res = self.lookup_snapshot(sval)
+        if self.trackers:
+            for tracker in self.trackers:
+                tracker.note_object(sval, res is not None)
+        if res is None:
+            raise KeyError(val)
         return res
     def __contains__(self, val):
         try:
@@ -35,10 +226,35 @@ class GetStatusWrapper:
             return False
         return True
     def __iter__(self):
+        if self.trackers:
+            for tracker in self.trackers:
+                tracker.cacheable = False
         for name, obj in self.printer.lookup_objects():
             if self.__contains__(name):
                 yield name
 
+# Find the context variables that a template only reads fields from
+# (eg, "menu.input"), returning {name: set_of_fields} for them
+def _find_context_attrs(parsed, names):
+    loads = {}
+    for node in parsed.find_all(jinja2.nodes.Name):
+        if node.ctx == 'load' and node.name in names:
+            loads[node.name] = loads.get(node.name, 0) + 1
+    attrs = {}
+    for node in parsed.find_all((jinja2.nodes.Getattr, jinja2.nodes.Getitem)):
+        if (not isinstance(node.node, jinja2.nodes.Name)
+            or node.node.name not in names):
+            continue
+        if isinstance(node, jinja2.nodes.Getattr):
+            attr = node.attr
+        elif isinstance(node.arg, jinja2.nodes.Const):
+            attr = node.arg.value
+        else:
+            continue
+        attrs.setdefault(node.node.name, []).append(attr)
+    return {name: set(fields) for name, fields in attrs.items()
+            if len(fields) == loads.get(name)}
+
 # Wrapper around a Jinja2 template
 class TemplateWrapper:
     def __init__(self, printer, env, name, script):
@@ -47,16 +263,21 @@ class TemplateWrapper:
         self.gcode = self.printer.lookup_object('gcode')
         gcode_macro = self.printer.lookup_object('gcode_macro')
         self.create_template_context = gcode_macro.create_template_context
+        self.note_render = gcode_macro.note_render
         try:
             self.template = env.from_string(script)
+            parsed = env.parse(script)
+            self.context_names = jinja2.meta.find_undeclared_variables(parsed)
         except Exception as e:
             msg = "Error loading template '%s': %s" % (
                  name, traceback.format_exception_only(type(e), e)[-1])
             logging.exception(msg)
             raise printer.config_error(msg)
-    def render(self, context=None):
-        if context is None:
-            context = self.create_template_context()
+        self.context_names.discard('printer')
+        self.context_attrs = _find_context_attrs(parsed, self.context_names)
+        # Last result (tracker, inputs, output) for dependency tracking
+        self.last_render = None
+    def _render(self, context):
         try:
             return str(self.template.render(context))
         except Exception as e:
@@ -64,6 +285,58 @@ class TemplateWrapper:
                 self.name, traceback.format_exception_only(type(e), e)[-1])
             logging.exception(msg)
             raise self.gcode.error(msg)
+    def _get_inputs(self, context):
+        # Return the context values (other than printer status) used by
+        # the template, or None if it calls functions with side effects
+        inputs = {}
+        for name in self.context_names:
+            val = context.get(name)
+            attrs = self.context_attrs.get(name)
+            if attrs is not None and isinstance(val, dict):
+                # Only the fields the template reads are inputs
+                val = {attr: val.get(attr, _missing) for attr in attrs}
+            if callable(val):
+                if not getattr(val, 'template_cacheable', False):
+                    return None
+                continue
+            elif isinstance(val, dict):
+                if [v for v in val.values() if callable(v)]:
+                    return None
+                val = dict(val)
+            elif isinstance(val, list):
+                val = list(val)
+            inputs[name] = val
+        return inputs
+    def render(self, context=None):
+        if context is None:
+            context = self.create_template_context()
+        status = context.get('printer')
+        if not isinstance(status, GetStatusWrapper) or status.trackers is None:
+            return self._render(context)
+        # Reuse the last output if none of its inputs have changed
+        trackers = status.trackers
+        inputs = self._get_inputs(context)
+        last_render = self.last_render
+        if (inputs is not None and last_render is not None
+            and last_render[1] == inputs and last_render[0].check(status)):
+            for tracker in trackers:
+                tracker.merge(last_render[0])
+            self.note_render(True)
+            return last_render[2]
+        self.note_render(False)
+        self.last_render = None
+        tracker = StatusTracker()
+        trackers.append(tracker)
+        try:
+            output = self._render(context)
+        finally:
+            trackers.pop()
+        if inputs is not None and tracker.cacheable:
+            self.last_render = (tracker, inputs, output)
+        else:
+            for t in trackers:
+                t.cacheable = False
+        return output
     def run_gcode_from_command(self, context=None):
         self.gcode.run_script_from_command(self.render(context))
 
@@ -72,6 +345,11 @@ class PrinterGCodeMacro:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.env = jinja2.Environment('{%', '%}', '{', '}')
+        # Status snapshots shared by all renders with the same eventtime
+        self.status_cache = {}
+        self.status_cache_time = None
+        self.status_trackers = []
+        self.render_hits = self.render_misses = 0
     def load_template(self, config, option, default=None):
         name = "%s:%s" % (config.get_name(), option)
         if default is None:
@@ -79,6 +357,15 @@ class PrinterGCodeMacro:
         else:
             script = config.get(option, default)
         return TemplateWrapper(self.printer, self.env, name, script)
+    def note_render(self, is_hit):
+        if is_hit:
+            self.render_hits += 1
+        else:
+            self.render_misses += 1
+    def stats(self, eventtime):
+        renders = self.render_hits + self.render_misses
+        return False, "template_renders=%d template_hit_ratio=%.3f" % (
+            renders, self.render_hits / max(1., float(renders)))
     def _action_emergency_stop(self, msg="action_emergency_stop"):
         self.printer.invoke_shutdown("Shutdown due to %s" % (msg,))
         return ""
@@ -95,8 +382,16 @@ class PrinterGCodeMacro:
             logging.exception("Remote Call Error")
         return ""
     def create_template_context(self, eventtime=None):
+        cache = trackers = None
+        if eventtime is not None:
+            if eventtime != self.status_cache_time:
+                self.status_cache = {}
+                self.status_cache_time = eventtime
+            cache = self.status_cache
+            trackers = self.status_trackers
         return {
-            'printer': GetStatusWrapper(self.printer, eventtime),
+            'printer': GetStatusWrapper(self.printer, eventtime, cache,
+                                        trackers),
             'action_emergency_stop': self._action_emergency_stop,
             'action_respond_info': self._action_respond_info,
             'action_raise_error': self._action_raise_error,
@@ -135,6 +430,9 @@ class GCodeMacro:
                                         name, self.cmd_SET_GCODE_VARIABLE,
                                         desc=self.cmd_SET_GCODE_VARIABLE_help)
         self.in_script = False
+        self.status_name = config.get_name()
+        self.webhooks = printer.lookup_object('webhooks')
+        self.webhooks.register_status_tracking(self.status_name)
         prefix = 'default_parameter_'
         self.kwparams = { o[len(prefix):].upper(): config.get(o)
                           for o in config.get_prefix_options(prefix) }
@@ -172,7 +470,10 @@ class GCodeMacro:
             literal = ast.literal_eval(value)
         except ValueError as e:
             raise gcmd.error("Unable to parse '%s' as a literal" % (value,))
-        self.variables[variable] = literal
+        variables = dict(self.variables)
+        variables[variable] = literal
+        self.variables = variables
+        self.webhooks.mark_status_dirty(self.status_name, [variable])
     cmd_desc = "G-Code macro"
     def cmd(self, gcmd):
         if self.in_script:
@@ -33,6 +33,8 @@ class GCodeMove:
             desc = getattr(self, 'cmd_' + cmd + '_help', None)
             gcode.register_command(cmd, func, False, desc)
         gcode.register_command('G0', self.cmd_G1)
+        gcode.register_fast_move('G0', self.cmd_G1, self.fast_G1)
+        gcode.register_fast_move('G1', self.cmd_G1, self.fast_G1)
         gcode.register_command('M114', self.cmd_M114, True)
         gcode.register_command('GET_POSITION', self.cmd_GET_POSITION, True)
         self.Coord = gcode.Coord
@@ -112,32 +114,38 @@ class GCodeMove:
         # Move
         params = gcmd.get_command_parameters()
         try:
-            for pos, axis in enumerate('XYZ'):
-                if axis in params:
-                    v = float(params[axis])
-                    if not self.absolute_coord:
-                        # value relative to position of last move
-                        self.last_position[pos] += v
-                    else:
-                        # value relative to base coordinate position
-                        self.last_position[pos] = v + self.base_position[pos]
-            if 'E' in params:
-                v = float(params['E']) * self.extrude_factor
-                if not self.absolute_coord or not self.absolute_extrude:
-                    # value relative to position of last move
-                    self.last_position[3] += v
-                else:
-                    # value relative to base coordinate position
-                    self.last_position[3] = v + self.base_position[3]
-            if 'F' in params:
-                gcode_speed = float(params['F'])
-                if gcode_speed <= 0.:
-                    raise gcmd.error("Invalid speed in '%s'"
-                                     % (gcmd.get_commandline(),))
-                self.speed = gcode_speed * self.speed_factor
+            coords = [float(params[a]) if a in params else None
+                      for a in 'XYZEF']
         except ValueError as e:
             raise gcmd.error("Unable to parse move '%s'"
                              % (gcmd.get_commandline(),))
+        self.fast_G1(gcmd.get_commandline(), coords)
+    def fast_G1(self, commandline, coords):
+        # Move with pre-parsed [X, Y, Z, E, F] coordinates (None if unset)
+        for pos in range(3):
+            v = coords[pos]
+            if v is not None:
+                if not self.absolute_coord:
+                    # value relative to position of last move
+                    self.last_position[pos] += v
+                else:
+                    # value relative to base coordinate position
+                    self.last_position[pos] = v + self.base_position[pos]
+        v = coords[3]
+        if v is not None:
+            v *= self.extrude_factor
+            if not self.absolute_coord or not self.absolute_extrude:
+                # value relative to position of last move
+                self.last_position[3] += v
+            else:
+                # value relative to base coordinate position
+                self.last_position[3] = v + self.base_position[3]
+        gcode_speed = coords[4]
+        if gcode_speed is not None:
+            if gcode_speed <= 0.:
+                raise self.printer.command_error("Invalid speed in '%s'"
+                                                 % (commandline,))
+            self.speed = gcode_speed * self.speed_factor
         self.move_with_transform(self.last_position, self.speed)
     # G-Code coordinate manipulation
     def cmd_G20(self, gcmd):
@@ -0,0 +1,42 @@
+# Report run time statistics for reactor callbacks
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+class ReactorProfiler:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.profiler = self.printer.get_reactor().enable_profiling()
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint("reactor/profile",
+                                   self._handle_profile_request)
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_command("REACTOR_PROFILE", self.cmd_REACTOR_PROFILE,
+                               desc=self.cmd_REACTOR_PROFILE_help)
+    def _handle_profile_request(self, web_request):
+        reset = web_request.get('reset', False, types=(bool,))
+        web_request.send({
+            'histogram_bounds': self.profiler.get_histogram_bounds(),
+            'callbacks': self.profiler.get_profile()})
+        if reset:
+            self.profiler.reset()
+    cmd_REACTOR_PROFILE_help = "Report the slowest reactor callbacks"
+    def cmd_REACTOR_PROFILE(self, gcmd):
+        count = gcmd.get_int('COUNT', 10, minval=1)
+        profile = self.profiler.get_profile()
+        top = sorted(profile.items(), key=lambda i: -i[1]['max'])[:count]
+        msg = ["%s: count=%d avg=%.6f max=%.6f" % (
+            name, p['count'], p['total'] / p['count'], p['max'])
+               for name, p in top]
+        gcmd.respond_info("\n".join(["Reactor callbacks (slowest first):"]
+                                    + msg))
+        if gcmd.get_int('RESET', 0):
+            self.profiler.reset()
+    def stats(self, eventtime):
+        busy, (max_time, max_name) = self.profiler.pop_interval()
+        return False, "reactor_busy=%.3f reactor_max=%.6f(%s)" % (
+            busy, max_time, max_name)
+
+def load_config(config):
+    return ReactorProfiler(config)
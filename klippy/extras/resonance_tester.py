@@ -6,6 +6,8 @@
 import logging, math, os, time
 from . import shaper_calibrate
 
+STREAM_UPDATE_TIME = 1.
+
 def _parse_probe_points(config):
     points = config.get('probe_points').split('\n')
     try:
@@ -84,6 +86,7 @@ class ResonanceTester:
             if self.accel_chip_names[0][1] == self.accel_chip_names[1][1]:
                 self.accel_chip_names = [('xy', self.accel_chip_names[0][1])]
         self.max_smoothing = config.getfloat('max_smoothing', None, minval=0.05)
+        self.streaming = config.getboolean('streaming', False)
 
         self.gcode = self.printer.lookup_object('gcode')
         self.gcode.register_command("MEASURE_AXES_NOISE",
@@ -99,6 +102,43 @@ class ResonanceTester:
                 (axis, self.printer.lookup_object(chip_name))
                 for axis, chip_name in self.accel_chip_names]
 
+    def _run_streaming_test(self, toolhead, axis, gcmd, helper):
+        # Run the test while folding accelerometer data into running
+        # PSD estimates, instead of buffering the whole measurement
+        reactor = self.printer.get_reactor()
+        streams = []
+        for chip_axis, chip in self.accel_chips:
+            if axis in chip_axis or chip_axis in axis:
+                chip.start_measurements()
+                stream = shaper_calibrate.PSDStream(helper, chip.query_rate)
+                streams.append((chip_axis, chip, stream))
+        def update_streams(eventtime):
+            for chip_axis, chip, stream in streams:
+                stream.add_data(chip.decode_raw_samples(
+                    chip.pop_raw_samples()))
+            return eventtime + STREAM_UPDATE_TIME
+        update_timer = reactor.register_timer(update_streams, reactor.NOW)
+        try:
+            self.test.run_test(toolhead, axis, gcmd)
+        finally:
+            reactor.unregister_timer(update_timer)
+        calibration_data = []
+        for chip_axis, chip, stream in streams:
+            results = chip.finish_measurements()
+            gcmd.respond_info("%s-axis accelerometer stats: %s" % (
+                chip_axis, results.get_stats(),))
+            stream.add_data(chip.decode_raw_samples(results.raw_samples))
+            data = None
+            if results.time_per_sample:
+                data = stream.get_calibration_data(
+                        1. / results.time_per_sample)
+            if data is None:
+                raise gcmd.error(
+                        "%s-axis accelerometer measured no data" % (
+                            chip_axis,))
+            calibration_data.append((chip_axis, data))
+        return calibration_data
+
     def cmd_TEST_RESONANCES(self, gcmd):
         toolhead = self.printer.lookup_object('toolhead')
         # Parse parameters
@@ -150,6 +190,14 @@ class ResonanceTester:
             toolhead.dwell(0.500)
             gcmd.respond_info("Testing axis %s" % axis.upper())
 
+            if self.streaming and csv_output and not raw_output:
+                for chip_axis, new_data in self._run_streaming_test(
+                        toolhead, axis, gcmd, helper):
+                    if data is None:
+                        data = new_data
+                    else:
+                        data.join(new_data)
+                continue
             for chip_axis, chip in self.accel_chips:
                 if axis in chip_axis or chip_axis in axis:
                     chip.start_measurements()
@@ -232,6 +280,14 @@ class ResonanceTester:
                 toolhead.dwell(0.500)
                 gcmd.respond_info("Testing axis %s" % axis.upper())
 
+                if self.streaming:
+                    for chip_axis, new_data in self._run_streaming_test(
+                            toolhead, axis, gcmd, helper):
+                        if calibration_data[axis] is None:
+                            calibration_data[axis] = new_data
+                        else:
+                            calibration_data[axis].join(new_data)
+                    continue
                 for chip_axis, chip in self.accel_chips:
                     if axis in chip_axis or chip_axis in axis:
                         chip.start_measurements()
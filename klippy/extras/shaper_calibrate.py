@@ -3,7 +3,7 @@
 # Copyright (C) 2020  Dmitry Butyugin <dmbutyugin@google.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import collections, importlib, logging, math, multiprocessing
+import collections, importlib, logging, math
 
 MIN_FREQ = 5.
 MAX_FREQ = 200.
@@ -154,6 +154,11 @@ class CalibrationData:
         self.data_sets = joined_data_sets
     def set_numpy(self, numpy):
         self.numpy = numpy
+    def __getstate__(self):
+        # The numpy module can not be passed to a background process
+        state = dict(self.__dict__)
+        state.pop('numpy', None)
+        return state
     def normalize_to_frequencies(self):
         for psd in self._psd_list:
             # Avoid division by zero errors
@@ -162,6 +167,46 @@ class CalibrationData:
             psd[self.freq_bins < MIN_FREQ] = 0.
 
 
+# Incrementally accumulate Welch's PSD from batches of accelerometer
+# data, so that memory use does not depend on the measurement length
+class PSDStream:
+    def __init__(self, calibrate, rate):
+        self.calibrate = calibrate
+        np = calibrate.numpy
+        nfft = calibrate.get_window_size(rate)
+        self.window = np.kaiser(nfft, 6.)
+        self.step = nfft - nfft // 2
+        self.pending = np.zeros((0, 3))
+        self.psd_sums = [0., 0., 0.]
+        self.n_windows = 0
+    def add_data(self, accel):
+        # Process all complete windows of (accel_x, accel_y, accel_z)
+        # rows, retaining the unprocessed tail for the next batch
+        np = self.calibrate.numpy
+        data = np.concatenate((self.pending, accel))
+        nfft = self.window.shape[0]
+        if data.shape[0] < nfft:
+            self.pending = data
+            return
+        n_windows = (data.shape[0] - (nfft - self.step)) // self.step
+        end = (n_windows - 1) * self.step + nfft
+        for i in range(3):
+            psd_sum, n = self.calibrate._psd_sum(data[:end,i], self.window)
+            self.psd_sums[i] = self.psd_sums[i] + psd_sum
+        self.n_windows += n_windows
+        self.pending = data[n_windows * self.step:].copy()
+    def get_calibration_data(self, sampling_freq):
+        if not self.n_windows:
+            return None
+        results = [self.calibrate._psd_finish(psd_sum, self.n_windows,
+                                              self.window, sampling_freq)
+                   for psd_sum in self.psd_sums]
+        (fx, px), (_, py), (_, pz) = results
+        calibration_data = CalibrationData(fx, px+py+pz, px, py, pz)
+        calibration_data.set_numpy(self.calibrate.numpy)
+        return calibration_data
+
+
 CalibrationResult = collections.namedtuple(
         'CalibrationResult',
         ('name', 'freq', 'vals', 'vibrs', 'smoothing', 'score'))
@@ -181,38 +226,19 @@ class ShaperCalibrate:
     def background_process_exec(self, method, args):
         if self.printer is None:
             return method(*args)
-        import queuelogger
-        parent_conn, child_conn = multiprocessing.Pipe()
-        def wrapper():
-            queuelogger.clear_bg_logging()
-            try:
-                res = method(*args)
-            except:
-                child_conn.send((True, traceback.format_exc()))
-                child_conn.close()
-                return
-            child_conn.send((False, res))
-            child_conn.close()
-        # Start a process to perform the calculation
-        calc_proc = multiprocessing.Process(target=wrapper)
-        calc_proc.daemon = True
-        calc_proc.start()
-        # Wait for the process to finish
-        reactor = self.printer.get_reactor()
-        gcode = self.printer.lookup_object("gcode")
-        eventtime = last_report_time = reactor.monotonic()
-        while calc_proc.is_alive():
-            if eventtime > last_report_time + 5.:
-                last_report_time = eventtime
-                gcode.respond_info("Wait for calculations..", log=False)
-            eventtime = reactor.pause(eventtime + .1)
-        # Return results
-        is_err, res = parent_conn.recv()
-        if is_err:
-            raise self.error("Error in remote calculation: %s" % (res,))
-        calc_proc.join()
-        parent_conn.close()
-        return res
+        import workerpool
+        pool = workerpool.lookup_worker_pool(self.printer)
+        return pool.run(method, args, "Wait for calculations..")
+
+    def background_process_map(self, method, args_list):
+        # Run several calculations in parallel
+        if self.printer is None:
+            return [method(*args) for args in args_list]
+        import workerpool
+        pool = workerpool.lookup_worker_pool(self.printer)
+        completions = [pool.submit(method, args) for args in args_list]
+        return [pool.wait(completion, "Wait for calculations..")
+                for completion in completions]
 
     def _split_into_windows(self, x, window_size, overlap):
         # Memory-efficient algorithm to split an input 'x' into a series
@@ -224,12 +250,10 @@ class ShaperCalibrate:
         return self.numpy.lib.stride_tricks.as_strided(
                 x, shape=shape, strides=strides, writeable=False)
 
-    def _psd(self, x, fs, nfft):
-        # Calculate power spectral density (PSD) using Welch's algorithm
+    def _psd_sum(self, x, window):
+        # Sum the power spectra of all overlapping windows of x
         np = self.numpy
-        window = np.kaiser(nfft, 6.)
-        # Compensation for windowing loss
-        scale = 1.0 / (window**2).sum()
+        nfft = window.shape[0]
 
         # Split into overlapping windows of size nfft
         overlap = nfft // 2
@@ -241,19 +265,35 @@ class ShaperCalibrate:
         # Calculate frequency response for each window using FFT
         result = np.fft.rfft(x, n=nfft, axis=0)
         result = np.conjugate(result) * result
-        result *= scale / fs
+        return result.real.sum(axis=-1), x.shape[-1]
+
+    def _psd_finish(self, psd_sum, n_windows, window, fs):
+        np = self.numpy
+        nfft = window.shape[0]
+        # Compensation for windowing loss
+        scale = 1.0 / (window**2).sum()
+
+        # Welch's algorithm: average response over windows
+        psd = psd_sum * (scale / (fs * n_windows))
         # For one-sided FFT output the response must be doubled, except
         # the last point for unpaired Nyquist frequency (assuming even nfft)
         # and the 'DC' term (0 Hz)
-        result[1:-1,:] *= 2.
-
-        # Welch's algorithm: average response over windows
-        psd = result.real.mean(axis=-1)
+        psd[1:-1] *= 2.
 
         # Calculate the frequency bins
         freqs = np.fft.rfftfreq(nfft, 1. / fs)
         return freqs, psd
 
+    def _psd(self, x, fs, nfft):
+        # Calculate power spectral density (PSD) using Welch's algorithm
+        window = self.numpy.kaiser(nfft, 6.)
+        psd_sum, n_windows = self._psd_sum(x, window)
+        return self._psd_finish(psd_sum, n_windows, window, fs)
+
+    def get_window_size(self, sampling_freq):
+        # Round up to the nearest power of 2 for faster FFT
+        return 1 << int(sampling_freq * WINDOW_T_SEC - 1).bit_length()
+
     def calc_freq_response(self, raw_values):
         np = self.numpy
         if raw_values is None:
@@ -261,13 +301,12 @@ class ShaperCalibrate:
         if isinstance(raw_values, np.ndarray):
             data = raw_values
         else:
-            data = np.array(raw_values.decode_samples())
+            data = raw_values.decode_samples_array()
 
         N = data.shape[0]
         T = data[-1,0] - data[0,0]
         SAMPLING_FREQ = N / T
-        # Round up to the nearest power of 2 for faster FFT
-        M = 1 << int(SAMPLING_FREQ * WINDOW_T_SEC - 1).bit_length()
+        M = self.get_window_size(SAMPLING_FREQ)
         if N <= M:
             return None
 
@@ -280,7 +319,7 @@ class ShaperCalibrate:
 
     def process_accelerometer_data(self, data):
         calibration_data = self.background_process_exec(
-                self.calc_freq_response, (data,))
+                _calc_freq_response, (data,))
         if calibration_data is None:
             raise self.error(
                     "Internal error processing accelerometer data %s" % (data,))
@@ -356,9 +395,10 @@ class ShaperCalibrate:
     def find_best_shaper(self, calibration_data, max_smoothing, logger=None):
         best_shaper = None
         all_shapers = []
-        for shaper_cfg in INPUT_SHAPERS:
-            shaper = self.background_process_exec(self.fit_shaper, (
-                shaper_cfg, calibration_data, max_smoothing))
+        shapers = self.background_process_map(_fit_shaper, [
+            (shaper_cfg, calibration_data, max_smoothing)
+            for shaper_cfg in INPUT_SHAPERS])
+        for shaper in shapers:
             if logger is not None:
                 logger("Fitted shaper '%s' frequency = %.1f Hz "
                        "(vibrations = %.1f%%, smoothing ~= %.3f)" % (
@@ -406,3 +446,11 @@ class ShaperCalibrate:
                     csvfile.write("\n")
         except IOError as e:
             raise self.error("Error writing to file '%s': %s", output, str(e))
+
+# Calculations run in a background process (see workerpool.py)
+def _calc_freq_response(raw_values):
+    return ShaperCalibrate(None).calc_freq_response(raw_values)
+
+def _fit_shaper(shaper_cfg, calibration_data, max_smoothing):
+    return ShaperCalibrate(None).fit_shaper(shaper_cfg, calibration_data,
+                                            max_smoothing)
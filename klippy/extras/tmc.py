@@ -3,7 +3,7 @@
 # Copyright (C) 2018-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, collections
+import logging, collections, struct, base64
 import stepper
 
 
@@ -15,6 +15,30 @@ import stepper
 def ffs(mask):
     return (mask & -mask).bit_length() - 1
 
+# Precompiled (mask, shift, sign_bit) information for the fields of
+# each register.  These are shared by all drivers of the same type.
+_field_layouts = {}
+
+def _build_field_layout(all_fields, signed_fields):
+    key = (id(all_fields), tuple(sorted(signed_fields)))
+    entry = _field_layouts.get(key)
+    if entry is not None and entry[0] is all_fields:
+        return entry[1]
+    layout = {}
+    for reg_name, reg_fields in all_fields.items():
+        reg_layout = layout[reg_name] = collections.OrderedDict()
+        sorted_fields = sorted([(m, f) for f, m in reg_fields.items()])
+        for mask, field_name in sorted_fields:
+            shift = ffs(mask)
+            sign_bit = 0
+            if field_name in signed_fields:
+                sign_bit = 1 << ((mask >> shift).bit_length() - 1)
+            reg_layout[field_name] = (mask, shift, sign_bit)
+    _field_layouts[key] = (all_fields, layout)
+    return layout
+
+PRETTY_CACHE_SIZE = 1024
+
 class FieldHelper:
     def __init__(self, all_fields, signed_fields=[], field_formatters={},
                  registers=None):
@@ -26,6 +50,8 @@ class FieldHelper:
             self.registers = collections.OrderedDict()
         self.field_to_register = { f: r for r, fields in self.all_fields.items()
                                    for f in fields }
+        self.field_layout = _build_field_layout(all_fields, signed_fields)
+        self.pretty_cache = {}
     def lookup_register(self, field_name, default=None):
         return self.field_to_register.get(field_name, default)
     def get_field(self, field_name, reg_value=None, reg_name=None):
@@ -34,10 +60,10 @@ class FieldHelper:
             reg_name = self.field_to_register[field_name]
         if reg_value is None:
             reg_value = self.registers.get(reg_name, 0)
-        mask = self.all_fields[reg_name][field_name]
-        field_value = (reg_value & mask) >> ffs(mask)
-        if field_name in self.signed_fields and ((reg_value & mask)<<1) > mask:
-            field_value -= (1 << field_value.bit_length())
+        mask, shift, sign_bit = self.field_layout[reg_name][field_name]
+        field_value = (reg_value & mask) >> shift
+        if field_value & sign_bit:
+            field_value -= sign_bit << 1
         return field_value
     def set_field(self, field_name, field_value, reg_value=None, reg_name=None):
         # Returns register value with field bits filled with supplied value
@@ -45,10 +71,30 @@ class FieldHelper:
             reg_name = self.field_to_register[field_name]
         if reg_value is None:
             reg_value = self.registers.get(reg_name, 0)
-        mask = self.all_fields[reg_name][field_name]
-        new_value = (reg_value & ~mask) | ((field_value << ffs(mask)) & mask)
+        mask, shift, sign_bit = self.field_layout[reg_name][field_name]
+        new_value = (reg_value & ~mask) | ((field_value << shift) & mask)
         self.registers[reg_name] = new_value
         return new_value
+    def get_reg_fields(self, reg_name, reg_value):
+        # Returns a dictionary with the values of all fields of a register
+        res = {}
+        for field_name, (mask, shift, sign_bit) in self.field_layout.get(
+                reg_name, {}).items():
+            field_value = (reg_value & mask) >> shift
+            if field_value & sign_bit:
+                field_value -= sign_bit << 1
+            res[field_name] = field_value
+        return res
+    def set_reg_fields(self, reg_name, field_values, reg_value=None):
+        # Returns register value with the bits of several fields filled
+        if reg_value is None:
+            reg_value = self.registers.get(reg_name, 0)
+        reg_layout = self.field_layout[reg_name]
+        for field_name, field_value in field_values.items():
+            mask, shift, sign_bit = reg_layout[field_name]
+            reg_value = (reg_value & ~mask) | ((field_value << shift) & mask)
+        self.registers[reg_name] = reg_value
+        return reg_value
     def set_config_field(self, config, field_name, default):
         # Allow a field to be set from the config file
         config_name = "driver_" + field_name.upper()
@@ -65,28 +111,110 @@ class FieldHelper:
         return self.set_field(field_name, val)
     def pretty_format(self, reg_name, reg_value):
         # Provide a string description of a register
-        reg_fields = self.all_fields.get(reg_name, {})
-        reg_fields = sorted([(mask, name) for name, mask in reg_fields.items()])
+        cache_key = (reg_name, reg_value)
+        res = self.pretty_cache.get(cache_key)
+        if res is not None:
+            return res
+        formatters = self.field_formatters
         fields = []
-        for mask, field_name in reg_fields:
-            field_value = self.get_field(field_name, reg_value, reg_name)
-            sval = self.field_formatters.get(field_name, str)(field_value)
+        for field_name, (mask, shift, sign_bit) in self.field_layout.get(
+                reg_name, {}).items():
+            field_value = (reg_value & mask) >> shift
+            if not field_value and field_name not in formatters:
+                continue
+            if field_value & sign_bit:
+                field_value -= sign_bit << 1
+            sval = formatters.get(field_name, str)(field_value)
             if sval and sval != "0":
                 fields.append(" %s=%s" % (field_name, sval))
-        return "%-11s %08x%s" % (reg_name + ":", reg_value, "".join(fields))
+        res = "%-11s %08x%s" % (reg_name + ":", reg_value, "".join(fields))
+        if len(self.pretty_cache) >= PRETTY_CACHE_SIZE:
+            self.pretty_cache.clear()
+        self.pretty_cache[cache_key] = res
+        return res
 
 
 ######################################################################
 # Periodic error checking
 ######################################################################
 
+POLL_TIME = 1.
+
+# Schedule the periodic checks of all drivers on an mcu.  The drivers
+# sharing a bus are checked back to back in a single window and the
+# windows of the different buses are spread out over POLL_TIME.
+class TMCPollScheduler:
+    def __init__(self, printer, mcu_name):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.mcu_name = mcu_name
+        self.buses = []
+        self.poll_timer = None
+        self.next_bus = 0
+    def add_check(self, echeck):
+        for bus in self.buses:
+            if bus[0].mcu_tmc.mutex is echeck.mcu_tmc.mutex:
+                bus.append(echeck)
+                break
+        else:
+            self.buses.append([echeck])
+        if self.poll_timer is None:
+            waketime = self.reactor.monotonic() + POLL_TIME / len(self.buses)
+            self.poll_timer = self.reactor.register_timer(self._poll_bus,
+                                                          waketime)
+    def remove_check(self, echeck):
+        for bus in self.buses:
+            if echeck in bus:
+                bus.remove(echeck)
+                if not bus:
+                    self.buses.remove(bus)
+                break
+        if not self.buses and self.poll_timer is not None:
+            self.reactor.unregister_timer(self.poll_timer)
+            self.poll_timer = None
+    def _poll_bus(self, eventtime):
+        if not self.buses:
+            return self.reactor.NEVER
+        self.next_bus %= len(self.buses)
+        bus = self.buses[self.next_bus]
+        self.next_bus += 1
+        for echeck in list(bus):
+            if echeck not in bus:
+                # Checks were stopped while polling another driver
+                continue
+            if not echeck.do_check():
+                return self.reactor.NEVER
+        return eventtime + POLL_TIME / max(1, len(self.buses))
+    def stats(self, eventtime):
+        checks = [echeck for bus in self.buses for echeck in bus]
+        if not checks:
+            return False, ""
+        reads = sum([echeck.read_count for echeck in checks])
+        retries = sum([echeck.retry_count for echeck in checks])
+        max_latency = max([echeck.max_latency for echeck in checks])
+        return False, "tmc_poll_%s: reads=%d retries=%d max_latency=%.3f" % (
+            self.mcu_name, reads, retries, max_latency)
+
+def lookup_tmc_poll_scheduler(printer, mcu):
+    name = "tmc_poll_scheduler " + mcu.get_name()
+    sched = printer.lookup_object(name, None)
+    if sched is None:
+        sched = TMCPollScheduler(printer, mcu.get_name())
+        printer.add_object(name, sched)
+    return sched
+
 class TMCErrorCheck:
     def __init__(self, config, mcu_tmc, clear_gstat=True):
         self.printer = config.get_printer()
         self.stepper_name = ' '.join(config.get_name().split()[1:])
         self.mcu_tmc = mcu_tmc
         self.fields = mcu_tmc.get_fields()
-        self.check_timer = None
+        self.scheduler = lookup_tmc_poll_scheduler(self.printer,
+                                                   mcu_tmc.get_mcu())
+        self.is_checking = False
+        # Register read statistics
+        self.read_count = self.retry_count = 0
+        self.total_latency = self.max_latency = 0.
         # Setup for GSTAT query
         self.clear_gstat = clear_gstat
         reg_name = self.fields.lookup_register("drv_err")
@@ -107,18 +235,24 @@ class TMCErrorCheck:
         self.drv_status_reg_info = [0, reg_name, mask, err_mask]
     def _query_register(self, reg_info, try_clear=False):
         last_value, reg_name, mask, err_mask = reg_info
+        reactor = self.printer.get_reactor()
         count = 0
         while 1:
             try:
+                start_time = reactor.monotonic()
                 val = self.mcu_tmc.get_register(reg_name)
             except self.printer.command_error as e:
                 count += 1
+                self.retry_count += 1
                 if count < 3 and str(e).startswith("Unable to read tmc uart"):
                     # Allow more retries on a TMC UART read error
-                    reactor = self.printer.get_reactor()
                     reactor.pause(reactor.monotonic() + 0.050)
                     continue
                 raise
+            latency = reactor.monotonic() - start_time
+            self.read_count += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
             if val & mask != last_value & mask:
                 fmt = self.fields.pretty_format(reg_name, val)
                 logging.info("TMC '%s' reports %s", self.stepper_name, fmt)
@@ -133,28 +267,227 @@ class TMCErrorCheck:
             if try_clear:
                 try_clear = False
                 self.mcu_tmc.set_register(reg_name, val & err_mask)
-    def _do_periodic_check(self, eventtime, try_clear=False):
+    def do_check(self, try_clear=False):
         try:
             self._query_register(self.drv_status_reg_info)
             if self.gstat_reg_info is not None:
                 self._query_register(self.gstat_reg_info, try_clear=try_clear)
         except self.printer.command_error as e:
             self.printer.invoke_shutdown(str(e))
-            return self.printer.get_reactor().NEVER
-        return eventtime + 1.
+            return False
+        return True
     def stop_checks(self):
-        if self.check_timer is None:
+        if not self.is_checking:
             return
-        self.printer.get_reactor().unregister_timer(self.check_timer)
-        self.check_timer = None
+        self.scheduler.remove_check(self)
+        self.is_checking = False
     def start_checks(self):
-        if self.check_timer is not None:
+        if self.is_checking:
             self.stop_checks()
-        self._do_periodic_check(0., try_clear=self.clear_gstat)
+        if not self.do_check(try_clear=self.clear_gstat):
+            return
+        self.scheduler.add_check(self)
+        self.is_checking = True
+    def get_status(self, eventtime=None):
+        avg_latency = self.total_latency / max(1, self.read_count)
+        return {'poll_reads': self.read_count,
+                'poll_retries': self.retry_count,
+                'poll_avg_latency': avg_latency,
+                'poll_max_latency': self.max_latency}
+
+
+######################################################################
+# Telemetry streaming
+######################################################################
+
+# Fields reported in each sample (and their names on each driver type)
+STREAM_FIELDS = [("sg_result", ["SG_RESULT", "SG@RDSEL1"]),
+                 ("cs_actual", ["CS_ACTUAL", "SE"])]
+STREAM_FLAGS = ["ot", "otpw", "t120", "t143", "t150", "t157"]
+# print_time, stepper index, sg_result, cs_actual, flags
+STREAM_SAMPLE_FORMAT = "<dBhhH"
+STREAM_BUFFER_SIZE = 4096
+STREAM_FLUSH_TIME = .250
+STREAM_MAX_RATE = 50.
+STREAM_MAX_BACKLOG = 256 * 1024
+
+# Read the telemetry registers of a single driver
+class TMCStreamDriver:
+    def __init__(self, printer, name, mcu_tmc):
+        self.printer = printer
+        self.name = name
+        self.mcu_tmc = mcu_tmc
+        self.mcu = mcu_tmc.get_mcu()
+        fields = mcu_tmc.get_fields()
+        self.read_registers = []
+        self.field_lookups = []
+        for field_names in [names for n, names in STREAM_FIELDS]:
+            for field_name in field_names:
+                reg_name = fields.lookup_register(field_name)
+                if reg_name is not None:
+                    break
+            else:
+                self.field_lookups.append(None)
+                continue
+            if reg_name not in self.read_registers:
+                self.read_registers.append(reg_name)
+            self.field_lookups.append((reg_name, field_name))
+        self.flag_lookups = []
+        for bit, flag_name in enumerate(STREAM_FLAGS):
+            for reg_name in self.read_registers:
+                if flag_name in fields.all_fields[reg_name]:
+                    self.flag_lookups.append((1 << bit, reg_name, flag_name))
+                    break
+        self.fields = fields
+    def sample(self):
         reactor = self.printer.get_reactor()
-        curtime = reactor.monotonic()
-        self.check_timer = reactor.register_timer(self._do_periodic_check,
-                                                  curtime + 1.)
+        start_time = reactor.monotonic()
+        reg_values = {}
+        for reg_name in self.read_registers:
+            reg_values[reg_name] = self.mcu_tmc.get_register(reg_name)
+        end_time = reactor.monotonic()
+        print_time = self.mcu.estimated_print_time(.5 * (start_time + end_time))
+        values = []
+        for lookup in self.field_lookups:
+            if lookup is None:
+                values.append(-1)
+                continue
+            reg_name, field_name = lookup
+            values.append(self.fields.get_field(
+                field_name, reg_values[reg_name], reg_name))
+        flags = 0
+        for bit, reg_name, flag_name in self.flag_lookups:
+            if self.fields.get_field(flag_name, reg_values[reg_name], reg_name):
+                flags |= bit
+        return print_time, values[0], values[1], flags
+
+class TMCStreamClient:
+    def __init__(self, cconn, template, indexes, rate, use_binary, seq):
+        self.cconn = cconn
+        self.template = template
+        self.indexes = indexes
+        self.rate = rate
+        self.use_binary = use_binary
+        self.last_seq = seq
+        self.dropped = 0
+
+# Sample the drivers into a ring buffer and send them to clients
+class TMCStreamHelper:
+    def __init__(self, printer):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.drivers = []
+        self.clients = []
+        self.samples = collections.deque(maxlen=STREAM_BUFFER_SIZE)
+        self.next_seq = 0
+        self.sample_errors = 0
+        self.sample_timer = self.flush_timer = None
+        webhooks = printer.lookup_object('webhooks')
+        webhooks.register_endpoint("tmc/stream", self._handle_stream)
+    def register_driver(self, name, mcu_tmc):
+        self.drivers.append(TMCStreamDriver(self.printer, name, mcu_tmc))
+    def _handle_stream(self, web_request):
+        template = web_request.get_dict('response_template', {})
+        rate = web_request.get_float('rate', 10.)
+        if rate <= 0. or rate > STREAM_MAX_RATE:
+            raise web_request.error("Invalid rate (maximum is %.0f)"
+                                    % (STREAM_MAX_RATE,))
+        fmt = web_request.get_str('format', 'json')
+        if fmt not in ('json', 'binary'):
+            raise web_request.error("Invalid format '%s'" % (fmt,))
+        names = [d.name for d in self.drivers]
+        steppers = web_request.get('steppers', names, types=(list,))
+        indexes = []
+        for name in steppers:
+            if name not in names:
+                raise web_request.error("Unknown stepper '%s'" % (name,))
+            indexes.append(names.index(name))
+        cconn = web_request.get_client_connection()
+        self.clients = [c for c in self.clients if c.cconn is not cconn]
+        self.clients.append(TMCStreamClient(cconn, template, set(indexes),
+                                            rate, fmt == 'binary',
+                                            self.next_seq))
+        if self.sample_timer is None:
+            self.sample_timer = self.reactor.register_timer(
+                self._sample_drivers, self.reactor.NOW)
+            self.flush_timer = self.reactor.register_timer(
+                self._flush_clients, self.reactor.NOW)
+        web_request.send({
+            'steppers': names, 'flags': STREAM_FLAGS,
+            'fields': ['print_time', 'stepper']
+                      + [n for n, names in STREAM_FIELDS] + ['flags'],
+            'sample_format': STREAM_SAMPLE_FORMAT})
+    def _stop(self):
+        self.reactor.unregister_timer(self.sample_timer)
+        self.reactor.unregister_timer(self.flush_timer)
+        self.sample_timer = self.flush_timer = None
+    def _sample_drivers(self, eventtime):
+        self.clients = [c for c in self.clients if not c.cconn.is_closed()]
+        if not self.clients or self.printer.is_shutdown():
+            self._stop()
+            return self.reactor.NEVER
+        indexes = set()
+        for client in self.clients:
+            indexes.update(client.indexes)
+        for index in sorted(indexes):
+            try:
+                sample = self.drivers[index].sample()
+            except self.printer.command_error:
+                self.sample_errors += 1
+                continue
+            print_time, sg_result, cs_actual, flags = sample
+            self.samples.append((self.next_seq, print_time, index,
+                                 sg_result, cs_actual, flags))
+            self.next_seq += 1
+        # Don't queue up reads if the bus can not keep up with the rate
+        period = 1. / max([c.rate for c in self.clients])
+        curtime = self.reactor.monotonic()
+        return max(eventtime + period, curtime + .5 * period)
+    def _flush_clients(self, eventtime):
+        if self.samples:
+            first_seq = self.samples[0][0]
+        else:
+            first_seq = self.next_seq
+        for client in self.clients:
+            cconn = client.cconn
+            if cconn.is_closed():
+                continue
+            # Samples that were overwritten in the ring buffer
+            client.dropped += max(0, first_seq - client.last_seq)
+            new_samples = [s[1:] for s in self.samples
+                           if s[0] >= client.last_seq
+                           and s[2] in client.indexes]
+            client.last_seq = self.next_seq
+            if not new_samples:
+                continue
+            if cconn.send_size > STREAM_MAX_BACKLOG:
+                # Client is not keeping up - drop samples
+                client.dropped += len(new_samples)
+                continue
+            params = {'dropped': client.dropped}
+            if client.use_binary:
+                data = "".join([struct.pack(STREAM_SAMPLE_FORMAT, *s)
+                                for s in new_samples])
+                params['data'] = base64.b64encode(data).decode('ascii')
+            else:
+                params['samples'] = new_samples
+            client.dropped = 0
+            out = {'params': params}
+            out.update(client.template)
+            cconn.send(out)
+        return eventtime + STREAM_FLUSH_TIME
+    def stats(self, eventtime):
+        if not self.clients:
+            return False, ""
+        return False, "tmc_stream: clients=%d samples=%d errors=%d" % (
+            len(self.clients), self.next_seq, self.sample_errors)
+
+def lookup_tmc_stream(printer):
+    stream = printer.lookup_object('tmc_stream', None)
+    if stream is None:
+        stream = TMCStreamHelper(printer)
+        printer.add_object('tmc_stream', stream)
+    return stream
 
 
 ######################################################################
@@ -169,6 +502,8 @@ class TMCCommandHelper:
         self.mcu_tmc = mcu_tmc
         self.current_helper = current_helper
         self.echeck_helper = TMCErrorCheck(config, mcu_tmc, clear_gstat)
+        lookup_tmc_stream(self.printer).register_driver(self.stepper_name,
+                                                        mcu_tmc)
         self.fields = mcu_tmc.get_fields()
         self.read_registers = self.read_translate = None
         self.toff = None
@@ -185,6 +520,8 @@ class TMCCommandHelper:
         gcode.register_mux_command("SET_TMC_CURRENT", "STEPPER", self.name,
                                    self.cmd_SET_TMC_CURRENT,
                                    desc=self.cmd_SET_TMC_CURRENT_help)
+    def get_status(self, eventtime=None):
+        return self.echeck_helper.get_status(eventtime)
     def _init_registers(self, print_time=None):
         # Send registers
         for reg_name, val in self.fields.registers.items():
@@ -217,6 +217,8 @@ class MCU_TMC_SPI:
         self.fields = fields
     def get_fields(self):
         return self.fields
+    def get_mcu(self):
+        return self.tmc_spi.spi.get_mcu()
     def get_register(self, reg_name):
         reg = self.name_to_reg[reg_name]
         with self.mutex:
@@ -244,6 +246,7 @@ class TMC2130:
         cmdhelper = tmc.TMCCommandHelper(config, self.mcu_tmc, current_helper,
                                          clear_gstat=False)
         cmdhelper.setup_register_dump(ReadRegisters)
+        self.get_status = cmdhelper.get_status
         # Setup basic register values
         mh = tmc.TMCMicrostepHelper(config, self.mcu_tmc)
         self.get_microsteps = mh.get_microsteps
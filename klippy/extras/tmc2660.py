@@ -191,6 +191,8 @@ class MCU_TMC2660_SPI:
         self.fields = fields
     def get_fields(self):
         return self.fields
+    def get_mcu(self):
+        return self.spi.get_mcu()
     def get_register(self, reg_name):
         new_rdsel = ReadRegisters.index(reg_name)
         reg = self.name_to_reg["DRVCONF"]
@@ -230,6 +232,7 @@ class TMC2660:
         current_helper = TMC2660CurrentHelper(config, self.mcu_tmc)
         cmdhelper = tmc.TMCCommandHelper(config, self.mcu_tmc, current_helper)
         cmdhelper.setup_register_dump(ReadRegisters)
+        self.get_status = cmdhelper.get_status
 
         # DRVCTRL
         mh = tmc.TMCMicrostepHelper(config, self.mcu_tmc)
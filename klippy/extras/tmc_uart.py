@@ -199,6 +199,8 @@ class MCU_TMC_uart:
         self.mutex = self.mcu_uart.mutex
     def get_fields(self):
         return self.fields
+    def get_mcu(self):
+        return self.mcu_uart.mcu
     def _do_get_register(self, reg_name):
         reg = self.name_to_reg[reg_name]
         if self.printer.get_start_args().get('debugoutput') is not None:
@@ -3,9 +3,260 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging
+import os, mmap, struct, array, hashlib, logging
 
 VALID_GCODE_EXTS = ['gcode', 'g', 'gco']
+READ_SIZE = 64 * 1024
+DISPATCH_BATCH_LINES = 100
+
+
+######################################################################
+# Pre-parsed g-code cache
+######################################################################
+
+# The cache stores each line of a g-code file as a length (in bytes,
+# including the newline), a kind byte, and (for simple G0/G1 moves) the
+# parsed coordinates.  Lines are grouped into blocks of:
+#   <nlines, ncoords> <lengths[nlines]> <kinds[nlines]> <coords[ncoords]>
+CACHE_MAGIC = "KLGCACHE"
+CACHE_VERSION = 1
+CACHE_HEADER = struct.Struct("<8sIQd")
+CACHE_BLOCK_HEADER = struct.Struct("<II")
+CACHE_BLOCK_LINES = 4096
+KIND_TEXT = 0x00
+KIND_SKIP = 0x01
+KIND_MOVE = 0x80 # Or'ed with move command index << 5 and coordinate mask
+MOVE_CMDS = ['G0', 'G1']
+
+class GCodeCacheWriter:
+    def __init__(self, fname, file_size, file_mtime):
+        self.fname = fname
+        self.tmp_fname = fname + ".tmp"
+        self.f = open(self.tmp_fname, 'wb')
+        self.f.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION,
+                                       file_size, file_mtime))
+        self.position = 0
+        self._reset_block()
+    def _reset_block(self):
+        self.lengths = array.array('I')
+        self.kinds = array.array('B')
+        self.coords = array.array('d')
+    def _flush_block(self):
+        self.f.write(CACHE_BLOCK_HEADER.pack(len(self.lengths),
+                                             len(self.coords)))
+        self.lengths.tofile(self.f)
+        self.kinds.tofile(self.f)
+        self.coords.tofile(self.f)
+        self._reset_block()
+    def add_line(self, length, item):
+        # Item is None (nothing to run), the line text, or a
+        # (line, cmd, coords) tuple from gcode.parse_fast_move()
+        if item is None:
+            kind = KIND_SKIP
+        elif type(item) is tuple:
+            kind = KIND_MOVE | (MOVE_CMDS.index(item[1]) << 5)
+            for i, v in enumerate(item[2]):
+                if v is not None:
+                    kind |= 1 << i
+                    self.coords.append(v)
+        else:
+            kind = KIND_TEXT
+        self.lengths.append(length)
+        self.kinds.append(kind)
+        self.position += length
+        if len(self.lengths) >= CACHE_BLOCK_LINES:
+            self._flush_block()
+    def finish(self):
+        if self.lengths:
+            self._flush_block()
+        self.f.close()
+        os.rename(self.tmp_fname, self.fname)
+    def abort(self):
+        try:
+            self.f.close()
+        finally:
+            os.remove(self.tmp_fname)
+
+class GCodeCacheReader:
+    def __init__(self, fname, file_size, file_mtime):
+        self.f = open(fname, 'rb')
+        header = self.f.read(CACHE_HEADER.size)
+        if (len(header) != CACHE_HEADER.size
+            or CACHE_HEADER.unpack(header) != (CACHE_MAGIC, CACHE_VERSION,
+                                               file_size, file_mtime)):
+            self.f.close()
+            raise IOError("Cache file %s is stale" % (fname,))
+        if not self._check_blocks():
+            self.f.close()
+            raise IOError("Cache file %s is truncated" % (fname,))
+        self.position = 0
+        self.pending = None
+    def _check_blocks(self):
+        # Verify that the file consists of a sequence of complete blocks
+        file_size = os.fstat(self.f.fileno()).st_size
+        pos = CACHE_HEADER.size
+        while pos < file_size:
+            self.f.seek(pos)
+            data = self.f.read(CACHE_BLOCK_HEADER.size)
+            if len(data) != CACHE_BLOCK_HEADER.size:
+                return False
+            nlines, ncoords = CACHE_BLOCK_HEADER.unpack(data)
+            if not nlines:
+                return False
+            pos += CACHE_BLOCK_HEADER.size + nlines * 5 + ncoords * 8
+        self.f.seek(CACHE_HEADER.size)
+        return pos == file_size
+    def close(self):
+        self.f.close()
+    def _read_block_header(self):
+        data = self.f.read(CACHE_BLOCK_HEADER.size)
+        if not data:
+            return None
+        nlines, ncoords = CACHE_BLOCK_HEADER.unpack(data)
+        lengths = array.array('I')
+        lengths.fromfile(self.f, nlines)
+        return nlines, ncoords, lengths
+    def seek(self, position):
+        # Skip blocks preceding the given file position.  Returns False
+        # if the position is not at the start of a line.
+        while 1:
+            header = self._read_block_header()
+            if header is None:
+                return position == self.position
+            nlines, ncoords, lengths = header
+            block_size = sum(lengths)
+            if self.position + block_size > position:
+                break
+            self.position += block_size
+            self.f.seek(nlines + ncoords * 8, os.SEEK_CUR)
+        kinds = array.array('B')
+        kinds.fromfile(self.f, nlines)
+        coords = array.array('d')
+        coords.fromfile(self.f, ncoords)
+        skip_lines = skip_coords = 0
+        while self.position < position:
+            self.position += lengths[skip_lines]
+            kind = kinds[skip_lines]
+            if kind & KIND_MOVE:
+                skip_coords += bin(kind & 0x1f).count('1')
+            skip_lines += 1
+        self.pending = (lengths[skip_lines:], kinds[skip_lines:],
+                        coords[skip_coords:])
+        return self.position == position
+    def read_records(self, data):
+        # Return a reversed list of (length, item) records for the next
+        # block of lines (item text is taken from the mapped g-code file)
+        if self.pending is not None:
+            lengths, kinds, coords = self.pending
+            self.pending = None
+        else:
+            header = self._read_block_header()
+            if header is None:
+                return []
+            nlines, ncoords, lengths = header
+            kinds = array.array('B')
+            kinds.fromfile(self.f, nlines)
+            coords = array.array('d')
+            coords.fromfile(self.f, ncoords)
+        records = []
+        pos = self.position
+        cpos = 0
+        for length, kind in zip(lengths, kinds):
+            if kind == KIND_SKIP:
+                item = None
+            elif kind == KIND_TEXT:
+                item = data[pos:pos + length - 1]
+            else:
+                move_coords = [None, None, None, None, None]
+                for i in range(5):
+                    if kind & (1 << i):
+                        move_coords[i] = coords[cpos]
+                        cpos += 1
+                item = (data[pos:pos + length - 1],
+                        MOVE_CMDS[(kind >> 5) & 0x03], move_coords)
+            records.append((length, item))
+            pos += length
+        self.position = pos
+        records.reverse()
+        return records
+
+class GCodeCache:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.dirname = os.path.normpath(os.path.expanduser(
+            config.get('cache_path')))
+        self.max_size = config.getint('cache_size', 1024, minval=1) << 20
+    def _get_cache_info(self, filename):
+        st = os.stat(filename)
+        fname = hashlib.sha1(os.path.abspath(filename)).hexdigest()
+        return (os.path.join(self.dirname, fname + ".gcache"),
+                st.st_size, st.st_mtime)
+    def open_reader(self, filename):
+        try:
+            cache_fname, size, mtime = self._get_cache_info(filename)
+        except OSError:
+            logging.exception("virtual_sdcard cache open")
+            return None
+        if not os.path.exists(cache_fname):
+            return None
+        try:
+            reader = GCodeCacheReader(cache_fname, size, mtime)
+            # Note use of the cache file for least-recently-used eviction
+            os.utime(cache_fname, None)
+            return reader
+        except (IOError, OSError, struct.error) as e:
+            logging.info("virtual_sdcard cache: %s", str(e))
+            self._remove(cache_fname)
+            return None
+    def discard(self, filename):
+        # Remove the cache file of a g-code file (eg, after a read error)
+        try:
+            cache_fname, size, mtime = self._get_cache_info(filename)
+        except OSError:
+            logging.exception("virtual_sdcard cache discard")
+            return
+        self._remove(cache_fname)
+    def _remove(self, cache_fname):
+        logging.info("virtual_sdcard cache: removing %s", cache_fname)
+        try:
+            os.remove(cache_fname)
+        except OSError:
+            logging.exception("virtual_sdcard cache remove")
+    def create_writer(self, filename):
+        try:
+            if not os.path.exists(self.dirname):
+                os.makedirs(self.dirname)
+            cache_fname, size, mtime = self._get_cache_info(filename)
+            return GCodeCacheWriter(cache_fname, size, mtime)
+        except (IOError, OSError):
+            logging.exception("virtual_sdcard cache create")
+            return None
+    def finish_writer(self, writer):
+        try:
+            writer.finish()
+        except (IOError, OSError):
+            logging.exception("virtual_sdcard cache write")
+            return
+        self._evict()
+    def _evict(self):
+        # Remove least recently used cache files until under size budget
+        try:
+            files = []
+            for fname in os.listdir(self.dirname):
+                if fname.endswith(".gcache"):
+                    fname = os.path.join(self.dirname, fname)
+                    st = os.stat(fname)
+                    files.append((st.st_mtime, st.st_size, fname))
+            files.sort()
+            total_size = sum([size for mtime, size, fname in files])
+            for mtime, size, fname in files:
+                if total_size <= self.max_size:
+                    break
+                logging.info("virtual_sdcard cache: removing %s", fname)
+                os.remove(fname)
+                total_size -= size
+        except OSError:
+            logging.exception("virtual_sdcard cache evict")
 
 class VirtualSD:
     def __init__(self, config):
@@ -15,13 +266,22 @@ class VirtualSD:
         sd = config.get('path')
         self.sdcard_dirname = os.path.normpath(os.path.expanduser(sd))
         self.current_file = None
+        self.file_path = None
         self.file_position = self.file_size = 0
+        # Pre-parsed g-code cache
+        self.gcode_cache = None
+        if config.get('cache_path', None) is not None:
+            self.gcode_cache = GCodeCache(config)
+        self.cache_writer = None
         # Print Stat Tracking
         self.print_stats = printer.load_object(config, 'print_stats')
         # Work timer
         self.reactor = printer.get_reactor()
         self.must_pause_work = self.cmd_from_sd = False
         self.work_timer = None
+        if printer.get_start_args().get('debuginput') is not None:
+            printer.register_event_handler("gcode:request_restart",
+                                           self._handle_request_restart)
         # Register commands
         self.gcode = printer.lookup_object('gcode')
         for cmd in ['M20', 'M21', 'M23', 'M24', 'M25', 'M26', 'M27']:
@@ -48,6 +308,15 @@ class VirtualSD:
             logging.info("Virtual sdcard (%d): %s\nUpcoming (%d): %s",
                          readpos, repr(data[:readcount]),
                          self.file_position, repr(data[readcount:]))
+    def _handle_request_restart(self, print_time):
+        # When processing a g-code input file (batch mode), complete an
+        # active print before exiting at the end of the input.  Don't
+        # wait if the request came from a command (RESTART) as the
+        # print can not progress while that command holds the mutex.
+        if self.cmd_from_sd or self.gcode.get_mutex().test():
+            return
+        while self.work_timer is not None and not self.must_pause_work:
+            self.reactor.pause(self.reactor.monotonic() + .100)
     def stats(self, eventtime):
         if self.work_timer is None:
             return False, ""
@@ -99,6 +368,8 @@ class VirtualSD:
             self.do_pause()
             self.current_file.close()
             self.current_file = None
+            self.file_path = None
+        self._abort_cache_writer()
         self.file_position = self.file_size = 0.
         self.print_stats.reset()
     cmd_SDCARD_RESET_FILE_help = "Clears a loaded SD File. Stops the print "\
@@ -162,9 +433,17 @@ class VirtualSD:
         gcmd.respond_raw("File opened:%s Size:%d" % (filename, fsize))
         gcmd.respond_raw("File selected")
         self.current_file = f
+        self.file_path = fname
         self.file_position = 0
         self.file_size = fsize
         self.print_stats.set_current_file(filename)
+        if self.gcode_cache is not None:
+            # Record the parsed file during the first print from it
+            reader = self.gcode_cache.open_reader(fname)
+            if reader is not None:
+                reader.close()
+            else:
+                self.cache_writer = self.gcode_cache.create_writer(fname)
     def cmd_M24(self, gcmd):
         # Start/resume SD print
         if self.work_timer is not None:
@@ -189,6 +468,94 @@ class VirtualSD:
         gcmd.respond_raw("SD printing byte %d/%d"
                          % (self.file_position, self.file_size))
     # Background work timer
+    def _map_file(self):
+        try:
+            mm = mmap.mmap(self.current_file.fileno(), 0,
+                           access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            # Empty file or filesystem without mmap support
+            return None
+        if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        return mm
+    def _read_data(self, mm, readpos):
+        if mm is not None:
+            return mm[readpos:readpos + READ_SIZE]
+        return self.current_file.read(READ_SIZE)
+    def _batch_lines(self, lines, gcode_mutex):
+        # Feed pending lines to the gcode parser, updating file_position
+        # as each command completes.  The batch is ended early if a
+        # pause is requested or another task is waiting for the mutex.
+        for i in range(DISPATCH_BATCH_LINES):
+            if (not lines or self.must_pause_work
+                or gcode_mutex.test_waiting()):
+                break
+            yield lines[-1]
+            self.file_position += len(lines.pop()) + 1
+    def _parse_line(self, line):
+        # Convert a line of the file to a (length, item) record
+        cmdline = line.strip()
+        cpos = cmdline.find(';')
+        if cpos >= 0:
+            cmdline = cmdline[:cpos].rstrip()
+        if not cmdline:
+            return (len(line) + 1, None)
+        cmd, coords = self.gcode.parse_fast_move(cmdline)
+        if cmd is None:
+            return (len(line) + 1, line)
+        return (len(line) + 1, (line, cmd, coords))
+    def _batch_records(self, records, gcode_mutex):
+        # Similar to _batch_lines(), but for pre-parsed records
+        writer = self.cache_writer
+        for i in range(DISPATCH_BATCH_LINES):
+            if (not records or self.must_pause_work
+                or gcode_mutex.test_waiting()):
+                break
+            length, item = records[-1]
+            if item is not None:
+                yield item
+            self.file_position += length
+            if writer is not None:
+                try:
+                    writer.add_line(length, item)
+                except (IOError, OSError):
+                    # A cache write failure must not stop the print
+                    logging.exception("virtual_sdcard cache write")
+                    self._abort_cache_writer()
+                    writer = None
+            records.pop()
+    def _open_cache_reader(self):
+        reader = self.gcode_cache.open_reader(self.file_path)
+        if reader is None:
+            return None
+        try:
+            if reader.seek(self.file_position):
+                return reader
+            logging.info("virtual_sdcard cache: position %d is not at the"
+                         " start of a line", self.file_position)
+        except (IOError, EOFError, struct.error):
+            logging.exception("virtual_sdcard cache seek")
+            reader.close()
+            self.gcode_cache.discard(self.file_path)
+            return None
+        reader.close()
+        return None
+    def _read_cache_records(self, reader, mm):
+        # Returns None if the cache file could not be decoded
+        try:
+            return reader.read_records(mm)
+        except (IOError, EOFError, struct.error, ValueError, IndexError):
+            logging.exception("virtual_sdcard cache read")
+        reader.close()
+        self.gcode_cache.discard(self.file_path)
+        return None
+    def _abort_cache_writer(self):
+        if self.cache_writer is not None:
+            try:
+                self.cache_writer.abort()
+            except (IOError, OSError):
+                logging.exception("virtual_sdcard cache abort")
+            self.cache_writer = None
     def work_handler(self, eventtime):
         logging.info("Starting SD card print (position %d)", self.file_position)
         self.reactor.unregister_timer(self.work_timer)
@@ -200,37 +567,75 @@ class VirtualSD:
             return self.reactor.NEVER
         self.print_stats.note_start()
         gcode_mutex = self.gcode.get_mutex()
+        mm = self._map_file()
+        # Check if pre-parsed records from the g-code cache can be used
+        use_records = self.gcode_cache is not None
+        reader = None
+        if use_records and mm is not None:
+            reader = self._open_cache_reader()
+        if self.cache_writer is not None and (
+                reader is not None
+                or self.cache_writer.position != self.file_position):
+            # Only record files that are printed sequentially
+            self._abort_cache_writer()
+        readpos = self.file_position
         partial_input = ""
         lines = []
         while not self.must_pause_work:
             if not lines:
                 # Read more data
                 try:
-                    data = self.current_file.read(8192)
+                    if reader is not None:
+                        lines = self._read_cache_records(reader, mm)
+                        if lines is None:
+                            # Parse the g-code text from the current position
+                            logging.info("virtual_sdcard cache: reading"
+                                         " position %d from file",
+                                         self.file_position)
+                            reader = None
+                            readpos = self.file_position
+                            continue
+                        is_eof = not lines
+                    else:
+                        data = self._read_data(mm, readpos)
+                        is_eof = not data
                 except:
                     logging.exception("virtual_sdcard read")
                     break
-                if not data:
+                if is_eof:
                     # End of file
                     self.current_file.close()
                     self.current_file = None
+                    self.file_path = None
+                    if self.cache_writer is not None:
+                        self.gcode_cache.finish_writer(self.cache_writer)
+                        self.cache_writer = None
                     logging.info("Finished SD card print")
                     self.gcode.respond_raw("Done printing file")
                     break
-                lines = data.split('\n')
-                lines[0] = partial_input + lines[0]
-                partial_input = lines.pop()
-                lines.reverse()
+                if reader is None:
+                    readpos += len(data)
+                    lines = data.split('\n')
+                    lines[0] = partial_input + lines[0]
+                    partial_input = lines.pop()
+                    if use_records:
+                        lines = [self._parse_line(line) for line in lines]
+                    lines.reverse()
                 self.reactor.pause(self.reactor.NOW)
                 continue
             # Pause if any other request is pending in the gcode class
             if gcode_mutex.test():
                 self.reactor.pause(self.reactor.monotonic() + 0.100)
                 continue
-            # Dispatch command
+            # Dispatch a batch of commands under a single mutex acquisition
+            if use_records:
+                batch = self._batch_records(lines, gcode_mutex)
+            else:
+                batch = self._batch_lines(lines, gcode_mutex)
             self.cmd_from_sd = True
             try:
-                self.gcode.run_script(lines[-1])
+                with gcode_mutex:
+                    self.gcode.run_commands(batch)
             except self.gcode.error as e:
                 self.print_stats.note_error(str(e))
                 break
@@ -238,7 +643,10 @@ class VirtualSD:
                 logging.exception("virtual_sdcard dispatch")
                 break
             self.cmd_from_sd = False
-            self.file_position += len(lines.pop()) + 1
+        if reader is not None:
+            reader.close()
+        if mm is not None:
+            mm.close()
         logging.info("Exiting SD card print (position %d)", self.file_position)
         self.work_timer = None
         self.cmd_from_sd = False
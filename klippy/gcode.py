@@ -89,6 +89,7 @@ class GCodeDispatch:
         self.ready_gcode_handlers = {}
         self.mux_commands = {}
         self.gcode_help = {}
+        self.fast_moves = {}
         # Register commands needed before config file is loaded
         handlers = ['M110', 'M112', 'M115',
                     'RESTART', 'FIRMWARE_RESTART', 'ECHO', 'STATUS', 'HELP']
@@ -138,6 +139,12 @@ class GCodeDispatch:
                 "mux command %s %s %s already registered (%s)" % (
                     cmd, key, value, prev_values))
         prev_values[value] = func
+    def register_fast_move(self, cmd, func, fast_func):
+        # Simple moves (eg, "G1 X10 Y20 F3000") may bypass the generic
+        # parser and be passed directly to fast_func as a list of
+        # [X, Y, Z, E, F] floats (None for missing parameters).  The
+        # fast path is only used while func is the active handler.
+        self.fast_moves[cmd] = (func, fast_func)
     def get_command_help(self):
         return dict(self.gcode_help)
     def register_output_handler(self, cb):
@@ -156,30 +163,68 @@ class GCodeDispatch:
         self._respond_state("Ready")
     # Parse input into commands
     args_r = re.compile('([A-Z_]+|[A-Z*/])')
+    fast_move_r = re.compile(r'^[Gg][01](?:\s+[XYZEFxyzef][-+]?[0-9.]+)*$')
+    fast_move_axes = {'X': 0, 'Y': 1, 'Z': 2, 'E': 3, 'F': 4,
+                      'x': 0, 'y': 1, 'z': 2, 'e': 3, 'f': 4}
+    def parse_fast_move(self, line):
+        # Parse a simple (comment free) G0/G1 line into its command and
+        # a list of [X, Y, Z, E, F] floats (None for missing parameters)
+        if self.fast_move_r.match(line) is None:
+            return None, None
+        coords = [None, None, None, None, None]
+        axes = self.fast_move_axes
+        try:
+            for part in line.split()[1:]:
+                coords[axes[part[0]]] = float(part[1:])
+        except ValueError as e:
+            # Let the generic parser report the error
+            return None, None
+        return line[:2].upper(), coords
+    def _lookup_fast_move(self, cmd):
+        fast_move = self.fast_moves.get(cmd)
+        if fast_move is None or fast_move[0] != self.gcode_handlers.get(cmd):
+            return None
+        return fast_move[1]
     def _process_commands(self, commands, need_ack=True):
         for line in commands:
+            fast_func = None
+            if type(line) is tuple:
+                # Move already decoded with parse_fast_move()
+                line, cmd, coords = line
+                fast_func = self._lookup_fast_move(cmd)
             # Ignore comments and leading/trailing spaces
             line = origline = line.strip()
             cpos = line.find(';')
             if cpos >= 0:
-                line = line[:cpos]
-            # Break line into parts and determine command
-            parts = self.args_r.split(line.upper())
-            numparts = len(parts)
-            cmd = ""
-            if numparts >= 3 and parts[1] != 'N':
-                cmd = parts[1] + parts[2].strip()
-            elif numparts >= 5 and parts[1] == 'N':
-                # Skip line number at start of command
-                cmd = parts[3] + parts[4].strip()
-            # Build gcode "params" dictionary
-            params = { parts[i]: parts[i+1].strip()
-                       for i in range(1, numparts, 2) }
-            gcmd = GCodeCommand(self, cmd, origline, params, need_ack)
+                line = line[:cpos].rstrip()
+            # Check for simple G0/G1 moves that can skip the generic parser
+            if fast_func is None:
+                cmd, coords = self.parse_fast_move(line)
+                if cmd is not None:
+                    fast_func = self._lookup_fast_move(cmd)
+            if fast_func is not None:
+                gcmd = None
+            else:
+                # Break line into parts and determine command
+                parts = self.args_r.split(line.upper())
+                numparts = len(parts)
+                cmd = ""
+                if numparts >= 3 and parts[1] != 'N':
+                    cmd = parts[1] + parts[2].strip()
+                elif numparts >= 5 and parts[1] == 'N':
+                    # Skip line number at start of command
+                    cmd = parts[3] + parts[4].strip()
+                # Build gcode "params" dictionary
+                params = { parts[i]: parts[i+1].strip()
+                           for i in range(1, numparts, 2) }
+                gcmd = GCodeCommand(self, cmd, origline, params, need_ack)
             # Invoke handler for command
-            handler = self.gcode_handlers.get(cmd, self.cmd_default)
             try:
-                handler(gcmd)
+                if gcmd is None:
+                    fast_func(origline, coords)
+                else:
+                    handler = self.gcode_handlers.get(cmd, self.cmd_default)
+                    handler(gcmd)
             except self.error as e:
                 self._respond_error(str(e))
                 self.printer.send_event("gcode:command_error")
@@ -192,9 +237,17 @@ class GCodeDispatch:
                 self._respond_error(msg)
                 if not need_ack:
                     raise
-            gcmd.ack()
+            if gcmd is None:
+                if need_ack:
+                    self.respond_raw("ok")
+            else:
+                gcmd.ack()
     def run_script_from_command(self, script):
         self._process_commands(script.split('\n'), need_ack=False)
+    def run_commands(self, commands):
+        # Run an iterable of g-code lines and/or (line, cmd, coords)
+        # tuples from parse_fast_move() - the caller must hold the mutex
+        self._process_commands(commands, need_ack=False)
     def run_script(self, script):
         with self.mutex:
             self._process_commands(script.split('\n'), need_ack=False)
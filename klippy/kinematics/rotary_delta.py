@@ -144,15 +144,27 @@ class RotaryDeltaCalibration:
         self.lower_arms = lower_arms
         self.endstops = endstops
         self.stepdists = stepdists
+        self._alloc_steppers()
         # Calculate the absolute angle of each endstop
-        ffi_main, self.ffi_lib = chelper.get_ffi()
-        self.sks = [ffi_main.gc(self.ffi_lib.rotary_delta_stepper_alloc(
-            shoulder_radius, shoulder_height, math.radians(a), ua, la),
-                                self.ffi_lib.free)
-                    for a, ua, la in zip(angles, upper_arms, lower_arms)]
         self.abs_endstops = [
             self.ffi_lib.itersolve_calc_position_from_coord(sk, 0., 0., es)
             for sk, es in zip(self.sks, endstops)]
+    def _alloc_steppers(self):
+        ffi_main, self.ffi_lib = chelper.get_ffi()
+        self.sks = [ffi_main.gc(self.ffi_lib.rotary_delta_stepper_alloc(
+            self.shoulder_radius, self.shoulder_height, math.radians(a),
+            ua, la), self.ffi_lib.free)
+                    for a, ua, la in zip(self.angles, self.upper_arms,
+                                         self.lower_arms)]
+    def __getstate__(self):
+        # The C helper objects can not be passed to a background process
+        state = dict(self.__dict__)
+        state.pop('ffi_lib', None)
+        state.pop('sks', None)
+        return state
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._alloc_steppers()
     def coordinate_descent_params(self, is_extended):
         # Determine adjustment parameters (for use with coordinate_descent)
         adj_params = ('shoulder_height', 'endstop_a', 'endstop_b', 'endstop_c')
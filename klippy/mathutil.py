@@ -3,8 +3,8 @@
 # Copyright (C) 2018-2019  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math, logging, multiprocessing, traceback
-import queuelogger
+import math, logging
+import workerpool
 
 
 ######################################################################
@@ -48,39 +48,12 @@ def coordinate_descent(adj_params, params, error_func):
     return params
 
 # Helper to run the coordinate descent function in a background
-# process so that it does not block the main thread.
+# process so that it does not block the main thread.  The error_func
+# must be picklable (see workerpool.py).
 def background_coordinate_descent(printer, adj_params, params, error_func):
-    parent_conn, child_conn = multiprocessing.Pipe()
-    def wrapper():
-        queuelogger.clear_bg_logging()
-        try:
-            res = coordinate_descent(adj_params, params, error_func)
-        except:
-            child_conn.send((True, traceback.format_exc()))
-            child_conn.close()
-            return
-        child_conn.send((False, res))
-        child_conn.close()
-    # Start a process to perform the calculation
-    calc_proc = multiprocessing.Process(target=wrapper)
-    calc_proc.daemon = True
-    calc_proc.start()
-    # Wait for the process to finish
-    reactor = printer.get_reactor()
-    gcode = printer.lookup_object("gcode")
-    eventtime = last_report_time = reactor.monotonic()
-    while calc_proc.is_alive():
-        if eventtime > last_report_time + 5.:
-            last_report_time = eventtime
-            gcode.respond_info("Working on calibration...", log=False)
-        eventtime = reactor.pause(eventtime + .1)
-    # Return results
-    is_err, res = parent_conn.recv()
-    if is_err:
-        raise Exception("Error in coordinate descent: %s" % (res,))
-    calc_proc.join()
-    parent_conn.close()
-    return res
+    pool = workerpool.lookup_worker_pool(printer)
+    return pool.run(coordinate_descent, (adj_params, params, error_func),
+                    "Working on calibration...")
 
 
 ######################################################################
@@ -153,6 +153,79 @@ def convert_msg_format(msgformat):
         msgformat = msgformat.replace(c, '%s')
     return msgformat
 
+# Generate python code that parses or encodes a message with the given
+# parameter layout (the VLQ integer decoding is unrolled)
+def _gen_parse_param(i, t, code):
+    pt = t
+    if isinstance(t, Enumeration):
+        pt = t.pt
+    if pt.is_dynamic_string:
+        code += ["l = s[pos]",
+                 "p%d = bytes(bytearray(s[pos+1:pos+l+1]))" % (i,),
+                 "pos += l + 1"]
+        return
+    code += ["c = s[pos]", "pos += 1", "v = c & 0x7f",
+             "if (c & 0x60) == 0x60:", "    v |= -0x20"]
+    indent = ""
+    for j in range(pt.max_length - 1):
+        # Use a loop at the last level to handle over-long encodings
+        test = "if" if j < pt.max_length - 2 else "while"
+        code += [indent + test + " c & 0x80:",
+                 indent + "    c = s[pos]",
+                 indent + "    pos += 1",
+                 indent + "    v = (v<<7) | (c & 0x7f)"]
+        indent += "    "
+    if not pt.signed:
+        code.append("v = int(v & 0xffffffff)")
+    if pt is t:
+        code.append("p%d = v" % (i,))
+    else:
+        code += ["p%d = reverse_enums%d.get(v)" % (i, i),
+                 "if p%d is None:" % (i,),
+                 "    p%d = '?%%d' %% (v,)" % (i,)]
+
+def _gen_encode_param(i, t, code):
+    code.append("v = params[%d]" % (i,))
+    pt = t
+    if isinstance(t, Enumeration):
+        pt = t.pt
+        code += ["tv = enums%d.get(v)" % (i,),
+                 "if tv is None:",
+                 "    raise error(\"Unknown value '%%s' in enumeration '%%s'\""
+                 " %% (v, %r))" % (t.enum_name,),
+                 "v = tv"]
+    if pt.is_dynamic_string:
+        code += ["out.append(len(v))", "out.extend(bytearray(v))"]
+        return
+    code += ["if v >= 0xc000000 or v < -0x4000000:"
+             " out.append((v>>28) & 0x7f | 0x80)",
+             "if v >= 0x180000 or v < -0x80000:"
+             " out.append((v>>21) & 0x7f | 0x80)",
+             "if v >= 0x3000 or v < -0x1000:"
+             " out.append((v>>14) & 0x7f | 0x80)",
+             "if v >= 0x60 or v < -0x20:"
+             " out.append((v>>7) & 0x7f | 0x80)",
+             "out.append(v & 0x7f)"]
+
+def build_message_funcs(msgid, param_names):
+    env = {'error': error}
+    parse_code = ["pos += 1"]
+    encode_code = ["out = [%d]" % (msgid,)]
+    for i, (name, t) in enumerate(param_names):
+        if isinstance(t, Enumeration):
+            env['enums%d' % (i,)] = t.enums
+            env['reverse_enums%d' % (i,)] = t.reverse_enums
+        _gen_parse_param(i, t, parse_code)
+        _gen_encode_param(i, t, encode_code)
+    parse_code.append("return {%s}, pos" % (", ".join(
+        ["%r: p%d" % (name, i) for i, (name, t) in enumerate(param_names)])))
+    encode_code.append("return out")
+    code = "\n".join(
+        ["def parse(s, pos):"] + ["    " + l for l in parse_code]
+        + ["def encode(params):"] + ["    " + l for l in encode_code])
+    exec(compile(code, "<msgproto>", "exec"), env)
+    return env['parse'], env['encode']
+
 class MessageFormat:
     def __init__(self, msgid, msgformat, enumerations={}):
         self.msgid = msgid
@@ -162,6 +235,8 @@ class MessageFormat:
         self.param_names = lookup_params(msgformat, enumerations)
         self.param_types = [t for name, t in self.param_names]
         self.name_to_type = dict(self.param_names)
+        # Replace the generic parse() and encode() methods
+        self.parse, self.encode = build_message_funcs(msgid, self.param_names)
     def encode(self, params):
         out = []
         out.append(self.msgid)
@@ -3,7 +3,8 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, gc, select, math, time, logging, Queue as queue
+import os, gc, select, math, time, logging, heapq, threading
+import Queue as queue
 import greenlet
 import chelper, util
 
@@ -14,6 +15,8 @@ class ReactorTimer:
     def __init__(self, callback, waketime):
         self.callback = callback
         self.waketime = waketime
+        self.heap_entry = None
+        self.profile_stats = None
 
 class ReactorCompletion:
     class sentinel: pass
@@ -49,6 +52,67 @@ class ReactorCallback:
         self.completion.complete(res)
         return self.reactor.NEVER
 
+# Per-callback run time statistics (see SelectReactor.enable_profiling())
+PROFILE_BUCKETS = 24
+PROFILE_MIN_EXP = -20 # First histogram bucket holds durations < 2**-20s
+
+class ReactorProfiler:
+    def __init__(self):
+        self.stats = {}
+        self.fd_stats = {}
+        self.interval_max = (0., None)
+        self.interval_busy = 0.
+    def _get_name(self, callback):
+        obj = getattr(callback, '__self__', None)
+        if isinstance(obj, ReactorCallback):
+            callback = obj.callback
+            obj = getattr(callback, '__self__', None)
+        if isinstance(obj, greenlet.greenlet):
+            return "greenlet_resume"
+        name = getattr(callback, '__name__', None)
+        if name is None:
+            return repr(callback)
+        if obj is not None:
+            return "%s.%s" % (obj.__class__.__name__, name)
+        return "%s.%s" % (getattr(callback, '__module__', None), name)
+    def lookup_stats(self, callback):
+        name = self._get_name(callback)
+        stats = self.stats.get(name)
+        if stats is None:
+            # [name, count, total, max, histogram]
+            stats = self.stats[name] = [name, 0, 0., 0., [0]*PROFILE_BUCKETS]
+        return stats
+    def lookup_fd_stats(self, callback):
+        stats = self.fd_stats.get(callback)
+        if stats is None:
+            stats = self.fd_stats[callback] = self.lookup_stats(callback)
+        return stats
+    def note(self, stats, duration):
+        stats[1] += 1
+        stats[2] += duration
+        if duration > stats[3]:
+            stats[3] = duration
+        bucket = math.frexp(duration)[1] - PROFILE_MIN_EXP
+        stats[4][min(PROFILE_BUCKETS - 1, max(0, bucket))] += 1
+        self.interval_busy += duration
+        if duration > self.interval_max[0]:
+            self.interval_max = (duration, stats[0])
+    def reset(self):
+        for stats in self.stats.values():
+            stats[1:] = [0, 0., 0., [0]*PROFILE_BUCKETS]
+    def get_histogram_bounds(self):
+        return [2.**(i + PROFILE_MIN_EXP) for i in range(PROFILE_BUCKETS)]
+    def get_profile(self):
+        return {name: {'count': count, 'total': total, 'max': max_time,
+                       'histogram': list(hist)}
+                for name, count, total, max_time, hist in self.stats.values()
+                if count}
+    def pop_interval(self):
+        res = self.interval_busy, self.interval_max
+        self.interval_busy = 0.
+        self.interval_max = (0., None)
+        return res
+
 class ReactorFileHandler:
     def __init__(self, fd, callback):
         self.fd = fd
@@ -71,6 +135,8 @@ class ReactorMutex:
         self.unlock = self.__exit__
     def test(self):
         return self.is_locked
+    def test_waiting(self):
+        return not not self.queue
     def __enter__(self):
         if not self.is_locked:
             self.is_locked = True
@@ -101,35 +167,80 @@ class SelectReactor:
         self._check_gc = gc_checking
         self._last_gc_times = [0., 0., 0.]
         # Timers
-        self._timers = []
+        self._timers = set()
+        self._timer_heap = []
+        self._timer_pending = []
+        self._timer_seq = 0
+        self._last_timer_check = 0.
         self._next_timer = self.NEVER
         # Callbacks
         self._pipe_fds = None
         self._async_queue = queue.Queue()
+        self._async_lock = threading.Lock()
+        self._async_signaled = self._async_deferred = False
+        self._async_batches = 0
         # File descriptors
         self._fds = []
         # Greenlets
         self._g_dispatch = None
         self._greenlets = []
         self._all_greenlets = []
+        # Profiling
+        self._profiler = None
     def get_gc_stats(self):
         return tuple(self._last_gc_times)
+    def enable_profiling(self):
+        # Record the run time of each timer and file descriptor callback
+        if self._profiler is None:
+            self._profiler = ReactorProfiler()
+        return self._profiler
+    def _run_profiled(self, stats, callback, eventtime):
+        g_dispatch = self._g_dispatch
+        start = self.monotonic()
+        res = callback(eventtime)
+        if g_dispatch is self._g_dispatch:
+            # Only note callbacks that did not pause
+            self._profiler.note(stats, self.monotonic() - start)
+        return res
     # Timers
-    def update_timer(self, timer_handler, waketime):
+    def _schedule_timer(self, timer_handler, waketime):
         timer_handler.waketime = waketime
+        if waketime >= self.NEVER:
+            # Any existing heap entry is now stale
+            timer_handler.heap_entry = None
+            return
+        self._timer_seq += 1
+        entry = timer_handler.heap_entry = (waketime, self._timer_seq,
+                                            timer_handler)
+        if waketime <= self._last_timer_check:
+            # Timer is already due - run it in the next _check_timers() pass
+            self._timer_pending.append(entry)
+        else:
+            heapq.heappush(self._timer_heap, entry)
+            if len(self._timer_heap) > 2 * len(self._timers) + 64:
+                self._compact_timers()
         self._next_timer = min(self._next_timer, waketime)
+    def _compact_timers(self):
+        # Remove stale entries from the timer heap
+        pending = set(self._timer_pending)
+        heap = [t.heap_entry for t in self._timers
+                if t.heap_entry is not None and t.heap_entry not in pending]
+        heapq.heapify(heap)
+        self._timer_heap[:] = heap
+    def update_timer(self, timer_handler, waketime):
+        if timer_handler in self._timers:
+            self._schedule_timer(timer_handler, waketime)
+        else:
+            timer_handler.waketime = waketime
     def register_timer(self, callback, waketime=NEVER):
         timer_handler = ReactorTimer(callback, waketime)
-        timers = list(self._timers)
-        timers.append(timer_handler)
-        self._timers = timers
-        self._next_timer = min(self._next_timer, waketime)
+        self._timers.add(timer_handler)
+        self._schedule_timer(timer_handler, waketime)
         return timer_handler
     def unregister_timer(self, timer_handler):
         timer_handler.waketime = self.NEVER
-        timers = list(self._timers)
-        timers.pop(timers.index(timer_handler))
-        self._timers = timers
+        timer_handler.heap_entry = None
+        self._timers.remove(timer_handler)
     def _check_timers(self, eventtime, busy):
         if eventtime < self._next_timer:
             if busy:
@@ -148,17 +259,36 @@ class SelectReactor:
                     return 0.
             return min(1., max(.001, self._next_timer - eventtime))
         self._next_timer = self.NEVER
+        self._last_timer_check = eventtime
+        heap = self._timer_heap
+        for entry in self._timer_pending:
+            heapq.heappush(heap, entry)
+        self._timer_pending = []
         g_dispatch = self._g_dispatch
-        for t in self._timers:
-            waketime = t.waketime
-            if eventtime >= waketime:
-                t.waketime = self.NEVER
-                t.waketime = waketime = t.callback(eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._next_timer = min(self._next_timer, waketime)
-                    self._end_greenlet(g_dispatch)
-                    return 0.
-            self._next_timer = min(self._next_timer, waketime)
+        while heap and heap[0][0] <= eventtime:
+            entry = heapq.heappop(heap)
+            t = entry[2]
+            if t.heap_entry is not entry:
+                # Stale entry (timer was rescheduled or unregistered)
+                continue
+            t.heap_entry = None
+            t.waketime = self.NEVER
+            if self._profiler is None:
+                waketime = t.callback(eventtime)
+            else:
+                if t.profile_stats is None:
+                    t.profile_stats = self._profiler.lookup_stats(t.callback)
+                waketime = self._run_profiled(t.profile_stats, t.callback,
+                                              eventtime)
+            if t in self._timers:
+                self._schedule_timer(t, waketime)
+            else:
+                t.waketime = waketime
+            if g_dispatch is not self._g_dispatch:
+                self._end_greenlet(g_dispatch)
+                return 0.
+        if heap:
+            self._next_timer = min(self._next_timer, heap[0][0])
         return 0.
     # Callbacks and Completions
     def completion(self):
@@ -167,24 +297,44 @@ class SelectReactor:
         rcb = ReactorCallback(self, callback, waketime)
         return rcb.completion
     # Asynchronous (from another thread) callbacks and completions
-    def register_async_callback(self, callback, waketime=NOW):
-        self._async_queue.put_nowait(
-            (ReactorCallback, (self, callback, waketime)))
+    def _async_wake(self):
+        # Only write to the pipe if a wakeup is not already pending
+        with self._async_lock:
+            if self._async_batches:
+                self._async_deferred = True
+                return
+            if self._async_signaled:
+                return
+            self._async_signaled = True
         try:
             os.write(self._pipe_fds[1], '.')
         except os.error:
             pass
+    def register_async_callback(self, callback, waketime=NOW):
+        self._async_queue.put_nowait(
+            (ReactorCallback, (self, callback, waketime)))
+        self._async_wake()
     def async_complete(self, completion, result):
         self._async_queue.put_nowait((completion.complete, (result,)))
-        try:
-            os.write(self._pipe_fds[1], '.')
-        except os.error:
-            pass
+        self._async_wake()
+    def async_batch_begin(self):
+        # Defer wakeups from async calls until async_batch_end()
+        with self._async_lock:
+            self._async_batches += 1
+    def async_batch_end(self):
+        with self._async_lock:
+            self._async_batches -= 1
+            if self._async_batches or not self._async_deferred:
+                return
+            self._async_deferred = False
+        self._async_wake()
     def _got_pipe_signal(self, eventtime):
         try:
             os.read(self._pipe_fds[0], 4096)
         except os.error:
             pass
+        with self._async_lock:
+            self._async_signaled = False
         while 1:
             try:
                 func, args = self._async_queue.get_nowait()
@@ -196,6 +346,7 @@ class SelectReactor:
         util.set_nonblock(self._pipe_fds[0])
         util.set_nonblock(self._pipe_fds[1])
         self.register_fd(self._pipe_fds[0], self._got_pipe_signal)
+        self._async_signaled = False
     # Greenlets
     def _sys_pause(self, waketime):
         # Pause using system sleep for when reactor not running
@@ -254,7 +405,12 @@ class SelectReactor:
             eventtime = self.monotonic()
             for fd in res[0]:
                 busy = True
-                fd.callback(eventtime)
+                if self._profiler is None:
+                    fd.callback(eventtime)
+                else:
+                    self._run_profiled(
+                        self._profiler.lookup_fd_stats(fd.callback),
+                        fd.callback, eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -313,7 +469,13 @@ class PollReactor(SelectReactor):
             eventtime = self.monotonic()
             for fd, event in res:
                 busy = True
-                self._fds[fd](eventtime)
+                callback = self._fds[fd]
+                if self._profiler is None:
+                    callback(eventtime)
+                else:
+                    self._run_profiled(
+                        self._profiler.lookup_fd_stats(callback),
+                        callback, eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -350,7 +512,13 @@ class EPollReactor(SelectReactor):
             eventtime = self.monotonic()
             for fd, event in res:
                 busy = True
-                self._fds[fd](eventtime)
+                callback = self._fds[fd]
+                if self._profiler is None:
+                    callback(eventtime)
+                else:
+                    self._run_profiled(
+                        self._profiler.lookup_fd_stats(callback),
+                        callback, eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
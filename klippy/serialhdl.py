@@ -13,6 +13,7 @@ class error(Exception):
 
 class SerialReader:
     BITS_PER_BYTE = 10.
+    PULL_BATCH = 32
     def __init__(self, reactor, serialport, baud, rts=True):
         self.reactor = reactor
         self.serialport = serialport
@@ -31,34 +32,73 @@ class SerialReader:
         self.background_thread = None
         # Message handlers
         self.handlers = {}
+        self.bulk_handlers = {}
         self.register_response(self._handle_unknown_init, '#unknown')
         self.register_response(self.handle_output, '#output')
         # Sent message notification tracking
         self.last_notify_id = 0
         self.pending_notifications = {}
     def _bg_thread(self):
-        response = self.ffi_main.new('struct pull_queue_message *')
+        responses = self.ffi_main.new('struct pull_queue_message[%d]'
+                                      % (self.PULL_BATCH,))
         while 1:
-            self.ffi_lib.serialqueue_pull(self.serialqueue, response)
-            count = response.len
+            count = self.ffi_lib.serialqueue_pull_batch(
+                self.serialqueue, responses, len(responses))
             if count < 0:
                 break
+            # Coalesce reactor wakeups to one per batch of messages
+            self.reactor.async_batch_begin()
+            try:
+                self._handle_batch(responses, count)
+            finally:
+                self.reactor.async_batch_end()
+    def _flush_bulk(self, bulk_order, bulk_msgs):
+        # Deliver the pending messages for bulk handlers as a list
+        for hdl in bulk_order:
+            try:
+                with self.lock:
+                    hdl(bulk_msgs[hdl])
+            except:
+                logging.exception("Exception in serial callback")
+        del bulk_order[:]
+        bulk_msgs.clear()
+    def _handle_batch(self, responses, count):
+        bulk_order = []
+        bulk_msgs = {}
+        for i in range(count):
+            response = responses[i]
             if response.notify_id:
+                # Preserve wire order - flush bulk messages received earlier
+                if bulk_order:
+                    self._flush_bulk(bulk_order, bulk_msgs)
                 params = {'#sent_time': response.sent_time,
                           '#receive_time': response.receive_time}
                 completion = self.pending_notifications.pop(response.notify_id)
                 self.reactor.async_complete(completion, params)
                 continue
-            params = self.msgparser.parse(response.msg[0:count])
+            params = self.msgparser.parse(response.msg[0:response.len])
             params['#sent_time'] = response.sent_time
             params['#receive_time'] = response.receive_time
             hdl = (params['#name'], params.get('oid'))
+            with self.lock:
+                bulk_hdl = self.bulk_handlers.get(hdl)
+            if bulk_hdl is not None:
+                msgs = bulk_msgs.get(bulk_hdl)
+                if msgs is None:
+                    msgs = bulk_msgs[bulk_hdl] = []
+                    bulk_order.append(bulk_hdl)
+                msgs.append(params)
+                continue
+            if bulk_order:
+                self._flush_bulk(bulk_order, bulk_msgs)
             try:
                 with self.lock:
                     hdl = self.handlers.get(hdl, self.handle_default)
                     hdl(params)
             except:
                 logging.exception("Exception in serial callback")
+        if bulk_order:
+            self._flush_bulk(bulk_order, bulk_msgs)
     def _get_identify_data(self, eventtime):
         # Query the "data dictionary" from the micro-controller
         identify_data = ""
@@ -159,11 +199,18 @@ class SerialReader:
     def get_default_command_queue(self):
         return self.default_cmd_queue
     # Serial response callbacks
-    def register_response(self, callback, name, oid=None):
+    def register_response(self, callback, name, oid=None, bulk=False):
+        # A 'bulk' callback is passed a list of the messages received
+        # together instead of being called once per message
         with self.lock:
             if callback is None:
-                del self.handlers[name, oid]
+                self.handlers.pop((name, oid), None)
+                self.bulk_handlers.pop((name, oid), None)
+            elif bulk:
+                self.handlers.pop((name, oid), None)
+                self.bulk_handlers[name, oid] = callback
             else:
+                self.bulk_handlers.pop((name, oid), None)
                 self.handlers[name, oid] = callback
     # Command sending
     def raw_send(self, cmd, minclock, reqclock, cmd_queue):
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math, logging, collections
+import math, logging, collections, threading, Queue as queue
 import chelper
 
 class error(Exception):
@@ -43,6 +43,7 @@ class MCU_stepper:
         self._itersolve_generate_steps = ffi_lib.itersolve_generate_steps
         self._itersolve_check_active = ffi_lib.itersolve_check_active
         self._trapq = ffi_main.NULL
+        self._step_pool = None
     def get_mcu(self):
         return self._mcu
     def get_name(self, short=False):
@@ -159,6 +160,8 @@ class MCU_stepper:
         return old_tq
     def add_active_callback(self, cb):
         self._active_callbacks.append(cb)
+    def set_step_generation_pool(self, pool):
+        self._step_pool = pool
     def generate_steps(self, flush_time):
         # Check for activity if necessary
         if self._active_callbacks:
@@ -170,6 +173,10 @@ class MCU_stepper:
                 for cb in cbs:
                     cb(ret)
         # Generate steps
+        pool = self._step_pool
+        if pool is not None and pool.submit(self._stepper_kinematics,
+                                            flush_time):
+            return
         ret = self._itersolve_generate_steps(self._stepper_kinematics,
                                              flush_time)
         if ret:
@@ -178,6 +185,63 @@ class MCU_stepper:
         ffi_main, ffi_lib = chelper.get_ffi()
         return ffi_lib.itersolve_is_active_axis(self._stepper_kinematics, axis)
 
+# Run the itersolve step generation of steppers in background threads.
+# Each stepper only updates its own stepcompress queue (and the C code
+# releases the GIL), so steppers can be processed in any order.  The
+# results are only flushed to the mcus after finish() returns.
+class StepGenerationPool:
+    def __init__(self, num_threads):
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self._itersolve_generate_steps = ffi_lib.itersolve_generate_steps
+        self._jobs = queue.Queue()
+        self._errors = []
+        self._active = False
+        self._threads = []
+        for i in range(num_threads):
+            t = threading.Thread(target=self._worker,
+                                 name="step-generation-%d" % (i,))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+    def _worker(self):
+        while 1:
+            job = self._jobs.get()
+            if job is None:
+                # Thread exit request from stop()
+                self._jobs.task_done()
+                break
+            sk, flush_time = job
+            try:
+                if self._itersolve_generate_steps(sk, flush_time):
+                    self._errors.append(sk)
+            except:
+                logging.exception("Exception in step generation thread")
+                self._errors.append(sk)
+            self._jobs.task_done()
+    def begin(self):
+        # Steppers submit their step generation until finish() is called
+        self._active = True
+    def submit(self, stepper_kinematics, flush_time):
+        if not self._active:
+            return False
+        self._jobs.put((stepper_kinematics, flush_time))
+        return True
+    def finish(self):
+        self._active = False
+        self._jobs.join()
+        if self._errors:
+            del self._errors[:]
+            raise error("Internal error in stepcompress")
+    def stop(self):
+        # Stop the worker threads (the pool can not be used afterwards)
+        self._active = False
+        threads = self._threads
+        self._threads = []
+        for t in threads:
+            self._jobs.put(None)
+        for t in threads:
+            t.join()
+
 # Helper code to build a stepper object from a config section
 def PrinterStepper(config, units_in_radians=False):
     printer = config.get_printer()
@@ -191,6 +255,8 @@ def PrinterStepper(config, units_in_radians=False):
     step_dist = parse_step_distance(config, units_in_radians, True)
     mcu_stepper = MCU_stepper(name, step_pin_params, dir_pin_params, step_dist,
                               units_in_radians)
+    mcu_stepper.set_step_generation_pool(
+        printer.lookup_object('step_generation_pool', None))
     # Support for stepper enable pin handling
     stepper_enable = printer.load_object(config, 'stepper_enable')
     stepper_enable.register_stepper(mcu_stepper, config.get('enable_pin', None))
@@ -4,30 +4,40 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import math, logging, importlib
-import mcu, chelper, kinematics.extruder
+import mcu, chelper, stepper, kinematics.extruder
 
 # Common suffixes: _d is distance (in mm), _v is velocity (in
 #   mm/second), _v2 is velocity squared (mm^2/s^2), _t is time (in
 #   seconds), _r is ratio (scalar between 0.0 and 1.0)
 
-# Class to track each move request
-class Move:
+# Class to track each move request.  Many moves may be created per
+# second, so attribute storage is fixed (__slots__) and the per-axis
+# values are stored in tuples (which the garbage collector can ignore).
+class Move(object):
+    __slots__ = (
+        'toolhead', 'start_pos', 'end_pos', 'accel', 'timing_callbacks',
+        'is_kinematic_move', 'axes_d', 'move_d', 'axes_r', 'min_move_t',
+        'max_start_v2', 'max_cruise_v2', 'delta_v2', 'max_smoothed_v2',
+        'smooth_delta_v2', 'start_v', 'cruise_v', 'end_v',
+        'accel_t', 'cruise_t', 'decel_t')
     def __init__(self, toolhead, start_pos, end_pos, speed):
         self.toolhead = toolhead
         self.start_pos = tuple(start_pos)
         self.end_pos = tuple(end_pos)
         self.accel = toolhead.max_accel
-        self.timing_callbacks = []
+        self.timing_callbacks = ()
         velocity = min(speed, toolhead.max_velocity)
         self.is_kinematic_move = True
-        self.axes_d = axes_d = [end_pos[i] - start_pos[i] for i in (0, 1, 2, 3)]
-        self.move_d = move_d = math.sqrt(sum([d*d for d in axes_d[:3]]))
+        axes_d = (end_pos[0] - start_pos[0], end_pos[1] - start_pos[1],
+                  end_pos[2] - start_pos[2], end_pos[3] - start_pos[3])
+        move_d = math.sqrt(axes_d[0]*axes_d[0] + axes_d[1]*axes_d[1]
+                           + axes_d[2]*axes_d[2])
         if move_d < .000000001:
             # Extrude only move
             self.end_pos = (start_pos[0], start_pos[1], start_pos[2],
                             end_pos[3])
-            axes_d[0] = axes_d[1] = axes_d[2] = 0.
-            self.move_d = move_d = abs(axes_d[3])
+            axes_d = (0., 0., 0., axes_d[3])
+            move_d = abs(axes_d[3])
             inv_move_d = 0.
             if move_d:
                 inv_move_d = 1. / move_d
@@ -36,7 +46,10 @@ class Move:
             self.is_kinematic_move = False
         else:
             inv_move_d = 1. / move_d
-        self.axes_r = [d * inv_move_d for d in axes_d]
+        self.axes_d = axes_d
+        self.move_d = move_d
+        self.axes_r = (axes_d[0] * inv_move_d, axes_d[1] * inv_move_d,
+                       axes_d[2] * inv_move_d, axes_d[3] * inv_move_d)
         self.min_move_t = move_d / velocity
         # Junction speeds are tracked in velocity squared.  The
         # delta_v2 is the maximum amount of this squared-velocity that
@@ -249,6 +262,13 @@ class ToolHead:
         self.trapq_append = ffi_lib.trapq_append
         self.trapq_free_moves = ffi_lib.trapq_free_moves
         self.step_generators = []
+        self.step_pool = None
+        step_threads = config.getint('step_generation_threads', 0, minval=0)
+        if step_threads:
+            self.step_pool = stepper.StepGenerationPool(step_threads)
+            self.printer.add_object('step_generation_pool', self.step_pool)
+            self.printer.register_event_handler("klippy:disconnect",
+                                                self.step_pool.stop)
         # Create kinematics class
         gcode = self.printer.lookup_object('gcode')
         self.Coord = gcode.Coord
@@ -282,11 +302,20 @@ class ToolHead:
         batch_time = MOVE_BATCH_TIME
         kin_flush_delay = self.kin_flush_delay
         lkft = self.last_kin_flush_time
+        step_pool = self.step_pool
         while 1:
             self.print_time = min(self.print_time + batch_time, next_print_time)
             sg_flush_time = max(lkft, self.print_time - kin_flush_delay)
-            for sg in self.step_generators:
-                sg(sg_flush_time)
+            if step_pool is not None:
+                step_pool.begin()
+                try:
+                    for sg in self.step_generators:
+                        sg(sg_flush_time)
+                finally:
+                    step_pool.finish()
+            else:
+                for sg in self.step_generators:
+                    sg(sg_flush_time)
             free_time = max(lkft, sg_flush_time - kin_flush_delay)
             self.trapq_free_moves(self.trapq, free_time)
             self.extruder.update_move_time(free_time)
@@ -532,6 +561,9 @@ class ToolHead:
         if last_move is None:
             callback(self.get_last_move_time())
             return
+        if not last_move.timing_callbacks:
+            # The callback list is only allocated when needed
+            last_move.timing_callbacks = []
         last_move.timing_callbacks.append(callback)
     def note_kinematic_activity(self, kin_time):
         self.last_kin_move_time = max(self.last_kin_move_time, kin_time)
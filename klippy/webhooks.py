@@ -3,7 +3,7 @@
 # Copyright (C) 2020 Eric Callahan <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license
-import logging, socket, os, sys, errno, json
+import logging, socket, os, sys, errno, json, struct, importlib
 import gcode
 
 # Json decodes strings as unicode types in Python 2.x.  This doesn't
@@ -22,6 +22,112 @@ def byteify(data, ignore_dicts=False):
                 for k, v in data.items()}
     return data
 
+# Maximum amount of unsent data buffered for a client connection
+MAX_SEND_BACKLOG = 4 * 1024 * 1024
+# Delay between attempts to send to a client whose socket buffer is full
+SEND_RETRY_MIN_DELAY = .001
+SEND_RETRY_MAX_DELAY = .100
+
+# Maximum size of a single binary framed message
+MAX_FRAME_SIZE = 1024 * 1024
+
+class JSONCodec:
+    # Default encoding - JSON messages terminated by a 0x03 character
+    name = "json"
+    def split_messages(self, data):
+        # Returns the list of complete messages and any partial data
+        messages = data.split('\x03')
+        return messages, messages.pop()
+    def decode(self, msg):
+        return json.loads(msg, object_hook=byteify)
+    def encode(self, data):
+        return json.dumps(data) + "\x03"
+    def encode_params(self, params):
+        return json.dumps(params)
+    def encode_message(self, template, params_enc):
+        # Encode a response template with an already encoded "params"
+        # field (allows a single encoding of params to be shared)
+        if 'params' in template:
+            template = dict(template)
+            del template['params']
+        if not template:
+            return '{"params": %s}\x03' % (params_enc,)
+        return '%s, "params": %s}\x03' % (json.dumps(template)[:-1],
+                                           params_enc)
+
+class MsgPackCodec:
+    # Optional binary encoding - msgpack messages with a 4 byte
+    # (big-endian) length prefix
+    name = "msgpack"
+    def __init__(self, msgpack):
+        self.msgpack = msgpack
+        is_py2 = sys.version_info[0] < 3
+        self.packer = msgpack.Packer(use_bin_type=not is_py2)
+        self.raw = is_py2
+        self.params_key = self.packer.pack('params')
+    def split_messages(self, data):
+        messages = []
+        pos = 0
+        while len(data) - pos >= 4:
+            size = struct.unpack_from('>I', data, pos)[0]
+            if size > MAX_FRAME_SIZE:
+                raise ValueError("Frame size %d exceeds maximum" % (size,))
+            if len(data) - pos - 4 < size:
+                break
+            messages.append(data[pos + 4:pos + 4 + size])
+            pos += 4 + size
+        return messages, data[pos:]
+    def decode(self, msg):
+        return self.msgpack.unpackb(msg, raw=self.raw)
+    def encode(self, data):
+        msg = self.packer.pack(data)
+        return struct.pack('>I', len(msg)) + msg
+    def encode_params(self, params):
+        return self.packer.pack(params)
+    def encode_message(self, template, params_enc):
+        packer = self.packer
+        items = [k for k in template if k != 'params']
+        out = [packer.pack_map_header(len(items) + 1)]
+        for k in items:
+            out.append(packer.pack(k))
+            out.append(packer.pack(template[k]))
+        out.append(self.params_key)
+        out.append(params_enc)
+        msg = b"".join(out)
+        return struct.pack('>I', len(msg)) + msg
+
+JSON_CODEC = JSONCodec()
+
+def lookup_codecs():
+    # Return the available client encodings
+    codecs = {JSON_CODEC.name: JSON_CODEC}
+    try:
+        msgpack = importlib.import_module('msgpack')
+    except ImportError:
+        msgpack = None
+    if msgpack is not None:
+        codec = MsgPackCodec(msgpack)
+        codecs[codec.name] = codec
+    return codecs
+
+class MessageCache:
+    # Share the encoding of a message between clients
+    def __init__(self, params):
+        self.params = params
+        self.params_enc = {}
+        self.messages = {}
+    def encode(self, codec, template):
+        key = (codec.name, json.dumps(template, sort_keys=True))
+        msg = self.messages.get(key)
+        if msg is None:
+            params_enc = self.params_enc.get(codec.name)
+            if params_enc is None:
+                params_enc = codec.encode_params(self.params)
+                self.params_enc[codec.name] = params_enc
+            msg = codec.encode_message(template, params_enc)
+            self.messages[key] = msg
+        return msg
+
 class WebRequestError(gcode.CommandError):
     def __init__(self, message,):
         Exception.__init__(self, message)
@@ -36,9 +142,8 @@ class Sentinel:
 
 class WebRequest:
     error = WebRequestError
-    def __init__(self, client_conn, request):
+    def __init__(self, client_conn, base_request):
         self.client_conn = client_conn
-        base_request = json.loads(request, object_hook=byteify)
         if type(base_request) != dict:
             raise ValueError("Not a top-level dictionary")
         self.id = base_request.get('id', None)
@@ -104,6 +209,10 @@ class ServerSocket:
         self.reactor = printer.get_reactor()
         self.sock = self.fd_handle = None
         self.clients = {}
+        self.pending_send = {}
+        self.codecs = lookup_codecs()
+        self.send_timer = self.reactor.register_timer(self._do_send)
+        self.send_retry_delay = SEND_RETRY_MIN_DELAY
         start_args = printer.get_start_args()
         server_address = start_args.get('apiserver')
         is_fileinput = (start_args.get('debuginput') is not None)
@@ -149,8 +258,33 @@ class ServerSocket:
                     % (file_path))
                 raise
 
+    def get_encodings(self):
+        return sorted(self.codecs.keys())
+
     def pop_client(self, client_id):
         self.clients.pop(client_id, None)
+        self.pending_send.pop(client_id, None)
+
+    def schedule_send(self, client):
+        if not self.pending_send:
+            self.send_retry_delay = SEND_RETRY_MIN_DELAY
+            self.reactor.update_timer(self.send_timer, self.reactor.NOW)
+        self.pending_send[client.uid] = client
+
+    def _do_send(self, eventtime):
+        # Write queued data to all clients (one socket send per client)
+        pending_send = self.pending_send
+        self.pending_send = {}
+        for uid, client in pending_send.items():
+            if client.flush_send_queue():
+                self.pending_send[uid] = client
+        if self.pending_send:
+            # Socket buffer full - retry with an increasing delay so that
+            # a stalled client does not keep the reactor busy
+            delay = self.send_retry_delay
+            self.send_retry_delay = min(2. * delay, SEND_RETRY_MAX_DELAY)
+            return eventtime + delay
+        return self.reactor.NEVER
 
 class ClientConnection:
     def __init__(self, server, sock):
@@ -162,8 +296,11 @@ class ClientConnection:
         self.sock = sock
         self.fd_handle = self.reactor.register_fd(
             self.sock.fileno(), self.process_received)
-        self.partial_data = self.send_buffer = ""
-        self.is_sending_data = False
+        self.partial_data = ""
+        self.codec = JSON_CODEC
+        self.pending_codec = None
+        self.send_queue = []
+        self.send_size = 0
         self.set_client_info("?", "New connection")
 
     def set_client_info(self, client_info, state_msg=None):
@@ -206,12 +343,17 @@ class ClientConnection:
             # Socket Closed
             self.close()
             return
-        requests = data.split('\x03')
-        requests[0] = self.partial_data + requests[0]
-        self.partial_data = requests.pop()
+        try:
+            requests, self.partial_data = self.codec.split_messages(
+                self.partial_data + data)
+        except ValueError as e:
+            logging.info("webhooks client %s: %s, closing socket",
+                         self.uid, str(e))
+            self.close()
+            return
         for req in requests:
             try:
-                web_request = WebRequest(self, req)
+                web_request = WebRequest(self, self.codec.decode(req))
             except Exception:
                 logging.exception("webhooks: Error decoding Server Request %s"
                                   % (req))
@@ -232,45 +374,75 @@ class ClientConnection:
             web_request.set_error(WebRequestError(str(e)))
             self.printer.invoke_shutdown(msg)
         result = web_request.finish()
-        if result is None:
-            return
-        self.send(result)
+        if result is not None:
+            self.send(result)
+        if self.pending_codec is not None:
+            # Switch encoding after the response to the request is sent
+            self.codec = self.pending_codec
+            self.pending_codec = None
+
+    def set_encoding(self, name):
+        codec = self.server.codecs.get(name)
+        if codec is None:
+            raise WebRequestError("Unsupported encoding '%s'" % (name,))
+        if codec is not self.codec:
+            self.pending_codec = codec
+
+    def get_encoding(self):
+        if self.pending_codec is not None:
+            return self.pending_codec.name
+        return self.codec.name
 
     def send(self, data):
-        self.send_buffer += json.dumps(data) + "\x03"
-        if not self.is_sending_data:
-            self.is_sending_data = True
-            self.reactor.register_callback(self._do_send)
+        self.send_encoded(self.codec.encode(data))
 
-    def _do_send(self, eventtime):
-        retries = 10
-        while self.send_buffer:
-            try:
-                sent = self.sock.send(self.send_buffer)
-            except socket.error as e:
-                if e.errno == errno.EBADF or e.errno == errno.EPIPE \
-                        or not retries:
-                    sent = 0
-                else:
-                    retries -= 1
-                    waketime = self.reactor.monotonic() + .001
-                    self.reactor.pause(waketime)
-                    continue
-            retries = 10
-            if sent > 0:
-                self.send_buffer = self.send_buffer[sent:]
-            else:
-                logging.info(
-                    "webhooks: Error sending server data,  closing socket")
-                self.close()
-                break
-        self.is_sending_data = False
+    def send_cached(self, msg_cache, template):
+        # Queue a message whose encoding may be shared with other clients
+        self.send_encoded(msg_cache.encode(self.codec, template))
+
+    def send_encoded(self, msg):
+        # Queue an already encoded (and terminated) message
+        if self.is_closed():
+            return
+        self.send_queue.append(msg)
+        self.send_size += len(msg)
+        if self.send_size > MAX_SEND_BACKLOG:
+            logging.info("webhooks client %s: send backlog of %d bytes"
+                         " exceeded, closing socket", self.uid, self.send_size)
+            self.close()
+            return
+        self.server.schedule_send(self)
+
+    def flush_send_queue(self):
+        # Returns True if data remains to be sent
+        if self.is_closed() or not self.send_queue:
+            return False
+        data = "".join(self.send_queue)
+        try:
+            sent = self.sock.send(data)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self.send_queue = [data]
+                return True
+            sent = 0
+        if sent <= 0:
+            logging.info(
+                "webhooks: Error sending server data,  closing socket")
+            self.close()
+            return False
+        data = data[sent:]
+        self.send_queue = [data] if data else []
+        self.send_size = len(data)
+        return not not data
 
 class WebHooks:
     def __init__(self, printer):
         self.printer = printer
         self._endpoints = {"list_endpoints": self._handle_list_endpoints}
         self._remote_methods = {}
+        # Status change tracking
+        self._status_dirty = {}
+        self._status_saved_calls = 0
         self.register_endpoint("info", self._handle_info_request)
         self.register_endpoint("emergency_stop", self._handle_estop_request)
         self.register_endpoint("register_remote_method",
@@ -286,15 +458,21 @@ class WebHooks:
         web_request.send({'endpoints': list(self._endpoints.keys())})
 
     def _handle_info_request(self, web_request):
+        cconn = web_request.get_client_connection()
         client_info = web_request.get_dict('client_info', None)
         if client_info is not None:
-            web_request.get_client_connection().set_client_info(client_info)
+            cconn.set_client_info(client_info)
+        encoding = web_request.get_str('encoding', None)
+        if encoding is not None:
+            cconn.set_encoding(encoding)
         state_message, state = self.printer.get_state_message()
         src_path = os.path.dirname(__file__)
         klipper_path = os.path.normpath(os.path.join(src_path, ".."))
         response = {'state': state, 'state_message': state_message,
                     'hostname': socket.gethostname(),
-                    'klipper_path': klipper_path, 'python_path': sys.executable}
+                    'klipper_path': klipper_path, 'python_path': sys.executable,
+                    'encoding': cconn.get_encoding(),
+                    'encodings': self.sconn.get_encodings()}
         start_args = self.printer.get_start_args()
         for sa in ['log_file', 'config_file', 'software_version', 'cpu_info']:
             response[sa] = start_args.get(sa)
@@ -326,6 +504,33 @@ class WebHooks:
         state_message, state = self.printer.get_state_message()
         return {'state': state, 'state_message': state_message}
 
+    def register_status_tracking(self, name):
+        # Printer objects that call mark_status_dirty() whenever their
+        # get_status() result changes are only queried when needed
+        self._status_dirty[name] = None
+
+    def mark_status_dirty(self, name, fields=None):
+        dirty = self._status_dirty.get(name)
+        if fields is None or name not in self._status_dirty:
+            self._status_dirty[name] = None
+        elif dirty is not None:
+            dirty.update(fields)
+
+    def pop_status_dirty(self, name):
+        # Returns False for untracked objects, None if all fields may
+        # have changed, or the set of changed fields
+        if name not in self._status_dirty:
+            return False
+        dirty = self._status_dirty[name]
+        self._status_dirty[name] = set()
+        return dirty
+
+    def note_status_skipped(self, name):
+        self._status_saved_calls += 1
+
+    def stats(self, eventtime):
+        return False, "status_saved_calls=%d" % (self._status_saved_calls,)
+
     def call_remote_method(self, method, **kwargs):
         if method not in self._remote_methods:
             raise self.printer.command_error(
@@ -344,6 +549,34 @@ class WebHooks:
                 "No active connections for method '%s'" % (method))
         self._remote_methods[method] = valid_conns
 
+# Maximum number of queued asynchronous G-Code jobs
+MAX_GCODE_JOBS = 1024
+# Minimum time between progress notifications of a running job
+JOB_PROGRESS_TIME = 1.
+
+class GCodeJob:
+    def __init__(self, job_id, script, priority, cconn, template):
+        self.job_id = job_id
+        self.script = script
+        self.priority = priority
+        self.cconn = cconn
+        self.template = template
+        self.state = "queued"
+        self.is_cancelled = False
+    def get_sort_key(self):
+        # Higher priority jobs run first, then in submission order
+        return (-self.priority, self.job_id)
+    def get_info(self):
+        return {'job_id': self.job_id, 'state': self.state,
+                'priority': self.priority, 'script': self.script}
+    def notify(self, state, **kwargs):
+        self.state = state
+        params = {'job_id': self.job_id, 'state': state}
+        params.update(kwargs)
+        out = dict(self.template)
+        out['params'] = params
+        self.cconn.send(out)
+
 class GCodeHelper:
     def __init__(self, printer):
         self.printer = printer
@@ -351,6 +584,13 @@ class GCodeHelper:
         # Output subscription tracking
         self.is_output_registered = False
         self.clients = {}
+        # Asynchronous job tracking
+        self.jobs = []
+        self.running_job = None
+        self.is_processing_jobs = False
+        self.next_job_id = 1
+        printer.register_event_handler("klippy:shutdown",
+                                       self._handle_shutdown)
         # Register webhooks
         wh = printer.lookup_object('webhooks')
         wh.register_endpoint("gcode/help", self._handle_help)
@@ -360,6 +600,9 @@ class GCodeHelper:
                              self._handle_firmware_restart)
         wh.register_endpoint("gcode/subscribe_output",
                              self._handle_subscribe_output)
+        wh.register_endpoint("gcode/submit", self._handle_submit)
+        wh.register_endpoint("gcode/cancel", self._handle_cancel)
+        wh.register_endpoint("gcode/jobs", self._handle_jobs)
     def _handle_help(self, web_request):
         web_request.send(self.gcode.get_command_help())
     def _handle_script(self, web_request):
@@ -368,14 +611,93 @@ class GCodeHelper:
         self.gcode.run_script('restart')
     def _handle_firmware_restart(self, web_request):
         self.gcode.run_script('firmware_restart')
+    def _handle_submit(self, web_request):
+        script = web_request.get_str('script')
+        priority = web_request.get_int('priority', 0)
+        template = web_request.get_dict('response_template', {})
+        if len(self.jobs) >= MAX_GCODE_JOBS:
+            raise web_request.error("Too many queued G-Code jobs")
+        job = GCodeJob(self.next_job_id, script, priority,
+                       web_request.get_client_connection(), template)
+        self.next_job_id += 1
+        self.jobs.append(job)
+        self.jobs.sort(key=GCodeJob.get_sort_key)
+        if not self.is_processing_jobs:
+            self.is_processing_jobs = True
+            reactor = self.printer.get_reactor()
+            reactor.register_callback(self._process_jobs)
+        web_request.send({'job_id': job.job_id, 'state': job.state})
+    def _handle_cancel(self, web_request):
+        job_id = web_request.get_int('job_id')
+        job = self.running_job
+        if job is not None and job.job_id == job_id:
+            # Stop the running job before its next command
+            job.is_cancelled = True
+            return
+        for job in self.jobs:
+            if job.job_id == job_id:
+                self.jobs.remove(job)
+                job.notify("cancelled")
+                return
+        raise web_request.error("Unknown G-Code job %d" % (job_id,))
+    def _handle_jobs(self, web_request):
+        jobs = list(self.jobs)
+        if self.running_job is not None:
+            jobs.insert(0, self.running_job)
+        web_request.send({'jobs': [job.get_info() for job in jobs]})
+    def _handle_shutdown(self):
+        jobs = self.jobs
+        self.jobs = []
+        for job in jobs:
+            job.notify("cancelled", message="Printer is shutdown")
+    def _run_job(self, job):
+        reactor = self.printer.get_reactor()
+        lines = job.script.split('\n')
+        job.notify("running", line=0, lines=len(lines))
+        next_progress = reactor.monotonic() + JOB_PROGRESS_TIME
+        try:
+            with self.gcode.get_mutex():
+                for i, line in enumerate(lines):
+                    if job.is_cancelled:
+                        job.notify("cancelled", line=i, lines=len(lines))
+                        return
+                    self.gcode.run_script_from_command(line)
+                    eventtime = reactor.monotonic()
+                    if eventtime >= next_progress and i + 1 < len(lines):
+                        job.notify("running", line=i + 1, lines=len(lines))
+                        next_progress = eventtime + JOB_PROGRESS_TIME
+                if job.is_cancelled:
+                    # Cancelled while running the last command
+                    job.notify("cancelled", line=len(lines), lines=len(lines))
+                    return
+        except self.printer.command_error as e:
+            job.notify("error", message=str(e))
+            return
+        except Exception as e:
+            logging.exception("Internal error on G-Code job %d", job.job_id)
+            job.notify("error", message=str(e))
+            return
+        job.notify("complete")
+    def _process_jobs(self, eventtime):
+        while self.jobs:
+            job = self.jobs.pop(0)
+            if job.cconn.is_closed():
+                # The client that submitted the job has disconnected
+                job.state = "cancelled"
+                logging.info("Dropping G-Code job %d of closed client",
+                             job.job_id)
+                continue
+            self.running_job = job
+            self._run_job(job)
+            self.running_job = None
+        self.is_processing_jobs = False
     def _output_callback(self, msg):
+        msg_cache = MessageCache({'response': msg})
         for cconn, template in list(self.clients.items()):
             if cconn.is_closed():
                 del self.clients[cconn]
                 continue
-            tmp = dict(template)
-            tmp['params'] = {'response': msg}
-            cconn.send(tmp)
+            cconn.send_cached(msg_cache, template)
     def _handle_subscribe_output(self, web_request):
         cconn = web_request.get_client_connection()
         template = web_request.get_dict('response_template', {})
@@ -409,6 +731,9 @@ class QueryStatusHelper:
         self.pending_queries = []
         msglist.extend(self.clients.values())
         # Generate get_status() info for each client
+        webhooks = self.printer.lookup_object('webhooks')
+        dirty_fields = {}
+        status_msgs = []
         for cconn, subscription, send_func, template in msglist:
             is_query = cconn is None
             if not is_query and cconn.is_closed():
@@ -419,15 +744,29 @@ class QueryStatusHelper:
             for obj_name, req_items in subscription.items():
                 res = query.get(obj_name, None)
                 if res is None:
-                    po = self.printer.lookup_object(obj_name, None)
-                    if po is None or not hasattr(po, 'get_status'):
-                        res = query[obj_name] = {}
+                    dirty = webhooks.pop_status_dirty(obj_name)
+                    lres = last_query.get(obj_name)
+                    if dirty is not False and not dirty and lres is not None:
+                        # Tracked object that has not changed
+                        webhooks.note_status_skipped(obj_name)
+                        res = query[obj_name] = lres
                     else:
-                        res = query[obj_name] = po.get_status(eventtime)
+                        po = self.printer.lookup_object(obj_name, None)
+                        if po is None or not hasattr(po, 'get_status'):
+                            res = query[obj_name] = {}
+                        else:
+                            res = query[obj_name] = po.get_status(eventtime)
+                    if (dirty is not False and dirty is not None
+                        and lres is not None):
+                        dirty_fields[obj_name] = dirty
                 if req_items is None:
                     req_items = list(res.keys())
                     if req_items:
                         subscription[obj_name] = req_items
+                dirty = dirty_fields.get(obj_name)
+                if dirty is not None and not is_query:
+                    # Only check fields that were reported as changed
+                    req_items = [ri for ri in req_items if ri in dirty]
                 lres = last_query.get(obj_name, {})
                 cres = {}
                 for ri in req_items:
@@ -437,10 +776,20 @@ class QueryStatusHelper:
                 if cres or is_query:
                     cquery[obj_name] = cres
             # Send data
-            if cquery or is_query:
+            if is_query:
                 tmp = dict(template)
                 tmp['params'] = {'eventtime': eventtime, 'status': cquery}
                 send_func(tmp)
+            elif cquery:
+                # Encode each distinct status update only once
+                for prev_cquery, msg_cache in status_msgs:
+                    if prev_cquery == cquery:
+                        break
+                else:
+                    msg_cache = MessageCache({'eventtime': eventtime,
+                                              'status': cquery})
+                    status_msgs.append((cquery, msg_cache))
+                cconn.send_cached(msg_cache, template)
         if not query:
             # Unregister timer if there are no longer any subscriptions
             reactor = self.printer.get_reactor()
@@ -0,0 +1,104 @@
+# Persistent pool of background processes for long calculations
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import logging, multiprocessing, traceback
+import queuelogger
+
+PROGRESS_TIME = 5.
+# Maximum time to wait for a calculation (a worker process may have been
+# killed, in which case the pool never reports a result)
+CALC_TIMEOUT = 900.
+
+# Code run in the worker processes.  Submitted functions and their
+# arguments are pickled, so they must be module level functions (or
+# instances of module level classes).
+def _worker_init():
+    queuelogger.clear_bg_logging()
+
+def _run_job(func, args):
+    try:
+        return False, func(*args)
+    except:
+        return True, traceback.format_exc()
+
+class WorkerPool:
+    def __init__(self, printer):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.pool = None
+        # {completion: multiprocessing AsyncResult}
+        self.pending = {}
+        printer.register_event_handler("klippy:shutdown", self.cancel_all)
+        printer.register_event_handler("klippy:disconnect", self.cancel_all)
+    def _get_pool(self):
+        # The worker processes are forked on first use and then reused
+        if self.pool is None:
+            processes = max(1, multiprocessing.cpu_count() - 1)
+            logging.info("Starting %d background worker processes",
+                         processes)
+            self.pool = multiprocessing.Pool(processes, _worker_init)
+        return self.pool
+    def submit(self, func, args):
+        # Start a calculation and return a completion for its result
+        completion = self.reactor.completion()
+        def handle_result(res):
+            # Called from the pool's result handler thread
+            self.reactor.async_complete(completion, res)
+        self.pending[completion] = self._get_pool().apply_async(
+            _run_job, (func, args), callback=handle_result)
+        return completion
+    def _check_result(self, async_res):
+        # The pool only invokes the callback on success - obtain the
+        # result of a failed job (eg, one that could not be pickled)
+        if async_res is None or not async_res.ready():
+            return None
+        try:
+            return async_res.get(0.)
+        except Exception as e:
+            return True, "%s: %s" % (type(e).__name__, str(e))
+    def wait(self, completion, progress_msg=None, timeout=CALC_TIMEOUT):
+        # Wait for a submitted calculation and return its result
+        gcode = self.printer.lookup_object("gcode")
+        eventtime = self.reactor.monotonic()
+        end_time = eventtime + timeout
+        while 1:
+            res = completion.wait(eventtime + PROGRESS_TIME)
+            if res is not None:
+                break
+            res = self._check_result(self.pending.get(completion))
+            if res is not None:
+                break
+            eventtime = self.reactor.monotonic()
+            if eventtime >= end_time:
+                res = (True, "Timeout after %.0f seconds" % (timeout,))
+                break
+            if progress_msg is not None:
+                gcode.respond_info(progress_msg, log=False)
+        self.pending.pop(completion, None)
+        is_err, res = res
+        if is_err:
+            logging.error("Error in remote calculation:\n%s", res)
+            msg = res.strip().split('\n')[-1]
+            raise self.printer.command_error(
+                "Error in remote calculation: %s" % (msg,))
+        return res
+    def run(self, func, args, progress_msg=None):
+        return self.wait(self.submit(func, args), progress_msg)
+    def cancel_all(self):
+        # Stop the worker processes and fail any outstanding requests
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+        pending = self.pending
+        self.pending = {}
+        for completion in pending:
+            completion.complete((True, "Calculation cancelled"))
+
+def lookup_worker_pool(printer):
+    pool = printer.lookup_object('worker_pool', None)
+    if pool is None:
+        pool = WorkerPool(printer)
+        printer.add_object('worker_pool', pool)
+    return pool
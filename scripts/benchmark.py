@@ -0,0 +1,729 @@
+#!/usr/bin/env python2
+# Micro-benchmarks for host software (klippy) hot paths
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+from __future__ import print_function
+import sys, os, optparse, time, logging, math
+KLIPPY_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                          '..', 'klippy')
+sys.path.append(KLIPPY_DIR)
+sys.path.append(os.path.join(KLIPPY_DIR, 'extras'))
+TEST_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                        '..', 'test', 'klippy')
+
+def report(name, count, duration, units):
+    print("%-32s %10.0f %s/sec (%d in %.3fs)" % (
+        name, count / duration, units, count, duration))
+
+
+######################################################################
+# Minimal printer object
+######################################################################
+
+class DummyMutex:
+    def __enter__(self):
+        pass
+    def __exit__(self, type=None, value=None, tb=None):
+        pass
+
+class DummyReactor:
+    def mutex(self, is_locked=False):
+        return DummyMutex()
+    def monotonic(self):
+        return time.time()
+
+class DummyPrinter:
+    config_error = Exception
+    def __init__(self):
+        import gcode
+        self.command_error = gcode.CommandError
+        self.reactor = DummyReactor()
+        self.objects = {}
+        self.event_handlers = {}
+    def get_start_args(self):
+        return {}
+    def get_reactor(self):
+        return self.reactor
+    def register_event_handler(self, event, callback):
+        self.event_handlers.setdefault(event, []).append(callback)
+    def send_event(self, event, *params):
+        return [cb(*params) for cb in self.event_handlers.get(event, [])]
+    def add_object(self, name, obj):
+        self.objects[name] = obj
+    def lookup_object(self, name, default=None):
+        return self.objects.get(name, default)
+    def load_object(self, config, name, default=None):
+        return self.objects.get(name, default)
+    def invoke_shutdown(self, msg):
+        raise Exception(msg)
+
+class DummyConfig:
+    def __init__(self, printer):
+        self.printer = printer
+    def get_printer(self):
+        return self.printer
+
+
+######################################################################
+# G-Code parsing
+######################################################################
+
+def read_move_gcode(options):
+    fname = options.gcode or os.path.join(TEST_DIR, 'move.gcode')
+    f = open(fname, 'r')
+    lines = f.read().split('\n')
+    f.close()
+    # Only replay the commands implemented by gcode_move
+    handled = ['G0', 'G1', 'G90', 'G91', 'G92', 'M82', 'M83']
+    return [l for l in lines
+            if (l.split(';')[0].split() or ['G1'])[0].upper() in handled]
+
+def setup_gcode_move(move_func):
+    import gcode, gcode_move
+    printer = DummyPrinter()
+    gd = gcode.GCodeDispatch(printer)
+    gd.respond_raw = lambda msg: None
+    printer.add_object('gcode', gd)
+    gm = gcode_move.GCodeMove(DummyConfig(printer))
+    gm.move_with_transform = move_func
+    gd._handle_ready()
+    return gd
+
+def run_gcode(options, name, gd, lines):
+    count = 0
+    start = time.time()
+    while time.time() - start < options.duration:
+        for i in range(100):
+            gd._process_commands(lines, need_ack=False)
+        count += len(lines) * 100
+    report(name, count, time.time() - start, "lines")
+
+def bench_gcode(options):
+    lines = read_move_gcode(options)
+    def count_move(newpos, speed):
+        pass
+    gd = setup_gcode_move(count_move)
+    gd.fast_moves = {}
+    run_gcode(options, "gcode generic parser", gd, lines)
+    gd = setup_gcode_move(count_move)
+    run_gcode(options, "gcode fast move parser", gd, lines)
+
+
+######################################################################
+# Bed mesh move splitting
+######################################################################
+
+class DummyMeshConfig:
+    def getfloat(self, option, default, **kw):
+        return default
+
+class MeshTransform:
+    # Same move splitting as BedMesh.move() with an active mesh
+    def __init__(self, splitter):
+        self.splitter = splitter
+        self.last_position = [0., 0., 0., 0.]
+        self.moves = 0
+    def move(self, newpos, speed):
+        splitter = self.splitter
+        splitter.build_move(self.last_position, newpos, 1.)
+        while not splitter.traverse_complete:
+            splitter.split()
+            self.moves += 1
+        self.last_position[:] = newpos
+
+def bench_bed_mesh(options):
+    from extras import bed_mesh
+    if options.gcode:
+        lines = read_move_gcode(options)
+    else:
+        # Infill lines across a 200x200 bed and a perimeter of 1mm moves
+        lines = ['G90', 'M83', 'G1 Z0.3 F6000']
+        for y in range(10, 190, 2):
+            lines.append('G1 X10 Y%d E0.1' % (y,))
+            lines.append('G1 X190 Y%d E6.0' % (y + 1,))
+        for i in range(566):
+            angle = i * 2. * math.pi / 566.
+            lines.append('G1 X%.3f Y%.3f E0.03' % (
+                100. + 90. * math.cos(angle), 100. + 90. * math.sin(angle)))
+    params = {'min_x': 0., 'max_x': 200., 'min_y': 0., 'max_y': 200.,
+              'x_count': 7, 'y_count': 7, 'mesh_x_pps': 2, 'mesh_y_pps': 2,
+              'algo': 'lagrange', 'tension': .2}
+    mesh = bed_mesh.ZMesh(params)
+    mesh.build_mesh([[.05 * math.sin(x + y) for x in range(7)]
+                     for y in range(7)])
+    def no_move(newpos, speed):
+        pass
+    gd = setup_gcode_move(no_move)
+    run_gcode(options, "gcode G1 without mesh", gd, lines)
+    for use_numpy in [False, True]:
+        splitter = bed_mesh.MoveSplitter(DummyMeshConfig(), None)
+        splitter.initialize(mesh)
+        name = "gcode G1 bed_mesh"
+        if not use_numpy:
+            splitter.np = False
+            name = "gcode G1 bed_mesh (no numpy)"
+        elif splitter._get_numpy() is None:
+            print("%-32s skipped (numpy not available)" % (name,))
+            continue
+        transform = MeshTransform(splitter)
+        gd = setup_gcode_move(transform.move)
+        run_gcode(options, name, gd, lines)
+
+def bench_bed_mesh_sample(options):
+    from extras import bed_mesh
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    sizes = list(range(3, 16, 2))
+    run_time = options.duration / (2. * len(sizes))
+    for algo in ['lagrange', 'bicubic']:
+        for size in sizes:
+            params = {'min_x': 0., 'max_x': 200., 'min_y': 0., 'max_y': 200.,
+                      'x_count': size, 'y_count': size, 'mesh_x_pps': 2,
+                      'mesh_y_pps': 2, 'algo': algo, 'tension': .2}
+            z_matrix = [[.05 * math.sin(x + .7 * y) for x in range(size)]
+                        for y in range(size)]
+            mesh = bed_mesh.ZMesh(params)
+            methods = [("loops", mesh._sample)]
+            if numpy is not None:
+                methods.append(("array", lambda z, mesh=mesh:
+                                mesh._sample_array(numpy, z)))
+            results = []
+            for method, func in methods:
+                count = 0
+                start = time.time()
+                while time.time() - start < run_time:
+                    func(z_matrix)
+                    count += 1
+                duration = time.time() - start
+                report("mesh %s %dx%d %s" % (algo, size, size, method),
+                       count, duration, "meshes")
+                results.append(mesh.mesh_matrix)
+            if results[-1] != results[0]:
+                print("%-32s results differ!" % ("",))
+    if numpy is None:
+        print("%-32s skipped array version (numpy not available)" % ("",))
+
+
+######################################################################
+# Toolhead lookahead
+######################################################################
+
+class DummyToolHead:
+    def __init__(self, printer):
+        import kinematics.extruder
+        self.printer = printer
+        self.extruder = kinematics.extruder.DummyExtruder(printer)
+        self.max_velocity = 300.
+        self.max_accel = 3000.
+        self.max_accel_to_decel = 1500.
+        scv2 = 5.**2
+        self.junction_deviation = scv2 * (math.sqrt(2.) - 1.) / 3000.
+        self.print_time = 0.
+    def _process_moves(self, moves):
+        for move in moves:
+            self.print_time += move.accel_t + move.cruise_t + move.decel_t
+            for cb in move.timing_callbacks:
+                cb(self.print_time)
+
+def bench_lookahead(options):
+    import gc, toolhead
+    # Tiny segments (0.1mm) approximating a circle (as for arcs)
+    points = []
+    for i in range(10000):
+        angle = i * 2. * math.pi / 1257.
+        points.append([100. + 20. * math.cos(angle),
+                       100. + 20. * math.sin(angle), 0.3, i * .004])
+    th = DummyToolHead(DummyPrinter())
+    # Collect garbage in the same way as the klippy reactor
+    gc.disable()
+    gc.collect()
+    collections = [0, 0, 0]
+    gc_time = 0.
+    count = 0
+    start = time.time()
+    while time.time() - start < options.duration:
+        mq = toolhead.MoveQueue(th)
+        mq.set_flush_time(2.)
+        prev = points[0]
+        for i in range(1, len(points)):
+            pos = points[i]
+            mq.add_move(toolhead.Move(th, prev, pos, 100.))
+            prev = pos
+            if not i % 100:
+                gi = gc.get_count()
+                if gi[0] >= 700:
+                    gc_level = 0
+                    if gi[1] >= 10:
+                        gc_level = 1
+                        if gi[2] >= 10:
+                            gc_level = 2
+                    gc_start = time.time()
+                    gc.collect(gc_level)
+                    gc_time += time.time() - gc_start
+                    collections[gc_level] += 1
+        mq.flush()
+        count += len(points) - 1
+    duration = time.time() - start
+    gc.enable()
+    report("lookahead tiny moves", count, duration, "moves")
+    print("%-32s %d/%d/%d gc collections (%.3fs, %.1f%%)" % (
+        "", collections[0], collections[1], collections[2],
+        gc_time, 100. * gc_time / duration))
+
+
+######################################################################
+# Reactor timer dispatch
+######################################################################
+
+def bench_reactor(options):
+    import reactor
+    for count in [10, 100, 1000]:
+        r = reactor.Reactor()
+        dispatches = [0]
+        def busy_timer(eventtime):
+            # Reschedule immediately to measure per-dispatch overhead
+            dispatches[0] += 1
+            return eventtime
+        def idle_timer(eventtime):
+            return eventtime + 1.
+        def stop_timer(eventtime):
+            r.end()
+            return r.NEVER
+        for i in range(count - 2):
+            r.register_timer(idle_timer, r.monotonic() + i / float(count))
+        r.register_timer(busy_timer, r.NOW)
+        r.register_timer(stop_timer, r.monotonic() + options.duration)
+        start = time.time()
+        r.run()
+        duration = time.time() - start
+        r.finalize()
+        report("reactor %d timers" % (count,), dispatches[0], duration,
+               "dispatches")
+        print("%-32s %10.3f usec/dispatch" % (
+            "", duration * 1000000. / dispatches[0]))
+
+
+######################################################################
+# Accelerometer sample decoding
+######################################################################
+
+def bench_adxl345(options):
+    import struct
+    from extras import adxl345
+    # Simulate a 60 second capture at 3200Hz (8 samples per block)
+    raw_samples = []
+    for seq in range(60 * 3200 // 8):
+        data = struct.pack('<24h', *[(seq + i * 37) % 65536 - 32768
+                                     for i in range(24)])
+        raw_samples.append((seq, data))
+    axes_map = [(0, adxl345.SCALE), (1, adxl345.SCALE), (2, -adxl345.SCALE)]
+    def run(name, method):
+        count = 0
+        start = time.time()
+        while time.time() - start < options.duration:
+            res = adxl345.ADXL345Results()
+            res.setup_data(axes_map, raw_samples, len(raw_samples), 0,
+                           0., 0., 60., 60.)
+            samples = method(res)
+            if samples is None:
+                print("%-32s skipped (numpy not available)" % (name,))
+                return
+            count += len(samples)
+        report(name, count, time.time() - start, "samples")
+    run("adxl345 decode_samples", adxl345.ADXL345Results.decode_samples)
+    run("adxl345 decode_samples_array",
+        adxl345.ADXL345Results.decode_samples_array)
+
+
+######################################################################
+# TMC register field decoding
+######################################################################
+
+def bench_tmc_fields(options):
+    from extras import tmc, tmc2209, tmc2208
+    fields = tmc.FieldHelper(tmc2209.Fields, tmc2208.SignedFields,
+                             tmc2208.FieldFormatters)
+    # DRV_STATUS values as seen when monitoring a moving stepper
+    values = [(i * 0x00010000 + (i % 7) * 0x00000101) & 0xffffffff
+              for i in range(32)]
+    def run(name, func):
+        gm.render_hits = gm.render_misses = 0
+        count = 0
+        start = time.time()
+        while time.time() - start < options.duration:
+            for val in values:
+                func(val)
+            count += len(values)
+        report(name, count, time.time() - start, "calls")
+    run("tmc get_field", lambda val: fields.get_field("CS_ACTUAL", val))
+    run("tmc set_field", lambda val: fields.set_field("toff", val & 0xf))
+    run("tmc pretty_format", lambda val: fields.pretty_format(
+        "DRV_STATUS", val))
+    unique = [0]
+    def pretty_unique(val):
+        unique[0] += 1
+        fields.pretty_format("DRV_STATUS", unique[0] & 0xffffffff)
+    run("tmc pretty_format (unique)", pretty_unique)
+
+
+######################################################################
+# MCU message parsing
+######################################################################
+
+SERIAL_RESPONSES = {
+    "clock clock=%u": 80,
+    "stats count=%u sum=%u sumsq=%u": 81,
+    "analog_in_state oid=%c next_clock=%u value=%hu": 82,
+    "trsync_state oid=%c can_trigger=%c trigger_reason=%c clock=%u": 83,
+    "adxl345_data oid=%c sequence=%hu data=%*s": 84,
+    "stepper_position oid=%c pos=%i": 85,
+}
+
+def make_serial_dump(msgparser):
+    # Simulate the responses received during a print with an accelerometer
+    dump = []
+    for i in range(20000):
+        msgs = [("adxl345_data", [3, i & 0xffff, os.urandom(48)])]
+        if not i % 10:
+            msgs.append(("analog_in_state", [1, i * 12345, i & 0x3fff]))
+            msgs.append(("analog_in_state", [2, i * 12345, i & 0x1fff]))
+            msgs.append(("clock", [i * 7654321]))
+        if not i % 100:
+            msgs.append(("stats", [i, i * 1000, i * 100000]))
+            msgs.append(("trsync_state", [4, 1, 0, i * 54321]))
+            msgs.append(("stepper_position", [5, -i * 100]))
+        for name, params in msgs:
+            cmd = msgparser.messages_by_name[name].encode(params)
+            dump.append(msgparser.encode(i, ''.join(map(chr, cmd))))
+    return ''.join(dump)
+
+def bench_msgproto(options):
+    import json, msgproto
+    msgparser = msgproto.MessageParser()
+    if options.dictionary:
+        f = open(options.dictionary, 'rb')
+        msgparser.process_identify(f.read(), decompress=False)
+        f.close()
+    else:
+        msgparser.process_identify(json.dumps({
+            'commands': {}, 'responses': SERIAL_RESPONSES}),
+                                   decompress=False)
+    if options.serial:
+        f = open(options.serial, 'rb')
+        data = f.read()
+        f.close()
+    else:
+        data = make_serial_dump(msgparser)
+    # Split the dump into message blocks
+    blocks = []
+    while data:
+        l = msgparser.check_packet(data)
+        if l <= 0:
+            data = data[1:]
+            continue
+        blocks.append(list(bytearray(data[:l])))
+        data = data[l:]
+    messages_by_id = msgparser.messages_by_id
+    unknown = msgparser.unknown
+    end_size = msgproto.MESSAGE_TRAILER_SIZE
+    def generic_parse(mid, s, pos):
+        if isinstance(mid, msgproto.MessageFormat):
+            return msgproto.MessageFormat.parse(mid, s, pos)
+        return mid.parse(s, pos)
+    def compiled_parse(mid, s, pos):
+        return mid.parse(s, pos)
+    def run(name, parse):
+        count = 0
+        start = time.time()
+        while time.time() - start < options.duration:
+            for s in blocks:
+                # Blocks may hold several messages (eg, host commands)
+                pos = msgproto.MESSAGE_HEADER_SIZE
+                end = len(s) - end_size
+                while pos < end:
+                    mid = messages_by_id.get(s[pos], unknown)
+                    params, pos = parse(mid, s, pos)
+                    count += 1
+        report(name, count, time.time() - start, "messages")
+    run("msgproto generic parse", generic_parse)
+    run("msgproto compiled parse", compiled_parse)
+
+
+######################################################################
+# Template rendering
+######################################################################
+
+PRINT_START = """
+{% set bed_temp = params.BED_TEMP|default(60)|float %}
+{% set extruder_temp = params.EXTRUDER_TEMP|default(210)|float %}
+{% set max_x = printer.configfile.settings.stepper_x.position_max %}
+{% set max_y = printer.configfile.settings.stepper_y.position_max %}
+M140 S{bed_temp}
+M104 S{extruder_temp * 0.75}
+G28
+{% if not printer.bed_mesh.profile_name %}
+BED_MESH_PROFILE LOAD=default
+{% endif %}
+G1 X{max_x / 2} Y{max_y / 2} Z{printer.toolhead.axis_maximum.z / 10} F6000
+M190 S{bed_temp}
+M109 S{extruder_temp}
+G92 E0
+G1 X{printer.gcode_move.homing_origin.x + 5} Y5 Z0.3 F{speed * 60}
+G1 X{max_x - 5} E{max_x / 20} F1500
+"""
+
+class DummyStatus:
+    def __init__(self, status):
+        self.status = status
+    def get_status(self, eventtime):
+        return self.status
+
+class DummyWebhooks:
+    def register_status_tracking(self, name):
+        pass
+    def mark_status_dirty(self, name, fields=None):
+        pass
+
+class DummyDisplay:
+    def draw_text(self, row, col, text, eventtime):
+        pass
+    def draw_progress_bar(self, row, col, width, value):
+        return ""
+
+def setup_status_objects(printer):
+    import gcode
+    Coord = gcode.Coord
+    settings = {}
+    for i in range(40):
+        settings['section%d' % (i,)] = {'option%d' % (j,): float(j)
+                                        for j in range(15)}
+    for axis in 'xyz':
+        settings['stepper_' + axis] = {'position_max': 250., 'step_pin': 'PA1',
+                                       'rotation_distance': 40.}
+    printer.add_object('configfile', DummyStatus({
+        'settings': settings, 'config': {}, 'save_config_pending': False}))
+    mesh = [[.01 * (x - y) for x in range(50)] for y in range(50)]
+    probed = [[.01 * (x + y) for x in range(7)] for y in range(7)]
+    printer.add_object('bed_mesh', DummyStatus({
+        'profile_name': 'default', 'mesh_min': (10., 10.),
+        'mesh_max': (240., 240.), 'probed_matrix': probed,
+        'mesh_matrix': mesh}))
+    printer.add_object('toolhead', DummyStatus({
+        'position': Coord(100., 100., 5., 0.), 'extruder': 'extruder',
+        'estimated_print_time': 1234.5, 'homed_axes': 'xyz',
+        'axis_minimum': Coord(0., 0., 0., 0.),
+        'axis_maximum': Coord(250., 250., 250., 0.)}))
+    printer.add_object('gcode_move', DummyStatus({
+        'speed_factor': 1., 'speed': 100., 'extrude_factor': 1.,
+        'homing_origin': Coord(0., 0., 0., 0.),
+        'position': Coord(100., 100., 5., 0.),
+        'gcode_position': Coord(100., 100., 5., 0.)}))
+    printer.add_object('extruder', DummyStatus({
+        'temperature': 205.3, 'target': 210., 'power': .5}))
+    printer.add_object('heater_bed', DummyStatus({
+        'temperature': 59.8, 'target': 60., 'power': .3}))
+    printer.add_object('fan', DummyStatus({'speed': .5, 'rpm': None}))
+    printer.add_object('idle_timeout', DummyStatus({
+        'state': 'Printing', 'printing_time': 3600.}))
+    printer.add_object('display_status', DummyStatus({
+        'progress': .4, 'message': None}))
+
+# Original template context (deep copy of each get_status() result)
+class DeepCopyStatusWrapper:
+    def __init__(self, printer, eventtime=None, *args):
+        self.printer = printer
+        self.eventtime = eventtime
+        self.cache = {}
+        self.trackers = None
+    def __getitem__(self, val):
+        import copy
+        sval = str(val).strip()
+        if sval in self.cache:
+            return self.cache[sval]
+        po = self.printer.lookup_object(sval, None)
+        if po is None or not hasattr(po, 'get_status'):
+            raise KeyError(val)
+        if self.eventtime is None:
+            self.eventtime = self.printer.get_reactor().monotonic()
+        self.cache[sval] = res = copy.deepcopy(po.get_status(self.eventtime))
+        return res
+    def __contains__(self, val):
+        try:
+            self.__getitem__(val)
+        except KeyError as e:
+            return False
+        return True
+
+def bench_template(options):
+    import gcode, configfile
+    from extras import gcode_macro
+    from extras.display import display
+    printer = DummyPrinter()
+    printer.add_object('gcode', gcode.GCodeDispatch(printer))
+    printer.add_object('webhooks', DummyWebhooks())
+    pconfig = configfile.PrinterConfig(printer)
+    dconfig = pconfig.read_config(
+        os.path.join(KLIPPY_DIR, 'extras', 'display', 'display.cfg'))
+    gm = gcode_macro.PrinterGCodeMacro(DummyConfig(printer))
+    printer.add_object('gcode_macro', gm)
+    setup_status_objects(printer)
+    print_start = gcode_macro.TemplateWrapper(printer, gm.env, "print_start",
+                                              PRINT_START)
+    templates = {}
+    for c in dconfig.get_prefix_sections('display_template '):
+        dt = display.DisplayTemplate(c)
+        templates[dt.name] = dt
+    group = display.DisplayGroup(
+        dconfig, '_default_16x4',
+        dconfig.get_prefix_sections('display_data _default_16x4 '))
+    lcd = DummyDisplay()
+    mconfig = pconfig.read_config(
+        os.path.join(KLIPPY_DIR, 'extras', 'display', 'menu.cfg'))
+    fanspeed = mconfig.getsection('menu __main __control __fanspeed')
+    menu_tpls = [gm.load_template(fanspeed, option)
+                 for option in ['input', 'enable', 'name']]
+    def run_print_start():
+        context = {'BED_TEMP': '65', 'EXTRUDER_TEMP': '215', 'speed': 50.}
+        context.update(print_start.create_template_context())
+        context['params'] = {'BED_TEMP': '65', 'EXTRUDER_TEMP': '215'}
+        print_start.render(context)
+    eventtime = [0.]
+    extruder = printer.lookup_object('extruder')
+    def run_display():
+        eventtime[0] += 1.
+        # Only the extruder temperature changes between screen updates
+        extruder.status['temperature'] = 205. + eventtime[0] % 10.
+        group.show(lcd, templates, eventtime[0])
+    def run_menu():
+        # Context as built by the menu on each screen update
+        eventtime[0] += 1.
+        context = gm.create_template_context(eventtime[0])
+        context['menu'] = {'eventtime': eventtime[0], 'back': lcd.draw_text,
+                           'exit': lcd.draw_text, 'ns': fanspeed.get_name()}
+        input_tpl, enable_tpl, name_tpl = menu_tpls
+        context['menu']['input'] = float(input_tpl.render(context))
+        enable_tpl.render(context)
+        name_tpl.render(context)
+    def run(name, func):
+        gm.render_hits = gm.render_misses = 0
+        count = 0
+        start = time.time()
+        while time.time() - start < options.duration:
+            for i in range(100):
+                func()
+            count += 100
+        report(name, count, time.time() - start, "renders")
+        if gm.render_hits or gm.render_misses:
+            print("%-32s %s" % ("", gm.stats(0.)[1]))
+    orig_wrapper = gcode_macro.GetStatusWrapper
+    gcode_macro.GetStatusWrapper = DeepCopyStatusWrapper
+    run("template PRINT_START deepcopy", run_print_start)
+    run("template display deepcopy", run_display)
+    gcode_macro.GetStatusWrapper = orig_wrapper
+    run("template PRINT_START", run_print_start)
+    run("template display", run_display)
+    run("template menu item", run_menu)
+
+
+######################################################################
+# Webhooks message encoding
+######################################################################
+
+def bench_webhooks(options):
+    import webhooks
+    printer = DummyPrinter()
+    setup_status_objects(printer)
+    objects = {name: None for name in printer.objects}
+    status = {name: obj.get_status(0.)
+              for name, obj in printer.objects.items()}
+    template = {'jsonrpc': "2.0", 'method': "notify_status_update"}
+    request = {'id': 123, 'method': "objects/subscribe",
+               'params': {'objects': objects,
+                          'response_template': template}}
+    toolhead = printer.lookup_object('toolhead')
+    extruder = printer.lookup_object('extruder')
+    def make_update(i):
+        pos = toolhead.status['position']._replace(x=100. + i * .01)
+        return {'eventtime': 1234.5 + i * .25,
+                'status': {'toolhead': {'position': pos},
+                           'gcode_move': {'gcode_position': pos},
+                           'extruder': {'temperature': 205. + i % 10}}}
+    updates = [make_update(i) for i in range(100)]
+    def run(name, func, data):
+        count = 0
+        start = time.time()
+        while time.time() - start < options.duration:
+            for d in data:
+                func(d)
+            count += len(data)
+        report(name, count, time.time() - start, "messages")
+    codecs = webhooks.lookup_codecs()
+    for codec_name in sorted(codecs):
+        codec = codecs[codec_name]
+        # Incoming subscription requests (as split from the socket data)
+        def decode_request(data):
+            for req in codec.split_messages(data)[0]:
+                webhooks.WebRequest(None, codec.decode(req))
+        run("webhooks %s request" % (codec_name,), decode_request,
+            [codec.encode(request)] * 10)
+        # Initial subscription response
+        response = {'id': 123, 'result': {'eventtime': 1234.5,
+                                          'status': status}}
+        run("webhooks %s status" % (codec_name,), codec.encode,
+            [response] * 10)
+        # Subscription updates
+        def encode_update(params):
+            webhooks.MessageCache(params).encode(codec, template)
+        run("webhooks %s update" % (codec_name,), encode_update, updates)
+        print("%-32s status_size=%d update_size=%d" % (
+            "", len(codec.encode(response)),
+            len(webhooks.MessageCache(updates[0]).encode(codec, template))))
+    if 'msgpack' not in codecs:
+        print("%-32s msgpack not available" % ("",))
+
+
+######################################################################
+# Startup
+######################################################################
+
+BENCHMARKS = {
+    'adxl345': bench_adxl345,
+    'bed_mesh': bench_bed_mesh,
+    'bed_mesh_sample': bench_bed_mesh_sample,
+    'gcode': bench_gcode,
+    'lookahead': bench_lookahead,
+    'msgproto': bench_msgproto,
+    'reactor': bench_reactor,
+    'template': bench_template,
+    'tmc_fields': bench_tmc_fields,
+    'webhooks': bench_webhooks,
+}
+
+def main():
+    usage = "%prog [options] <benchmark> [<benchmark> ...]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-d", "--duration", type="float", dest="duration",
+                    default=2., help="minimum time to run each benchmark")
+    opts.add_option("-g", "--gcode", type="string", dest="gcode",
+                    help="g-code file for the gcode benchmark")
+    opts.add_option("-s", "--serial", type="string", dest="serial",
+                    help="recorded serial data (eg, from klippy.py -o)"
+                    " for the msgproto benchmark")
+    opts.add_option("--dictionary", type="string", dest="dictionary",
+                    help="mcu data dictionary for the --serial file")
+    options, args = opts.parse_args()
+    if not args:
+        opts.error("Available benchmarks: %s" % (" ".join(sorted(BENCHMARKS))))
+    for name in args:
+        if name not in BENCHMARKS:
+            opts.error("Unknown benchmark '%s'" % (name,))
+    logging.basicConfig(level=logging.WARNING)
+    for name in args:
+        BENCHMARKS[name](options)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,15 @@
+; Small print file for adaptive bed_mesh tests - the extrusion moves
+; cover X50-80 Y50-80
+G90
+M82
+G1 X60 Y60 Z0.3 F3000
+G1 X80 Y60 E1
+G91
+G1 Y20 E1
+G1 X-20 E1 ; moves to X60 Y80
+G1 X100 Y100
+G1 X-100 Y-100
+G90
+G2 X60 Y60 I0 J-10 E5
+G3 X70 Y50 I10 J0 E6
+G1 X150 Y150 Z5
@@ -22,6 +22,12 @@ G1 X0 Y0
 G1 X1 Z2
 G1 X0 Y1 Z1
 
+; moves using less common formatting
+g1 x1 y1 f3000
+G1 X0Y0
+G0 X1 Y1 ; comment
+N10 G1 X0 Y0*95
+
 ; extrude only moves
 G1 E1
 G1 E0
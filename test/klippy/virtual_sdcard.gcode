@@ -0,0 +1,24 @@
+; Test print file for the virtual_sdcard g-code cache
+G28
+G90
+G1 Z5 F600
+
+G1 X10 Y10 F6000 ; move to start
+CHECK_POSITION POS=00107
+M83
+G1 X20 E1
+G1 Y20 E1
+; padding comment used to resume in the middle of a line
+CHECK_POSITION POS=00213
+G1 X10 E1
+G1 Y10 E1
+  G1 X15.5 Y12.25 E.5  ; leading space and comment
+CHECK_POSITION POS=00309
+G92 E0
+G1 X30 Y30 E2 F3000
+G0 X40 Y40
+CHECK_POSITION POS=00372
+SET_GCODE_OFFSET Z=0.1
+G1 X50 Y50 Z5.2
+SET_GCODE_OFFSET Z=0
+CHECK_POSITION POS=00457